@@ -15,10 +15,6 @@ import errno
 
 import imp
 
-import importlib
-
-import json
-
 import os
 
 import platform
@@ -29,18 +25,13 @@ import shutil
 
 import sys
 
+import time
+
 from collections import (defaultdict,
                          namedtuple)
 
 from contextlib import closing, contextmanager
 
-try:
-    from urllib.request import urlopen
-    from urllib.error import URLError
-except ImportError:
-    from urllib2 import urlopen  # suppress(import-error)
-    from urllib2 import URLError  # suppress(import-error)
-
 
 def force_mkdir(directory):
     """Recursively make all directories, ignores existing directories."""
@@ -59,6 +50,15 @@ def open_and_force_mkdir(path, mode):
     return open(path, mode)
 
 
+def _environment_list_without(key, value):
+    """Return the value of list key in os.environ without value."""
+    components = os.environ.get(key, "").split(os.pathsep)
+    if value in components:
+        components.remove(value)
+
+    return os.pathsep.join(components)
+
+
 class BashParentEnvironment(object):
     """A parent environment in a bash shell."""
 
@@ -95,22 +95,14 @@ class BashParentEnvironment(object):
 
     # suppress(invalid-name)
     def remove_from_environment_variable(self, key, value):
-        """Generate and execute script to remove value from key."""
-        value = BashParentEnvironment._format_environment_value(value)
-        script = ("export {k}=$(python -c \""
-                  "print(\\\":\\\".join(\\\"${k}\\\".split(\\\":\\\")"
-                  "[:\\\"${k}\\\".split(\\\":\\\").index(\\\"{v}\\\")] + "
-                  "\\\"${k}\\\".split(\\\":\\\")[\\\"${k}\\\".split(\\\":\\\")"
-                  ".index(\\\"{v}\\\") + 1:]))\")")
-        # There is something about the format() method on str which causes
-        # pychecker to trip over when passing keyword arguments. Just
-        # pass keyword arguments using the ** notation.
-        script_keys = {
-            "k": key,
-            "v": value
-        }
-        script = script.format(**script_keys)
-        self._printer(script)
+        """Generate and execute script to remove value from key.
+
+        The resulting value is computed here and overwrites key, so that
+        evaluating the script doesn't need to start another process.
+        """
+        self.overwrite_environment_variable(key,
+                                            _environment_list_without(key,
+                                                                      value))
 
     def prepend_environment_variable(self, key, value):
         """Generate and execute script to prepend value to key."""
@@ -151,19 +143,14 @@ class PowershellParentEnvironment(object):
 
     # suppress(invalid-name)
     def remove_from_environment_variable(self, key, value):
-        """Generate and execute script to remove value from key."""
-        script = ("$env:{k} = python -c \""
-                  "print(';'.join(r'$env:{k}'.split(';')"
-                  "[:r'$env:{k}'.split(r';').index(r'{v}')] + "
-                  "r'$env:{k}'.split(';')"
-                  "[r'$env:{k}'.split(';')"
-                  ".index(r'{v}') + 1:]))\"")
-        script_keys = {
-            "k": key,
-            "v": value
-        }
-        script = script.format(**script_keys)
-        self._printer(script)
+        """Generate and execute script to remove value from key.
+
+        The resulting value is computed here and overwrites key, so that
+        evaluating the script doesn't need to start another process.
+        """
+        self.overwrite_environment_variable(key,
+                                            _environment_list_without(key,
+                                                                      value))
 
     def prepend_environment_variable(self, key, value):
         """Generate and execute script to prepend value to key."""
@@ -195,33 +182,124 @@ class PowershellParentEnvironment(object):
         self._printer("exit {0}".format(status))
 
 
+def _lock_file(lock_file):
+    """Block until an exclusive lock on the open lock_file is held."""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt  # suppress(import-error)
+
+        # LK_LOCK only retries for ten seconds before giving up, so keep
+        # on trying until the lock is acquired.
+        while True:
+            try:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except IOError:  # suppress(pointless-except)
+                pass
+
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+
+def _lock_file_shared(lock_file):
+    """Block until a shared lock on the open lock_file is held.
+
+    Returns False if shared locks are not supported on this platform.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH)
+    return True
+
+
+def _try_lock_file(lock_file):
+    """Take an exclusive lock on the open lock_file, if nobody holds one.
+
+    Returns True if the lock is now held.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt  # suppress(import-error)
+
+        try:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except IOError:
+            return False
+
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError:
+        return False
+
+
+def _unlock_file(lock_file):
+    """Release the lock held on lock_file."""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt  # suppress(import-error)
+
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def locked_file(path):
+    """Hold an exclusive lock on the file at path while in this context.
+
+    The lock is held against other processes and other threads, but
+    it is not re-entrant - taking the same lock again while holding it
+    will block forever.
+    """
+    with open_and_force_mkdir(path, "a") as lock_file:
+        _lock_file(lock_file)
+        try:
+            yield
+        finally:
+            _unlock_file(lock_file)
+
+
 def _update_set_like_file(path, key):
     """For the file containing unique lines at :path:, add :key:.
 
     This function assumes that the file at :path: is a set-like file -
     it should contain one line per unique entry. :key: will be added
     if the file does not contain it already.
-    """
-    added_key = False
-    try:
-        with open(path, "r") as set_like_file:
-            records = set(set_like_file.read().splitlines())
-            if key not in records:
-                records |= set([key])
-                added_key = True
-    except IOError:
-        # Set added_key to True so that we write to this file
-        # next time
-        added_key = True
-        records = set([key])
 
-    # Only modify the file if we added a new language record, otherwise
-    # this file will cause the cache to be constantly marked as
-    # invalid.
-    if added_key:
-        with open(path, "w") as set_like_file:
-            set_like_file.truncate(0)
-            set_like_file.write("\n".join(list(records)))
+    Other processes may be updating the same file, so the file is
+    locked while it is being updated and the new contents are renamed
+    into place.
+    """
+    with locked_file(path + ".lock"):
+        added_key = False
+        try:
+            with open(path, "r") as set_like_file:
+                records = set(set_like_file.read().splitlines())
+                if key not in records:
+                    records |= set([key])
+                    added_key = True
+        except IOError:
+            # Set added_key to True so that we write to this file
+            # next time
+            added_key = True
+            records = set([key])
+
+        # Only modify the file if we added a new language record, otherwise
+        # this file will cause the cache to be constantly marked as
+        # invalid.
+        if added_key:
+            _write_atomically(path, "\n".join(list(records)).encode("utf-8"))
 
 
 class ContainerBase(object):
@@ -260,12 +338,13 @@ class ContainerBase(object):
         """
         if os.path.exists(self._ephemeral_caches):
             with util.Task("""Cleaning ephemeral caches"""):
-                with open(self._ephemeral_caches, "r") as ephemeral_log:
-                    for ephemeral_cache in ephemeral_log.readlines():
-                        self.delete(os.path.join(self._cache_dir,
-                                                 ephemeral_cache.strip()))
+                with locked_file(self._ephemeral_caches + ".lock"):
+                    with open(self._ephemeral_caches, "r") as ephemeral_log:
+                        for ephemeral_cache in ephemeral_log.readlines():
+                            self.delete(os.path.join(self._cache_dir,
+                                                     ephemeral_cache.strip()))
 
-                self.delete(self._ephemeral_caches)
+                    self.delete(self._ephemeral_caches)
 
     def named_cache_dir(self, name, ephemeral=True):
         """Return a dir called name in the cache dir, even if it exists.
@@ -285,6 +364,17 @@ class ContainerBase(object):
         """Return path to this container directory."""
         return self._container_dir
 
+    def lock(self, name):
+        """Return a context manager holding the lock called name.
+
+        Use this to make sure that only one process sharing this container
+        is doing something, such as installing a language, at a time.
+        Other processes wait until the lock is released.
+        """
+        return locked_file(os.path.join(self._cache_dir,
+                                        "locks",
+                                        name + ".lock"))
+
     @contextmanager
     def in_temp_cache_dir(self):
         """Create a temporary directory in the cache dir.
@@ -354,36 +444,31 @@ class LanguageBase(ContainerBase):
         """
         # Skip if this container has already been activated
         activation_keys = _keys_for_activation(self._language, self._version)
-        activated_env = os.environ.get(activation_keys.activated, None)
         shell = self._parent_shell if persist else None
 
-        if activated_env:
-            util.overwrite_environment_variable(shell,
-                                                activation_keys.activated,
-                                                str(int(activated_env) + 1))
-            return False
+        with util.environment_transaction(shell) as environment:
+            activated_env = environment.get(activation_keys.activated)
 
-        active_environment = self._active_environment(ActiveEnvironment)
+            if activated_env:
+                environment.overwrite(activation_keys.activated,
+                                      str(int(activated_env) + 1))
+                return False
 
-        for key, value in active_environment.overwrite.items():
-            backup = activation_keys.deactivate.format(key=key)
-            util.overwrite_environment_variable(shell,
-                                                backup,
-                                                util.maybe_environ(key))
-            util.overwrite_environment_variable(shell, key, value)
+            active_environment = self._active_environment(ActiveEnvironment)
 
-        for key, value in active_environment.prepend.items():
-            inserted = activation_keys.inserted.format(key=key)
-            util.overwrite_environment_variable(shell,
-                                                inserted,
-                                                value)
-            util.prepend_environment_variable(shell, key, value)
+            for key, value in active_environment.overwrite.items():
+                backup = activation_keys.deactivate.format(key=key)
+                environment.overwrite(backup, environment.get(key, ""))
+                environment.overwrite(key, value)
 
-        util.overwrite_environment_variable(shell,
-                                            activation_keys.activated,
-                                            "1")
+            for key, value in active_environment.prepend.items():
+                inserted = activation_keys.inserted.format(key=key)
+                environment.overwrite(inserted, value)
+                environment.prepend(key, value)
 
-        return True
+            environment.overwrite(activation_keys.activated, "1")
+
+            return True
 
     def _deactivate(self, util, persist=False):
         """Deactivate this container in both the parent and current context.
@@ -397,47 +482,40 @@ class LanguageBase(ContainerBase):
         reference count will be decreased.
         """
         activation_keys = _keys_for_activation(self._language, self._version)
-
-        # We substitute zero here because that is treated as the never
-        # activated value.
-        activated_env = os.environ.get(activation_keys.activated, "0")
         shell = self._parent_shell if persist else None
 
-        if int(activated_env) > 1:
-            util.overwrite_environment_variable(shell,
-                                                activation_keys.activated,
-                                                str(int(activated_env) - 1))
-            return False
-        elif int(activated_env) == 1:
-            active_environment = self._active_environment(ActiveEnvironment)
-
-            for key in active_environment.overwrite.keys():
-                backup = activation_keys.deactivate.format(key=key)
-                util.overwrite_environment_variable(shell,
-                                                    key,
-                                                    os.environ.get(backup, ""))
-                util.overwrite_environment_variable(shell,
-                                                    backup,
-                                                    None)
-
-            for key in active_environment.prepend.keys():
-                inserted = activation_keys.inserted.format(key=key)
-                for value in os.environ[inserted].split(os.pathsep):
-                    util.remove_from_environment_variable(shell,
-                                                          key,
-                                                          value)
-
-                util.overwrite_environment_variable(shell,
-                                                    inserted,
-                                                    None)
-
-            util.overwrite_environment_variable(shell,
-                                                activation_keys.activated,
-                                                None)
-
-            return True
-        else:
-            return False
+        with util.environment_transaction(shell) as environment:
+            # We substitute zero here because that is treated as the never
+            # activated value.
+            activated_env = environment.get(activation_keys.activated, "0")
+
+            if int(activated_env) > 1:
+                environment.overwrite(activation_keys.activated,
+                                      str(int(activated_env) - 1))
+                return False
+            elif int(activated_env) == 1:
+                active_environment = self._active_environment(
+                    ActiveEnvironment
+                )
+
+                for key in active_environment.overwrite.keys():
+                    backup = activation_keys.deactivate.format(key=key)
+                    environment.overwrite(key, environment.get(backup, ""))
+                    environment.overwrite(backup, None)
+
+                for key in active_environment.prepend.keys():
+                    inserted = activation_keys.inserted.format(key=key)
+                    environment.remove(
+                        key,
+                        *environment.get(inserted).split(os.pathsep)
+                    )
+                    environment.overwrite(inserted, None)
+
+                environment.overwrite(activation_keys.activated, None)
+
+                return True
+            else:
+                return False
 
     def activate(self, util):
         """Activate this container, persisting across invocations."""
@@ -484,281 +562,1537 @@ class LanguageBase(ContainerBase):
 FetchedModule = namedtuple("FetchedModule", "in_scripts_dir fs_path")
 
 
-_GITHUB_URLPATH = "polysquare/polysquare-ci-scripts/master/ciscripts/"
+_GITHUB_URLPATH_AT = "polysquare/polysquare-ci-scripts/{sha1}/ciscripts/"
+_GITHUB_URLPATH = _GITHUB_URLPATH_AT.format(sha1="master")
+_GITHUB_ARCHIVE = ("https://codeload.github.com/"
+                   "polysquare/polysquare-ci-scripts/tar.gz/{sha1}")
+
+# Scripts which almost every setup and check script ends up importing,
+# prefetched together if an archive of the whole tree is not available.
+_COMMON_SCRIPTS = (
+    "bootstrap.py",
+    "util.py",
+    "python_util.py",
+    "ruby_util.py",
+    "setup/project/configure_os.py",
+    "setup/project/configure_python.py",
+    "setup/project/configure_ruby.py",
+    "setup/project/setup.py"
+)
 
 
-def _fetch_script(info,
-                  script_path,
-                  domain="raw.githubusercontent.com",
-                  urlpath=_GITHUB_URLPATH):
-    """Download a script if it doesn't exist."""
-    if not os.path.exists(info.fs_path):
-        with open_and_force_mkdir(info.fs_path, "w") as scr:
-            remote = "%s/%s/%s" % (domain, urlpath, script_path)
-            retrycount = 100
-            while retrycount != 0:
-                try:
-                    contents = urlopen("http://{0}".format(remote)).read()
-                    scr.write(contents.decode())
-                    scr.truncate()
-                    retrycount = 0
-                except URLError:
-                    retrycount -= 1
-
-
-def _update_scripts_sha1_and_rmtree(scripts_dir, cache_dir, sha1):
-    """Write sha1 to file in cache_dir."""
-    with open(os.path.join(cache_dir,
-                           "most_recent"), "w") as recent_file:
-        recent_file.write(sha1)
-
-    if os.path.exists(scripts_dir) and os.path.isdir(scripts_dir):
-        shutil.rmtree(scripts_dir)
-
-
-def _fetch_sha1(stale_check):
-    """Fetch most recent sha1 from github."""
-    retrycount = 5
-    while retrycount != 0:
-        try:
-            contents = urlopen("http://" + stale_check).read().decode("utf-8")
-            return json.loads(contents)["sha"]
-        except URLError:
-            retrycount -= 1
+def _url_error():
+    """Return class representing a failed request.
 
-    return None
+    urllib is only imported when it is needed, so that it isn't
+    imported at all when nothing has to be fetched.
+    """
+    try:
+        from urllib.error import URLError
+    except ImportError:
+        from urllib2 import URLError  # suppress(import-error)
 
+    return URLError
 
-def _clear_stale(scripts_dir,
-                 cache_dir,
-                 stale_check):
-    """Clear scripts_dir if it is out of date.
 
-    We check the sha1 of the most recent commit returned by github
-    against the stored sha1 for our current scripts.
+class _PooledResponse(object):
+    """A response to a request made by HTTPClient.
 
-    If stale_check is not specified then we don't bother clearing
-    the directory.
+    Once the body of the response has been read, the connection it was
+    read from is handed back to the client to be re-used.
     """
-    if not stale_check:
-        return
 
-    sha1 = _fetch_sha1(stale_check)
+    def __init__(self, client, key, connection, response, url):
+        """Initialize this response, read from connection."""
+        super(_PooledResponse, self).__init__()
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._url = url
+
+    def read(self, amount=None):
+        """Read amount bytes from the response, or all of it."""
+        if amount is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amount)
 
-    if not sha1:
-        return
+        if self._response.isclosed():
+            self.close()
 
-    try:
-        with open(os.path.join(cache_dir, "most_recent"), "r") as recent_file:
-            most_recent = recent_file.read().strip()
+        return data
 
-        if most_recent != sha1:
-            _update_scripts_sha1_and_rmtree(scripts_dir, cache_dir, sha1)
-    except IOError:
-        _update_scripts_sha1_and_rmtree(scripts_dir, cache_dir, sha1)
+    def info(self):
+        """Return headers of this response."""
+        return self._response.msg
 
+    def getcode(self):
+        """Return status code of this response."""
+        return self._response.status
 
-_GH_STALE_CHECK = (
-    # suppress(E501)
-    "https://api.github.com/repos/polysquare/polysquare-ci-scripts/commits/HEAD"
-)
+    def geturl(self):
+        """Return the URL this response was read from."""
+        return self._url
 
+    def close(self):
+        """Close this response.
 
-class ContainerDir(ContainerBase):
-    """A container that all scripts and other data will be stored in."""
+        If the body was read in full then the connection goes back into
+        the pool, otherwise there is no way to re-use it.
+        """
+        if self._connection is None:
+            return
 
-    def __init__(self,
-                 shell,
-                 directory=None,
-                 stale_check=_GH_STALE_CHECK,
-                 **kwargs):
-        """Initialize this container in the directory specified."""
-        super(ContainerDir, self).__init__(directory)
-        if kwargs.get("scripts_directory"):
-            self._scripts_dir = kwargs["scripts_directory"]
-            self._force_created_scripts_dir = False
+        if self._response.isclosed() and not self._response.will_close:
+            self._client._release(self._key,  # suppress(protected-access)
+                                  self._connection)
         else:
-            self._scripts_dir = (os.path.join(self._container_dir, "_scripts"))
-            # First check if there's a more recent version of these scripts
-            # than the one we have stored. If so, we'll wipe out the
-            # scripts directory
-            _clear_stale(self._scripts_dir,
-                         self.named_cache_dir("scripts-updates",
-                                              ephemeral=False),
-                         stale_check)
-            force_mkdir(self._scripts_dir)
+            self._connection.close()
 
-            # Ensure that we have a /bootstrap.py script in our
-            # container.
-            _fetch_script(self.script_path("bootstrap.py"), "bootstrap.py")
-            self._force_created_scripts_dir = True
+        self._connection = None
 
-        sys.path = [self._scripts_dir] + sys.path
 
-        self._languages_dir = force_mkdir(os.path.join(self._container_dir,
-                                                       "_languages"))
-        self._languages_record_path = os.path.join(self._languages_dir,
-                                                   "record")
-        self._module_cache = dict()
+# Some servers, including the github API, refuse requests without
+# a User-Agent, so send the same one that urllib would have sent.
+_USER_AGENT = "Python-urllib/{0}.{1}".format(*sys.version_info[:2])
 
-        # Create languages record file if it doesn't exist
-        if not os.path.exists(self._languages_record_path):
-            with open(self._languages_record_path, "w"):
-                pass
 
-        self._failures = 0
-        self._shell = shell
+class HTTPClient(object):
+    """An HTTP client that keeps connections to each host alive.
 
-    def clean(self, util):
-        """Clean this container and all sub-containers."""
-        info = namedtuple("Info", "language version")
+    Failed requests are retried with exponential backoff and jitter,
+    until either :retries: retries have been made or :deadline: seconds
+    have passed since the first attempt. Responses with a status code
+    of 4xx are not retried.
 
-        # Having everything on one line is nice
-        #
-        # suppress(invalid-name)
-        with open(self._languages_record_path, "r") as f:
-            containers = [info(*(c.split("-"))) for c in f.read().splitlines()]
+    The number of requests and retries made and the total time spent
+    waiting for responses is kept in statistics.
+    """
 
-        for info in containers:
-            with util.Task("""Cleaning {0} {1} """
-                           """container""".format(info.language,
-                                                  info.version)):
-                script = "setup/project/configure_{0}.py".format(info.language)
-                ver_info = defaultdict(lambda: info.version)
-                self.fetch_and_import(script).get(self,
-                                                  util,
-                                                  None,
-                                                  ver_info).clean(util)
+    # suppress(too-many-arguments)
+    def __init__(self,
+                 retries=8,
+                 timeout=30,
+                 deadline=300,
+                 backoff=0.5,
+                 max_backoff=16):
+        """Initialize this HTTPClient with its retry policy."""
+        import threading
+
+        super(HTTPClient, self).__init__()
+        self._retries = retries
+        self._timeout = timeout
+        self._deadline = deadline
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._idle = defaultdict(list)
+        self._secure_hosts = set()
+        self._lock = threading.Lock()
+        self.statistics = defaultdict(float)
+
+    def _count(self, statistic, value=1):
+        """Add value to statistic."""
+        with self._lock:
+            self.statistics[statistic] += value
+
+    def _release(self, key, connection):
+        """Return connection to the pool of idle connections for key."""
+        with self._lock:
+            self._idle[key].append(connection)
+
+    def _connection(self, key, timeout):
+        """Return an idle connection for key, or a new one.
+
+        The second member of the returned tuple is True if the connection
+        was re-used.
+        """
+        try:
+            import http.client as http_client
+        except ImportError:
+            import httplib as http_client  # suppress(import-error)
 
-        with util.Task("""Cleaning up downloaded scripts"""):
-            if self._force_created_scripts_dir:
-                util.apply_to_files(util.force_remove_tree,
-                                    self._scripts_dir,
-                                    matching=["*.pyc"])
+        with self._lock:
+            if self._idle[key]:
+                connection = self._idle[key].pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
 
-        # Clean our own caches once we've cleaned caches from
-        # other containers, as they might be relying on our own cache.
-        super(ContainerDir, self).clean(util)
+                return (connection, True)
 
-    def script_path(self, relative_path):
-        """Get absolute path to script specified at relative_path.
+        scheme, netloc = key
+        if scheme == "https":
+            return (http_client.HTTPSConnection(netloc, timeout=timeout),
+                    False)
 
-        This function first looks in the current working directory
-        for a script named by :relative_path: and if it can't find
-        it, it will look in its own internal scripts directory.
-        """
-        # First try to find the script locally in the
-        # current working directory.
-        fs_path = os.path.realpath(os.path.join(os.getcwd(), relative_path))
+        return (http_client.HTTPConnection(netloc, timeout=timeout), False)
 
-        # Next try to find it in our scripts directory, or fetch it from
-        # the server which hosts all the scripts.
-        if not os.path.exists(fs_path):
-            fs_path = os.path.join(self._scripts_dir,
-                                   "ciscripts",
-                                   relative_path)
-            return FetchedModule(True, fs_path)
-        else:
-            return FetchedModule(False, fs_path)
+    def _request(self, url, headers, timeout):
+        """Make a single GET request for url, returning its response."""
+        import socket
 
-    # suppress(unused-function)
-    def loaded_module_name(self,
-                           script_path,
-                           domain="raw.githubusercontent.com",
-                           urlpath=_GITHUB_URLPATH):
-        """Get loaded module name for :script_path:."""
-        key = "{0}/{1}/{2}".format(domain, urlpath, script_path)
         try:
-            return self._module_cache[key].__name__
-        except KeyError:
-            return None
+            import http.client as http_client
+            from urllib.parse import urlsplit
+        except ImportError:
+            import httplib as http_client  # suppress(import-error)
+            from urlparse import urlsplit  # suppress(import-error)
 
-    def fetch_script(self,
-                     script_path,
-                     domain="raw.githubusercontent.com",
-                     urlpath=_GITHUB_URLPATH):
-        """Wrapper for _fetch_script, returns a FetchedModule."""
-        info = self.script_path(script_path)
-        _fetch_script(info, script_path, domain, urlpath)
-        return info
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        selector = parts.path or "/"
+        if parts.query:
+            selector += "?" + parts.query
 
-    def fetch_and_import(self,
-                         script_path,
-                         domain="raw.githubusercontent.com",
-                         urlpath=_GITHUB_URLPATH):
-        """Download a script if its not available and import it.
+        while True:
+            connection, reused = self._connection(key, timeout)
 
-        This downloads the script as part of the URL path as indicated by
-        script_path if it isn't already available in the specified directory.
-        """
-        def import_file_directly(path):
-            """Import a file at :path: directly, bypassing __import__."""
-            name = "local_module_" + re.sub(r"[\./]", "_", path)
-            return imp.load_source(name, path)
+            try:
+                connection.request("GET", selector, headers=headers)
+                response = connection.getresponse()
+            except (socket.error, http_client.HTTPException):
+                connection.close()
 
-        # First try to find the script locally in the
-        # current working directory.
-        info = self.fetch_script(script_path, domain, urlpath)
-        key = "{0}/{1}/{2}".format(domain, urlpath, script_path)
+                # The server may have closed a connection that was idle,
+                # in which case a new connection should just be made.
+                if reused:
+                    continue
 
-        try:
-            return self._module_cache[key]
-        except KeyError:
-            # We try to import the file normally first - this is useful
-            # for tests where we want to be able to get coverage on those
-            # files. If we can't import directly, then we need to
-            # fall back to importing the file.
-            fs_path = info.fs_path
-            if info.in_scripts_dir:
-                try:
-                    name = os.path.relpath(os.path.splitext(fs_path)[0],
-                                           start=self._scripts_dir)
-                    name = name.replace(os.path.sep, ".")
-                    self._module_cache[key] = importlib.import_module(name)
-                except ImportError:
-                    self._module_cache[key] = import_file_directly(fs_path)
-            else:
-                self._module_cache[key] = import_file_directly(fs_path)
+                raise
 
-        return self._module_cache[key]
+            return _PooledResponse(self, key, connection, response, url)
 
-    def language_dir(self, language):
-        """Return a dir to hold installations of language."""
-        path = os.path.join(self._languages_dir, language)
-        force_mkdir(path)
+    def _proxied(self, url):
+        """Return True if requests for url need to go through a proxy."""
+        try:
+            from urllib.request import getproxies, proxy_bypass
+            from urllib.parse import urlsplit
+        except ImportError:
+            # suppress(import-error)
+            from urllib import getproxies, proxy_bypass
+            from urlparse import urlsplit  # suppress(import-error)
 
-        return path
+        parts = urlsplit(url)
+        return (parts.scheme in getproxies() and
+                not proxy_bypass(parts.hostname))
 
-    def note_failure(self, instant_fail):
-        """Note a failure.
+    def _open_once(self, url, headers, timeout):
+        """Open url, following redirects and raising HTTPError on failure."""
+        try:
+            from urllib.request import Request, urlopen
+            from urllib.error import HTTPError
+            from urllib.parse import urljoin, urlsplit
+        except ImportError:
+            # suppress(import-error)
+            from urllib2 import Request, HTTPError, urlopen
+            from urlparse import urljoin, urlsplit  # suppress(import-error)
+
+        headers = dict({"User-Agent": _USER_AGENT}, **headers)
+
+        for _ in range(5):
+            parts = urlsplit(url)
+            if parts.scheme == "http" and parts.netloc in self._secure_hosts:
+                url = "https" + url[len("http"):]
+
+            if self._proxied(url):
+                request = Request(url)
+                for header, value in headers.items():
+                    request.add_header(header, value)
+
+                return urlopen(request, timeout=timeout)
+
+            started = time.time()
+            response = self._request(url, headers, timeout)
+            self._count("requests")
+            self._count("seconds", time.time() - started)
+
+            code = response.getcode()
+            if code in (301, 302, 303, 307, 308):
+                response.read()
+                location = urljoin(url, response.info().get("Location"))
+                redirected = urlsplit(location)
+
+                # Remember hosts that permanently redirect to https
+                # to save a round trip next time.
+                if (code in (301, 308) and
+                        redirected.scheme == "https" and
+                        redirected.netloc == parts.netloc):
+                    with self._lock:
+                        self._secure_hosts.add(parts.netloc)
+
+                url = location
+                continue
+
+            if code < 200 or code >= 300:
+                response.read()
+                raise HTTPError(url,
+                                code,
+                                response._response.reason,  # suppress(PYC70)
+                                response.info(),
+                                None)
+
+            return response
+
+        raise _url_error()("""Too many redirects for {0}""".format(url))
+
+    def open(self, url, headers=None, **kwargs):
+        """Open url and return its response, retrying on failure.
+
+        Pass :retries:, :timeout: and :deadline: to override the retry
+        policy of this client for this request. Responses with a status
+        code that is not 2xx raise HTTPError, other failures raise URLError
+        once there are no retries left.
+        """
+        import random
+        import socket
 
-        If instant_fail is True, then immediately exit, also making the
-        invoking shell exit too with our current exit status.
+        try:
+            import http.client as http_client
+            from urllib.error import HTTPError
+        except ImportError:
+            import httplib as http_client  # suppress(import-error)
+            from urllib2 import HTTPError  # suppress(import-error)
+
+        retries = kwargs.get("retries", self._retries)
+        timeout = kwargs.get("timeout", None) or self._timeout
+        deadline = time.time() + (kwargs.get("deadline", None) or
+                                  self._deadline)
+        errors = list()
+
+        for attempt in range(retries + 1):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                return self._open_once(url,
+                                       headers or dict(),
+                                       min(timeout, remaining))
+            except HTTPError as error:
+                if error.code < 500 and error.code != 429:
+                    raise
+
+                errors.append(error)
+            except (_url_error(),
+                    socket.error,
+                    http_client.HTTPException) as error:
+                errors.append(error)
+
+            if attempt != retries:
+                self._count("retries")
+                delay = min(self._max_backoff, self._backoff * 2 ** attempt)
+                time.sleep(max(0, min(random.uniform(0, delay),
+                                      deadline - time.time())))
+
+        self._count("failures")
+        raise _url_error()(u"""Failed to open URL {0} after {1} """
+                           u"""attempts. Errors [{2}]""".format(
+                               url,
+                               len(errors),
+                               ", ".join([repr(e) for e in errors])
+                           ))
+
+    def fetch(self, url, headers=None, **kwargs):
+        """Fetch the contents of url, retrying on failure.
+
+        Returns a tuple of the contents and headers of the response.
+        Reading the contents is retried as well as opening the URL.
         """
-        self._failures += 1
+        import socket
 
-        if instant_fail:
-            self._shell.exit(self._failures)
-            sys.exit(self._failures)
+        try:
+            import http.client as http_client
+        except ImportError:
+            import httplib as http_client  # suppress(import-error)
 
-    def reset_failure_count(self):  # suppress(unused-function)
-        """Reset failure count for this container."""
-        self._failures = 0
+        retries = kwargs.pop("retries", self._retries)
+        while True:
+            response = self.open(url, headers, retries=retries, **kwargs)
+            try:
+                with closing(response):
+                    return (response.read(), response.info())
+            except (socket.error, http_client.HTTPException):
+                if retries == 0:
+                    raise
 
-    def return_code(self):
-        """Return code of this container."""
-        return self._failures
+                retries -= 1
+                self._count("retries")
 
-    def new_container_for(self, language, version):
-        """Return class to construct a sub-container from.
 
-        Keep a note of the language and version combination that we just
-        requested a new container for.
-        """
-        key = "{language}-{version}".format(language=language, version=version)
-        _update_set_like_file(self._languages_record_path, key)
+_HTTP_CLIENT = list()
 
-        return LanguageBase
+
+def http_client():
+    """Return the HTTPClient shared by everything in this process."""
+    if not _HTTP_CLIENT:
+        _HTTP_CLIENT.append(HTTPClient())
+
+    return _HTTP_CLIENT[0]
+
+
+def _replace_file(source, destination):
+    """Rename source to destination, replacing destination if it exists."""
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        # Python 2 does not have os.replace and os.rename will not
+        # overwrite an existing file on Windows.
+        if platform.system() == "Windows" and os.path.exists(destination):
+            os.unlink(destination)
+
+        os.rename(source, destination)
+
+
+def _write_atomically(path, contents):
+    """Write contents to path by renaming a temporary file into place.
+
+    Other processes looking at path will either see no file at all
+    or the fully written file, never a partially downloaded one.
+    """
+    import tempfile
+
+    descriptor, temp_path = tempfile.mkstemp(dir=force_mkdir(os.path.dirname(
+        path
+    )), prefix=".tmp-")
+
+    try:
+        with os.fdopen(descriptor, "wb") as temp_file:
+            temp_file.write(contents)
+
+        _replace_file(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _scripts_urlpath(sha1):
+    """Return the urlpath to fetch the scripts at revision sha1 from.
+
+    Scripts fetched into the directory for a version of the scripts
+    must come from that version, not whatever master is at the time.
+    """
+    return _GITHUB_URLPATH_AT.format(sha1=sha1) if sha1 else _GITHUB_URLPATH
+
+
+def _version_in_scripts_directory(scripts_directory):
+    """Return the sha1 of the version of the scripts in scripts_directory.
+
+    Returns None if scripts_directory is not the directory for a version
+    of the scripts in a container.
+    """
+    path = os.path.realpath(scripts_directory)
+    if (os.path.basename(os.path.dirname(path)) == "_scripts" and
+            re.match(r"^[0-9a-f]{40}$", os.path.basename(path))):
+        return os.path.basename(path)
+
+    return None
+
+
+def _fetch_script(info,
+                  script_path,
+                  domain="raw.githubusercontent.com",
+                  urlpath=_GITHUB_URLPATH):
+    """Download a script if it doesn't exist."""
+    if not os.path.exists(info.fs_path):
+        remote = "%s/%s/%s" % (domain, urlpath, script_path)
+        contents = http_client().fetch("http://{0}".format(remote))[0]
+        _write_atomically(info.fs_path, contents)
+
+
+def _fetch_scripts_concurrently(scripts, domain, urlpath, jobs):
+    """Fetch each (info, script_path) pair in scripts on :jobs: threads."""
+    import threading
+
+    try:
+        from Queue import Queue, Empty
+    except ImportError:
+        # suppress(F811,E301,E101,F401,import-error,unused-import)
+        from queue import Queue, Empty
+
+    pending = Queue()
+    for info, script_path in scripts:
+        pending.put((info, script_path))
+
+    errors = list()
+
+    def fetcher():
+        """Fetch scripts until there are none left to fetch."""
+        while True:
+            try:
+                info, script_path = pending.get_nowait()
+            except Empty:
+                return
+
+            try:
+                _fetch_script(info, script_path, domain, urlpath)
+            except Exception as error:  # suppress(broad-except)
+                errors.append(error)
+
+    threads = [threading.Thread(target=fetcher)
+               for _ in range(max(1, min(jobs, len(scripts))))]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    # Raise the first error here, as it would have been raised if the
+    # scripts had been fetched one after another.
+    if errors:
+        raise errors[0]
+
+
+def _write_bundle(path, sources):
+    """Write a zip file containing sources to path."""
+    import io
+    import zipfile
+
+    contents = io.BytesIO()
+    with closing(zipfile.ZipFile(contents,
+                                 "w",
+                                 zipfile.ZIP_DEFLATED)) as bundle:
+        for name in sorted(sources.keys()):
+            bundle.writestr(name, sources[name])
+
+    _write_atomically(path, contents.getvalue())
+
+
+def _fetch_scripts_archive(scripts_dir, archive_url, bundle_path=None):
+    """Unpack the ciscripts/ tree from a tarball at archive_url.
+
+    The tarball is unpacked as it is being downloaded. Scripts that
+    already exist in scripts_dir are left alone. If :bundle_path: is
+    passed, all the scripts are also written to a zip file there, which
+    can be loaded by a BundleImporter. Returns True if the archive could
+    be fetched, or False if it couldn't, or the connection dropped or
+    the archive was corrupt while it was being unpacked.
+    """
+    import socket
+    import tarfile
+    import zlib
+
+    try:
+        import http.client as http_client_module
+    except ImportError:
+        import httplib as http_client_module  # suppress(import-error)
+
+    sources = dict()
+
+    try:
+        remote = http_client().open(archive_url)
+
+        with closing(remote):
+            with closing(tarfile.open(fileobj=remote,
+                                      mode="r|gz")) as archive:
+                for member in archive:
+                    # The first component of every path in the archive is
+                    # the name of the repository and revision.
+                    components = member.name.split("/")[1:]
+                    if (not member.isfile() or
+                            components[:1] != ["ciscripts"] or
+                            ".." in components):
+                        continue
+
+                    contents = archive.extractfile(member).read()
+                    sources["/".join(components[1:])] = contents
+
+                    path = os.path.join(scripts_dir, *components)
+                    if not os.path.exists(path):
+                        _write_atomically(path, contents)
+    except (_url_error(),
+            socket.error,
+            http_client_module.HTTPException,
+            tarfile.TarError,
+            zlib.error,
+            EOFError):
+        return False
+
+    if bundle_path:
+        _write_bundle(bundle_path, sources)
+
+    return True
+
+
+def _read_lines(path):
+    """Return the lines in the file at path, or nothing if it is missing."""
+    try:
+        with open(path, "r") as lines_file:
+            return lines_file.read().splitlines()
+    except IOError:
+        return list()
+
+
+def _write_lines_if_changed(path, lines):
+    """Write lines to the file at path, unless it already contains them.
+
+    Rewriting a file with the same contents would cause the cache to
+    be constantly marked as invalid.
+    """
+    if _read_lines(path) != lines:
+        _write_atomically(path, "\n".join(lines).encode("utf-8"))
+
+
+def _scripts_version_lock_path(scripts_root, sha1):
+    """Return path to the lock held by users of version sha1."""
+    return os.path.join(scripts_root, sha1 + ".lock")
+
+
+def _hold_scripts_version(scripts_root, sha1):
+    """Hold a shared lock on version sha1 of the scripts while it is used.
+
+    The lock is held until the returned file is closed, which prevents
+    other processes from removing the version in the meantime. Returns
+    None where shared locks are not supported.
+    """
+    lock_file = open_and_force_mkdir(_scripts_version_lock_path(scripts_root,
+                                                                sha1),
+                                     "a")
+
+    if not _lock_file_shared(lock_file):
+        lock_file.close()
+        return None
+
+    return lock_file
+
+
+def _remove_scripts_version(scripts_root, sha1):
+    """Remove the directory for version sha1, unless it is being used.
+
+    Returns True if the directory was removed.
+    """
+    with open_and_force_mkdir(_scripts_version_lock_path(scripts_root, sha1),
+                              "a") as lock_file:
+        if not _try_lock_file(lock_file):
+            return False
+
+        try:
+            shutil.rmtree(os.path.join(scripts_root, sha1),
+                          ignore_errors=True)
+        finally:
+            _unlock_file(lock_file)
+
+    return True
+
+
+def _use_scripts_version(scripts_root, cache_dir, sha1, keep):
+    """Mark sha1 as the most recently used version of the scripts.
+
+    Each version of the scripts lives in its own directory in
+    scripts_root. Only the :keep: most recently used versions are kept,
+    the directories for any others are removed once nothing is using
+    them any more.
+    """
+    versions_path = os.path.join(cache_dir, "versions")
+
+    with locked_file(versions_path + ".lock"):
+        versions = _read_lines(versions_path)
+        versions = [sha1] + [v for v in versions if v != sha1]
+        in_use = [v for v in versions[keep:]
+                  if not _remove_scripts_version(scripts_root, v)]
+
+        _write_lines_if_changed(versions_path, versions[:keep] + in_use)
+        _write_lines_if_changed(os.path.join(cache_dir, "most_recent"),
+                                [sha1])
+
+        # Scripts from before versioned directories were introduced were
+        # stored directly in scripts_root. Remove them the first time
+        # a version is used, but not afterwards, as they are used again
+        # whenever the version of the scripts can't be determined.
+        migrated_path = os.path.join(cache_dir, "migrated")
+        if not os.path.exists(migrated_path):
+            shutil.rmtree(os.path.join(scripts_root, "ciscripts"),
+                          ignore_errors=True)
+            _write_atomically(migrated_path, b"")
+
+
+def _report_stale_check_failure(stale_check, error):
+    """Report that the most recent sha1 couldn't be fetched on stderr."""
+    sys.stderr.write("""Couldn't check {0} for more recent scripts: """
+                     """{1}\n""".format(stale_check, error))
+
+
+def _fetch_sha1(stale_check, etag=None):
+    """Fetch most recent sha1 and its ETag from github.
+
+    If :etag: is specified and the most recent commit has not changed
+    since then, github will respond with 304 Not Modified and (None, etag)
+    is returned. If the sha1 could not be fetched, (None, None) is
+    returned.
+    """
+    import json
+
+    try:
+        from urllib.error import HTTPError
+    except ImportError:
+        from urllib2 import HTTPError  # suppress(import-error)
+
+    if "://" not in stale_check:
+        stale_check = "http://" + stale_check
+
+    headers = {"If-None-Match": etag} if etag else dict()
+
+    try:
+        contents, info = http_client().fetch(stale_check,
+                                             headers,
+                                             retries=4,
+                                             deadline=30)
+        return (json.loads(contents.decode("utf-8"))["sha"],
+                info.get("ETag", None))
+    except HTTPError as error:
+        if error.code == 304:
+            return (None, etag)
+
+        _report_stale_check_failure(stale_check, error)
+    except _url_error() as error:
+        _report_stale_check_failure(stale_check, error)
+
+    return (None, None)
+
+
+def _load_head(cache_dir):
+    """Load the result of the last stale check from cache_dir."""
+    import json
+
+    try:
+        with open(os.path.join(cache_dir, "head.json"), "r") as head_file:
+            return json.load(head_file)
+    except (IOError, ValueError):
+        return dict()
+
+
+def _check_head(cache_dir, stale_check, head):
+    """Check for the most recent commit, revalidating :head: if possible.
+
+    The result of the check is stored in cache_dir and returned.
+    """
+    import json
+
+    sha1, etag = _fetch_sha1(stale_check, head.get("etag", None))
+
+    if not etag and not sha1:
+        return head
+
+    head = {
+        "sha": sha1 or head["sha"],
+        "etag": etag,
+        "checked": time.time()
+    }
+    _write_atomically(os.path.join(cache_dir, "head.json"),
+                      json.dumps(head).encode("utf-8"))
+    return head
+
+
+def _report_background_check(log_path):
+    """Print anything the last background stale check printed on stderr."""
+    try:
+        with open(log_path, "r") as log_file:
+            output = log_file.read()
+
+        os.remove(log_path)
+    except (IOError, OSError):
+        return
+
+    sys.stderr.write(output)
+
+
+def _detach_from_parent(keep_fd, log_path):
+    """Detach this forked process from its parent.
+
+    The process is put in its own session, so that signals sent to the
+    process group of its parent don't reach it. Its standard input and
+    output are redirected to /dev/null and its standard error to
+    log_path. Every other file descriptor apart from keep_fd is closed,
+    so that a parent shell reading the output of its parent doesn't
+    wait for it to finish.
+    """
+    os.setsid()
+
+    with open(os.devnull, "r+") as devnull:
+        os.dup2(devnull.fileno(), 0)
+        os.dup2(devnull.fileno(), 1)
+
+    with open(log_path, "w") as log_file:
+        os.dup2(log_file.fileno(), 2)
+
+    try:
+        max_fd = os.sysconf("SC_OPEN_MAX")
+    except (AttributeError, ValueError, OSError):
+        max_fd = 256
+
+    os.closerange(3, keep_fd)
+    os.closerange(keep_fd + 1, max_fd)
+
+
+def _check_head_in_background(cache_dir, stale_check, head):
+    """Check for the most recent commit in a forked child process.
+
+    The result will be used by the next invocation. Returns False if
+    the check could not be started in the background. Only one check
+    runs at a time and anything it prints, including errors, is printed
+    by the first invocation after it finishes.
+    """
+    import traceback
+
+    if not hasattr(os, "fork"):
+        return False
+
+    log_path = os.path.join(cache_dir, "head.json.log")
+    with open_and_force_mkdir(os.path.join(cache_dir, "head.json.lock"),
+                              "a") as lock_file:
+        # Another check is still running. Its result will be used
+        # once it finishes.
+        if not _try_lock_file(lock_file):
+            return True
+
+        _report_background_check(log_path)
+
+        # The child shares the lock with us, so it is held until
+        # the child exits.
+        if os.fork() != 0:
+            return True
+
+        status = 0
+        try:
+            _detach_from_parent(lock_file.fileno(), log_path)
+
+            # Connections kept alive by our parent are not ours to use.
+            del _HTTP_CLIENT[:]
+            _check_head(cache_dir, stale_check, head)
+        except Exception:  # suppress(broad-except)
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stderr.flush()
+            os._exit(status)  # suppress(protected-access)
+
+
+# suppress(too-many-arguments)
+def _current_scripts_version(scripts_root,
+                             cache_dir,
+                             stale_check,
+                             keep,
+                             ttl=0,
+                             background=False):
+    """Return the sha1 of the version of the scripts to use.
+
+    We check the sha1 of the most recent commit returned by github
+    and switch to that version of the scripts, evicting the least
+    recently used versions if there are more than :keep: of them.
+
+    The result of the check is reused for :ttl: seconds, after which
+    it is revalidated. If :background: is True, the revalidation happens
+    in the background and the previous result is used until the next
+    invocation.
+
+    If stale_check is not specified or the most recent commit could not
+    be determined, then the version of the scripts used most recently
+    is used again. If there isn't one, None is returned.
+    """
+    sha1 = None
+
+    if stale_check:
+        head = _load_head(cache_dir)
+
+        if time.time() - head.get("checked", 0) >= ttl:
+            if not (background and
+                    head.get("sha", None) and
+                    _check_head_in_background(cache_dir, stale_check, head)):
+                head = _check_head(cache_dir, stale_check, head)
+
+        sha1 = head.get("sha", None)
+
+    if sha1:
+        _use_scripts_version(scripts_root, cache_dir, sha1, keep)
+        return sha1
+
+    most_recent = (_read_lines(os.path.join(cache_dir,
+                                            "most_recent")) or [None])[0]
+    if most_recent and os.path.isdir(os.path.join(scripts_root,
+                                                  most_recent)):
+        return most_recent
+
+    return None
+
+
+_GH_STALE_CHECK = (
+    # suppress(E501)
+    "https://api.github.com/repos/polysquare/polysquare-ci-scripts/commits/HEAD"
+)
+
+_SCRIPT_VERSIONS_TO_KEEP = 3
+
+_STALE_CHECK_TTL = 600
+
+
+def _bytecode_tag():
+    """Return a tag for the bytecode format used by this interpreter."""
+    implementation = getattr(sys, "implementation", None)
+    return (getattr(implementation, "cache_tag", None) or
+            "{0}-{1}{2}".format(platform.python_implementation().lower(),
+                                *sys.version_info[:2]))
+
+
+def _source_digest(path, source):
+    """Return a digest of the script at path with contents source."""
+    import hashlib
+
+    return hashlib.sha1(path.encode("utf-8") + b"\0" + source).hexdigest()
+
+
+def _set_code_filename(code, path):
+    """Set the filename of code and the code objects nested in it to path.
+
+    Returns False if code was compiled from another path and its
+    filename cannot be changed by this interpreter.
+    """
+    if code.co_filename == path:
+        return True
+
+    try:
+        from _imp import _fix_co_filename  # suppress(import-error)
+    except ImportError:
+        return False
+
+    _fix_co_filename(code, path)
+    return True
+
+
+def _compile_cached(path, bytecode_dir, source=None):
+    """Return a code object for the script at path.
+
+    Code objects are marshalled into bytecode_dir, keyed by the contents
+    of the script and the bytecode format of this interpreter. Unlike
+    .pyc files, modification times are not used, so the cache stays
+    valid after being restored from a tarball and it is used even if
+    PYTHONDONTWRITEBYTECODE is set.
+
+    Since the path is not part of the key, a script that is the same
+    in many versions of the scripts only has one entry in the cache,
+    so entries are not left behind when a version is removed.
+
+    If :source: is passed, it is used instead of reading path.
+    """
+    import hashlib
+    import marshal
+
+    if source is None:
+        with open(path, "rb") as source_file:
+            source = source_file.read()
+
+    cached = os.path.join(bytecode_dir,
+                          "{0}.{1}".format(hashlib.sha1(source).hexdigest(),
+                                           _bytecode_tag()))
+
+    try:
+        with open(cached, "rb") as cached_file:
+            code = marshal.load(cached_file)
+    except (IOError, EOFError, ValueError, TypeError):
+        code = None
+
+    # Interpreters which cannot change the filename of a code object
+    # compile the script again, replacing the entry in the cache.
+    if code is not None and _set_code_filename(code, path):
+        return code
+
+    code = compile(source, path, "exec", dont_inherit=True)
+
+    try:
+        _write_atomically(cached, marshal.dumps(code))
+    except (IOError, OSError):  # suppress(pointless-except)
+        pass
+
+    return code
+
+
+def _is_module_for(module, path):
+    """Return True if module was loaded from the script at path."""
+    module_path = getattr(module, "__file__", None)
+    if not module_path:
+        return False
+
+    return (os.path.splitext(os.path.realpath(module_path))[0] ==
+            os.path.splitext(os.path.realpath(path))[0])
+
+
+def _import_cached(name, path, bytecode_dir):
+    """Import the script at path as module name, caching its bytecode.
+
+    If the same script was already imported as name by this process
+    and it has not changed since, that module is used again.
+    """
+    with open(path, "rb") as source_file:
+        source = source_file.read()
+
+    digest = _source_digest(path, source)
+    module = sys.modules.get(name, None)
+    if getattr(module, "__ciscripts_digest__", None) == digest:
+        return module
+
+    module = imp.new_module(name)
+    module.__file__ = path
+    module.__ciscripts_digest__ = digest
+    sys.modules[name] = module
+
+    try:
+        exec(_compile_cached(path,  # suppress(exec-used)
+                             bytecode_dir,
+                             source),
+             module.__dict__)
+    except BaseException:
+        del sys.modules[name]
+        raise
+
+    return module
+
+
+class BundleImporter(object):
+    """Import scripts from a bundle of their sources.
+
+    The bundle maps paths relative to ciscripts/ to the source of each
+    script. Scripts in the bundle are importable as submodules of
+    :package:, a package name unique to the bundle. Both the PEP 302
+    (find_module and load_module) and PEP 451 (find_spec and exec_module)
+    protocols are implemented, so this works as an entry in sys.meta_path
+    on every version of python.
+    """
+
+    def __init__(self, sources, origin, bytecode_dir):
+        """Initialize this importer for sources, which came from origin."""
+        import hashlib
+
+        super(BundleImporter, self).__init__()
+        self._sources = sources
+        self._origin = origin
+        self._bytecode_dir = bytecode_dir
+        self._packages = set([""])
+        self.package = "_ciscripts_bundle_{0}".format(
+            hashlib.sha1(origin.encode("utf-8")).hexdigest()[:12]
+        )
+
+        for path in sources:
+            components = path.split("/")[:-1]
+            for index in range(1, len(components) + 1):
+                self._packages.add("/".join(components[:index]))
+
+    @staticmethod
+    def from_zip(path, bytecode_dir):
+        """Return a BundleImporter for the zip file at path, or None."""
+        import zipfile
+
+        try:
+            with closing(zipfile.ZipFile(path)) as bundle:
+                return BundleImporter(dict([(n, bundle.read(n))
+                                            for n in bundle.namelist()
+                                            if not n.endswith("/")]),
+                                      path,
+                                      bytecode_dir)
+        except (IOError, zipfile.BadZipfile):
+            return None
+
+    def _lookup(self, fullname):
+        """Find fullname in this bundle.
+
+        Returns a tuple of the path to the source of the module in the
+        bundle (or None if it has no source) and whether or not the module
+        is a package. Returns None if the module is not in this bundle.
+        """
+        if fullname == self.package:
+            base = ""
+        elif fullname.startswith(self.package + "."):
+            base = fullname[len(self.package) + 1:].replace(".", "/")
+        else:
+            return None
+
+        if base + ".py" in self._sources:
+            return (base + ".py", False)
+
+        init = "/".join([c for c in (base, "__init__.py") if c])
+        if init in self._sources:
+            return (init, True)
+        elif base in self._packages:
+            return (None, True)
+
+        return None
+
+    def module_name(self, script_path):
+        """Return name to import script_path from this bundle as, or None."""
+        if script_path.lstrip("/") not in self._sources:
+            return None
+
+        name = os.path.splitext(script_path.lstrip("/"))[0].replace("/", ".")
+        return self.package + "." + name
+
+    # suppress(unused-argument)
+    def find_module(self, fullname, path=None):
+        """Return this importer if fullname is in the bundle."""
+        return self if self._lookup(fullname) else None
+
+    def load_module(self, fullname):
+        """Load and return the module fullname."""
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+
+        module = imp.new_module(fullname)
+        module.__loader__ = self
+        sys.modules[fullname] = module
+
+        try:
+            self.exec_module(module)
+        except BaseException:
+            del sys.modules[fullname]
+            raise
+
+        return module
+
+    # suppress(unused-argument)
+    def find_spec(self, fullname, path=None, target=None):
+        """Return a ModuleSpec for fullname if it is in the bundle."""
+        found = self._lookup(fullname)
+        if not found:
+            return None
+
+        import importlib.util  # suppress(import-error)
+
+        return importlib.util.spec_from_loader(fullname,
+                                               self,
+                                               is_package=found[1])
+
+    def create_module(self, spec):  # suppress(no-self-use)
+        """Use the default module creation semantics."""
+        del spec
+
+    def exec_module(self, module):
+        """Run the code of module from its source in the bundle."""
+        source_path, is_package = self._lookup(module.__name__)
+        module.__file__ = os.path.join(self._origin,
+                                       source_path or "__init__.py")
+
+        if is_package:
+            module.__path__ = list()
+            module.__package__ = module.__name__
+        else:
+            module.__package__ = module.__name__.rpartition(".")[0]
+
+        if source_path:
+            exec(_compile_cached(module.__file__,  # suppress(exec-used)
+                                 self._bytecode_dir,
+                                 self._sources[source_path]),
+                 module.__dict__)
+
+
+def _install_bundle_importer(importer):
+    """Add importer to sys.meta_path, unless it was added already."""
+    for finder in sys.meta_path:
+        if getattr(finder, "package", None) == importer.package:
+            return finder
+
+    sys.meta_path.insert(0, importer)
+    return importer
+
+
+class PhaseTimer(object):
+    """Record how long each phase of bootstrapping takes.
+
+    Imports of scripts are recorded separately from other phases.
+    The modules loaded and the HTTP requests made since this PhaseTimer
+    was created are also included in its report.
+    """
+
+    def __init__(self):
+        """Start timing."""
+        super(PhaseTimer, self).__init__()
+        self._started = time.time()
+        self._initial_modules = set(sys.modules.keys())
+        self._initial_http = dict(http_client().statistics)
+        self.phases = list()
+        self.imports = list()
+
+    @contextmanager
+    def phase(self, name, kind="phase"):
+        """Record how long the phase called name takes."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            record = {"name": name, "seconds": time.time() - started}
+            (self.imports if kind == "import" else self.phases).append(record)
+
+    def report(self):
+        """Return a dictionary describing where time was spent."""
+        http = dict(http_client().statistics)
+        for statistic, value in self._initial_http.items():
+            http[statistic] -= value
+
+        return {
+            "total": time.time() - self._started,
+            "phases": self.phases,
+            "imports": self.imports,
+            "modules": sorted(set(sys.modules.keys()) -
+                              self._initial_modules),
+            "http": http
+        }
+
+    @contextmanager
+    def reported_to(self, destination):
+        """Write a report to destination once this context exits.
+
+        If :destination: is "-", the report is printed on stderr,
+        otherwise it is written to the file at destination as JSON.
+        If it is None, then no report is written.
+        """
+        try:
+            yield
+        finally:
+            report = self.report()
+            if destination == "-":
+                lines = ["""Bootstrap took {0:.3f}s""".format(report["total"])]
+                lines += ["""    {0}: {1:.3f}s""".format(r["name"],
+                                                         r["seconds"])
+                          for r in report["phases"]]
+                lines += ["""    import {0}: {1:.3f}s""".format(r["name"],
+                                                                r["seconds"])
+                          for r in report["imports"]]
+                lines.append("""    {0} modules loaded"""
+                             "".format(len(report["modules"])))
+                lines.append("""    {0:.0f} HTTP requests, {1:.0f} retries, """
+                             """{2:.0f} failures, {3:.3f}s waiting"""
+                             "".format(*[report["http"].get(s, 0)
+                                         for s in ("requests",
+                                                   "retries",
+                                                   "failures",
+                                                   "seconds")]))
+                sys.stderr.write("\n".join(lines) + "\n")
+            elif destination:
+                import json
+
+                with open(destination, "w") as report_file:
+                    json.dump(report, report_file, indent=2)
+
+
+class ContainerDir(ContainerBase):
+    """A container that all scripts and other data will be stored in."""
+
+    def __init__(self,
+                 shell,
+                 directory=None,
+                 stale_check=_GH_STALE_CHECK,
+                 **kwargs):
+        """Initialize this container in the directory specified."""
+        super(ContainerDir, self).__init__(directory)
+        self._scripts_sha1 = None
+        self._scripts_version_lock = None
+        self._bundle = None
+        self._timer = kwargs.get("timer", None) or PhaseTimer()
+
+        if kwargs.get("scripts_directory"):
+            self._scripts_dir = kwargs["scripts_directory"]
+            self._force_created_scripts_dir = False
+            version = _version_in_scripts_directory(self._scripts_dir)
+            self._urlpath = _scripts_urlpath(version)
+
+            if version:
+                self._scripts_version_lock = _hold_scripts_version(
+                    os.path.dirname(os.path.realpath(self._scripts_dir)),
+                    version
+                )
+        else:
+            # First check if there's a more recent version of these scripts
+            # than the one we have stored. Each version is kept in its own
+            # directory, so that switching between versions doesn't
+            # require fetching everything again.
+            scripts_root = force_mkdir(os.path.join(self._container_dir,
+                                                    "_scripts"))
+            with self._timer.phase("stale check"):
+                self._scripts_sha1 = _current_scripts_version(
+                    scripts_root,
+                    self.named_cache_dir("scripts-updates", ephemeral=False),
+                    stale_check,
+                    kwargs.get("keep_script_versions", None) or
+                    _SCRIPT_VERSIONS_TO_KEEP,
+                    ttl=kwargs.get("stale_check_ttl", None) or 0,
+                    background=kwargs.get("background_stale_check", False)
+                )
+
+            if self._scripts_sha1:
+                self._scripts_dir = os.path.join(scripts_root,
+                                                 self._scripts_sha1)
+            else:
+                self._scripts_dir = scripts_root
+
+            self._urlpath = _scripts_urlpath(self._scripts_sha1)
+            force_mkdir(self._scripts_dir)
+
+            if self._scripts_sha1:
+                self._scripts_version_lock = _hold_scripts_version(
+                    scripts_root,
+                    self._scripts_sha1
+                )
+
+            with self._timer.phase("fetch scripts"):
+                # Fetch everything we are likely to need up front, instead
+                # of fetching scripts one by one as they get imported.
+                if kwargs.get("prefetch_scripts"):
+                    self.prefetch_scripts()
+
+                # Ensure that we have a /bootstrap.py script in our
+                # container.
+                _fetch_script(self.script_path("bootstrap.py"),
+                              "bootstrap.py",
+                              urlpath=self._urlpath)
+
+            self._force_created_scripts_dir = True
+
+        # If all the scripts are bundled together, import them from the
+        # bundle instead of from individual files.
+        if not self._bundle:
+            self._load_bundle()
+
+        sys.path = [self._scripts_dir] + sys.path
+
+        self._languages_dir = force_mkdir(os.path.join(self._container_dir,
+                                                       "_languages"))
+        self._languages_record_path = os.path.join(self._languages_dir,
+                                                   "record")
+        self._module_cache = dict()
+
+        # Create languages record file if it doesn't exist
+        if not os.path.exists(self._languages_record_path):
+            with open(self._languages_record_path, "w"):
+                pass
+
+        self._failures = 0
+        self._shell = shell
+
+    def clean(self, util):
+        """Clean this container and all sub-containers."""
+        info = namedtuple("Info", "language version")
+
+        # Having everything on one line is nice
+        #
+        # suppress(invalid-name)
+        with open(self._languages_record_path, "r") as f:
+            containers = [info(*(c.split("-"))) for c in f.read().splitlines()]
+
+        for info in containers:
+            with util.Task("""Cleaning {0} {1} """
+                           """container""".format(info.language,
+                                                  info.version)):
+                script = "setup/project/configure_{0}.py".format(info.language)
+                ver_info = defaultdict(lambda: info.version)
+                self.fetch_and_import(script).get(self,
+                                                  util,
+                                                  None,
+                                                  ver_info).clean(util)
+
+        with util.Task("""Cleaning up downloaded scripts"""):
+            if self._force_created_scripts_dir:
+                util.apply_to_files(util.force_remove_tree,
+                                    self._scripts_dir,
+                                    matching=["*.pyc"])
+
+        # Clean our own caches once we've cleaned caches from
+        # other containers, as they might be relying on our own cache.
+        super(ContainerDir, self).clean(util)
+
+    def script_path(self, relative_path):
+        """Get absolute path to script specified at relative_path.
+
+        This function first looks in the current working directory
+        for a script named by :relative_path: and if it can't find
+        it, it will look in its own internal scripts directory.
+        """
+        # First try to find the script locally in the
+        # current working directory.
+        fs_path = os.path.realpath(os.path.join(os.getcwd(), relative_path))
+
+        # Next try to find it in our scripts directory, or fetch it from
+        # the server which hosts all the scripts.
+        if not os.path.exists(fs_path):
+            fs_path = os.path.join(self._scripts_dir,
+                                   "ciscripts",
+                                   relative_path)
+            return FetchedModule(True, fs_path)
+        else:
+            return FetchedModule(False, fs_path)
+
+    # suppress(unused-function)
+    def loaded_module_name(self,
+                           script_path,
+                           domain="raw.githubusercontent.com",
+                           urlpath=_GITHUB_URLPATH):
+        """Get loaded module name for :script_path:."""
+        key = "{0}/{1}/{2}".format(domain, urlpath, script_path)
+        try:
+            return self._module_cache[key].__name__
+        except KeyError:
+            return None
+
+    def _bundle_path(self):
+        """Return path to the bundle of all scripts in the scripts dir."""
+        return os.path.join(self._scripts_dir, "ciscripts.zip")
+
+    def _load_bundle(self):
+        """Start importing scripts from the bundle, if there is one."""
+        bundle = BundleImporter.from_zip(self._bundle_path(),
+                                         self.named_cache_dir("bytecode",
+                                                              ephemeral=False))
+        if bundle:
+            self._bundle = _install_bundle_importer(bundle)
+
+    def fetch_script(self,
+                     script_path,
+                     domain="raw.githubusercontent.com",
+                     urlpath=_GITHUB_URLPATH):
+        """Wrapper for _fetch_script, returns a FetchedModule.
+
+        Scripts fetched from the default location come from the version
+        of the scripts being used.
+        """
+        if urlpath == _GITHUB_URLPATH:
+            urlpath = self._urlpath
+
+        info = self.script_path(script_path)
+        _fetch_script(info, script_path, domain, urlpath)
+        return info
+
+    def prefetch_scripts(self,
+                         script_paths=_COMMON_SCRIPTS,
+                         domain="raw.githubusercontent.com",
+                         urlpath=_GITHUB_URLPATH,
+                         **kwargs):
+        """Fetch many scripts at once, ahead of calls to fetch_and_import.
+
+        If :archive_url: is passed, or the sha1 of the most recent
+        scripts is known and they are being fetched from the default
+        location, then the entire ciscripts/ tree is unpacked from a
+        single archive. Otherwise, or if the archive could not be fetched,
+        each script in :script_paths: is fetched on one of :jobs: threads.
+        """
+        archive_url = kwargs.get("archive_url", None)
+        if (not archive_url and
+                self._scripts_sha1 and
+                domain == "raw.githubusercontent.com" and
+                urlpath == _GITHUB_URLPATH):
+            archive_url = _GITHUB_ARCHIVE.format(sha1=self._scripts_sha1)
+
+        if archive_url and _fetch_scripts_archive(self._scripts_dir,
+                                                  archive_url,
+                                                  self._bundle_path()):
+            self._load_bundle()
+            return
+
+        if urlpath == _GITHUB_URLPATH:
+            urlpath = self._urlpath
+
+        scripts = [(self.script_path(p), p) for p in script_paths]
+        _fetch_scripts_concurrently([s for s in scripts
+                                     if not os.path.exists(s[0].fs_path)],
+                                    domain,
+                                    urlpath,
+                                    kwargs.get("jobs", 8))
+
+    def _import_script(self, script_path, domain, urlpath):
+        """Import the script at script_path, fetching it if necessary."""
+        bytecode_dir = self.named_cache_dir("bytecode", ephemeral=False)
+
+        # Scripts in the current working directory take precedence over
+        # the bundle, but otherwise import the script from the bundle
+        # if it has it.
+        info = self.script_path(script_path)
+        bundled_name = (info.in_scripts_dir and
+                        self._bundle and
+                        self._bundle.module_name(script_path))
+
+        if bundled_name:
+            import importlib
+
+            return importlib.import_module(bundled_name)
+
+        # Otherwise fetch the script, if it is not available already.
+        info = self.fetch_script(script_path, domain, urlpath)
+
+        # If this script was already imported normally, use that
+        # module - this is useful for tests where we want to be able
+        # to get coverage on those files and patch them. Otherwise,
+        # import the file directly, bypassing __import__, using the
+        # bytecode cache.
+        fs_path = info.fs_path
+        name = os.path.relpath(os.path.splitext(fs_path)[0],
+                               start=self._scripts_dir)
+        name = name.replace(os.path.sep, ".")
+        module = sys.modules.get(name, None)
+
+        if info.in_scripts_dir and _is_module_for(module, fs_path):
+            return module
+
+        return _import_cached("local_module_" + re.sub(r"[\./]",
+                                                       "_",
+                                                       fs_path),
+                              fs_path,
+                              bytecode_dir)
+
+    def fetch_and_import(self,
+                         script_path,
+                         domain="raw.githubusercontent.com",
+                         urlpath=_GITHUB_URLPATH):
+        """Download a script if its not available and import it.
+
+        This downloads the script as part of the URL path as indicated by
+        script_path if it isn't already available in the specified directory.
+        """
+        key = "{0}/{1}/{2}".format(domain, urlpath, script_path)
+
+        try:
+            return self._module_cache[key]
+        except KeyError:  # suppress(pointless-except)
+            pass
+
+        with self._timer.phase(script_path, kind="import"):
+            self._module_cache[key] = self._import_script(script_path,
+                                                          domain,
+                                                          urlpath)
+
+        return self._module_cache[key]
+
+    def language_dir(self, language):
+        """Return a dir to hold installations of language."""
+        path = os.path.join(self._languages_dir, language)
+        force_mkdir(path)
+
+        return path
+
+    def note_failure(self, instant_fail):
+        """Note a failure.
+
+        If instant_fail is True, then immediately exit, also making the
+        invoking shell exit too with our current exit status.
+        """
+        self._failures += 1
+
+        if instant_fail:
+            self._shell.exit(self._failures)
+            sys.exit(self._failures)
+
+    def reset_failure_count(self):  # suppress(unused-function)
+        """Reset failure count for this container."""
+        self._failures = 0
+
+    def return_code(self):
+        """Return code of this container."""
+        return self._failures
+
+    def new_container_for(self, language, version):
+        """Return class to construct a sub-container from.
+
+        Keep a note of the language and version combination that we just
+        requested a new container for.
+        """
+        key = "{language}-{version}".format(language=language, version=version)
+        _update_set_like_file(self._languages_record_path, key)
+
+        return LanguageBase
 
 
 def escaped_printer_with_character(char, file_object=None):
@@ -830,23 +2164,372 @@ def _determine_outputs(print_to_option):
     return (print_script_to, print_messages_to)
 
 
+_DAEMON_IDLE_TIMEOUT = 600
+
+# Seconds a client of the daemon has to send its request, so that a
+# client which never finishes doesn't keep others waiting forever.
+_DAEMON_REQUEST_TIMEOUT = 10
+
+
+def _daemon_socket_path(container_dir):
+    """Return path to the socket the daemon for container_dir listens on."""
+    return os.path.join(os.path.realpath(container_dir),
+                        "_cache",
+                        "daemon.sock")
+
+
+def _daemon_supported():
+    """Return True if bootstrap can run scripts in a daemon.
+
+    The standard streams of each client are passed to the daemon over
+    a Unix socket, which requires socket.sendmsg.
+    """
+    import socket
+
+    return (platform.system() != "Windows" and
+            hasattr(socket, "AF_UNIX") and
+            hasattr(socket.socket, "sendmsg"))
+
+
+def _bootstrap_script_path():
+    """Return path to the source of this script."""
+    return os.path.splitext(os.path.realpath(__file__))[0] + ".py"
+
+
+def _python_identity():
+    """Return the executable and version of the python running us."""
+    return [sys.executable, sys.version]
+
+
+def _connect_to_daemon(socket_path):
+    """Return a socket connected to the daemon at socket_path, or None."""
+    import socket
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        return connection
+    except socket.error:
+        connection.close()
+        return None
+
+
+def _start_daemon(container_dir, socket_path, idle_timeout):
+    """Start a daemon for container_dir and return a connection to it.
+
+    Returns None if the daemon could not be started.
+    """
+    import subprocess
+
+    # The daemon may have exited without removing its socket.
+    try:
+        os.unlink(socket_path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:  # suppress(PYC90)
+            raise error
+
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen([sys.executable,
+                          _bootstrap_script_path(),
+                          "-d",
+                          container_dir,
+                          "--serve-daemon",
+                          "--daemon-idle-timeout",
+                          str(idle_timeout)],
+                         stdin=devnull,
+                         stdout=devnull,
+                         stderr=devnull,
+                         close_fds=True,
+                         preexec_fn=os.setsid)
+
+    started = time.time()
+    while time.time() - started < 10:
+        connection = _connect_to_daemon(socket_path)
+        if connection:
+            return connection
+
+        time.sleep(0.05)
+
+    return None
+
+
+def _read_message(connection):
+    """Read a newline-terminated JSON message from connection."""
+    import json
+
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = connection.recv(65536)
+        if not chunk:
+            return None
+
+        data += chunk
+
+    return json.loads(data.decode("utf-8"))
+
+
+def _send_message(connection, message):
+    """Send message as newline-terminated JSON on connection."""
+    import json
+
+    connection.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+
+def _run_in_daemon(container_dir, argv, idle_timeout=_DAEMON_IDLE_TIMEOUT):
+    """Run bootstrap with argv in the daemon for container_dir.
+
+    The daemon is started if it is not running already. Our standard
+    streams, working directory and environment are passed to the daemon,
+    which runs the script and returns its exit code. Returns None if the
+    script could not be run in the daemon, for instance because it is
+    running under another python, in which case it should be run in
+    this process instead.
+    """
+    import array
+    import socket
+
+    if not _daemon_supported():
+        return None
+
+    socket_path = _daemon_socket_path(container_dir)
+    connection = _connect_to_daemon(socket_path)
+
+    if not connection:
+        with ContainerBase(container_dir).lock("daemon"):
+            connection = (_connect_to_daemon(socket_path) or
+                          _start_daemon(container_dir,
+                                        socket_path,
+                                        idle_timeout))
+
+    if not connection:
+        return None
+
+    with closing(connection):
+        for stream in (sys.stdout, sys.stderr):
+            stream.flush()
+
+        try:
+            connection.sendmsg([b"\0"],
+                               [(socket.SOL_SOCKET,
+                                 socket.SCM_RIGHTS,
+                                 array.array("i", [0, 1, 2]))])
+            _send_message(connection, {
+                "argv": argv,
+                "cwd": os.getcwd(),
+                "env": dict(os.environ),
+                "bootstrap": _bootstrap_script_path(),
+                "python": _python_identity()
+            })
+            reply = _read_message(connection)
+        except socket.error:
+            return None
+
+    if not reply or "status" not in reply:
+        return None
+
+    return reply["status"]
+
+
+def _receive_streams(connection):
+    """Receive the standard stream descriptors of a client."""
+    import array
+    import socket
+
+    descriptors = array.array("i")
+    _, ancillary, _, _ = connection.recvmsg(1, socket.CMSG_LEN(3 *
+                                                               descriptors
+                                                               .itemsize))
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            descriptors.frombytes(data[:len(data) - (len(data) %
+                                                     descriptors.itemsize)])
+
+    return list(descriptors)
+
+
+@contextmanager
+def _client_process_state(streams, request):
+    """Take on the streams, directory and environment of a client."""
+    saved_streams = [os.dup(fd) for fd in (0, 1, 2)]
+    saved_cwd = os.getcwd()
+    saved_environ = dict(os.environ)
+    saved_path = list(sys.path)
+
+    for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+
+    for fd, client_fd in enumerate(streams):
+        os.dup2(client_fd, fd)
+
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        yield
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            stream.flush()
+
+        for fd, saved_fd in enumerate(saved_streams):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+        for client_fd in streams:
+            os.close(client_fd)
+
+        sys.path = saved_path
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+
+
+def _forget_loaded_scripts():
+    """Remove scripts imported while handling a request from sys.modules.
+
+    The next request imports them again from the bytecode cache, so that
+    state kept by scripts, such as the results of completed tasks or
+    containers holding the parent shell of an earlier client, isn't
+    shared between clients with different directories and environments.
+    """
+    for name in list(sys.modules.keys()):
+        if name.startswith(("local_module_", "_ciscripts_bundle_")):
+            del sys.modules[name]
+
+
+def _reply_to_client(connection, message):
+    """Send message to the client on connection, unless it has gone away."""
+    import socket
+
+    try:
+        _send_message(connection, message)
+    except socket.error:  # suppress(pointless-except)
+        pass
+
+
+def _handle_daemon_request(connection):
+    """Run the script requested by the client on connection.
+
+    Returns False if the daemon should stop, because the client is using
+    a different bootstrap script. Clients running under a different
+    python are turned away, so that they run the script themselves.
+    """
+    import socket
+    import traceback
+
+    connection.settimeout(_DAEMON_REQUEST_TIMEOUT)
+
+    streams = list()
+
+    try:
+        streams = _receive_streams(connection)
+        request = _read_message(connection)
+    except (socket.error, ValueError):
+        # The client gave up, or never finished sending its request,
+        # so carry on with the next one.
+        for client_fd in streams:
+            os.close(client_fd)
+
+        return True
+
+    connection.settimeout(None)
+
+    if (len(streams) != 3 or
+            not request or
+            request.get("bootstrap") != _bootstrap_script_path()):
+        for client_fd in streams:
+            os.close(client_fd)
+
+        _reply_to_client(connection, {"restart": True})
+        return False
+
+    if request.get("python") != _python_identity():
+        for client_fd in streams:
+            os.close(client_fd)
+
+        _reply_to_client(connection, {"rejected": True})
+        return True
+
+    with _client_process_state(streams, request):
+        try:
+            status = main(request["argv"], in_daemon=True)
+        except SystemExit as exit_status:
+            status = exit_status.code
+        except Exception:  # suppress(broad-except)
+            traceback.print_exc()
+            status = 1
+        finally:
+            _forget_loaded_scripts()
+
+    if not isinstance(status, int):
+        status = 0 if status is None else 1
+
+    _reply_to_client(connection, {"status": status})
+    return True
+
+
+def _serve_daemon(container_dir, idle_timeout):
+    """Run scripts for clients of the daemon for container_dir.
+
+    Requests are handled one at a time, in this process, so that the
+    modules imported by scripts and their bytecode are kept between them.
+    Scripts themselves are imported again for each request.
+    The daemon exits once it has been idle for idle_timeout seconds.
+    """
+    import socket
+
+    socket_path = _daemon_socket_path(container_dir)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        os.unlink(socket_path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:  # suppress(PYC90)
+            raise error
+
+    force_mkdir(os.path.dirname(socket_path))
+    server.bind(socket_path)
+    server.listen(16)
+    server.settimeout(idle_timeout)
+
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                return 0
+
+            with closing(connection):
+                if not _handle_daemon_request(connection):
+                    return 0
+    finally:
+        server.close()
+
+        try:
+            os.unlink(socket_path)
+        except OSError:  # suppress(pointless-except)
+            pass
+
+
 # suppress(too-many-arguments)
 def _define_script_command(command_name,
                            parent_shell,
                            bootstrap_script,
                            container_path,
                            scripts_path,
-                           script):
+                           script,
+                           daemon=False):
     """Define a shortcut to run a CI script in the parent shell."""
     script_fragment = "\"{}\"".format(script) if script else ""
     parent_shell.define_command(command_name,
                                 "python \"{bootstrap}\" "
                                 "-d \"{container}\" "
                                 "-r \"{scripts}\" "
+                                "{daemon}"
                                 "-s {script}"
                                 "".format(bootstrap=bootstrap_script,
                                           container=container_path,
                                           scripts=scripts_path,
+                                          daemon="--daemon " if daemon else "",
                                           script=script_fragment))
 
 
@@ -858,7 +2541,7 @@ def _stale_check_url(args):
     return None
 
 
-def main(argv):
+def main(argv, in_daemon=False):
     """Create or use an existing container and run a script.
 
     If -e is passed, then output which is capable of being executed
@@ -872,7 +2555,16 @@ def main(argv):
     representing a created ContainerDir, a handle to the utilities library
     and an object representing the parent shell, where environment
     variables can be exported and other shell scripts be evaluated.
+
+    If --daemon is passed, then the commands defined in the parent shell
+    run their scripts in a daemon, started by the first of them, which
+    keeps imported modules and compiled scripts around between commands.
+
+    If --timings is passed, then a report of how long each phase took and
+    how many HTTP requests were made is printed on stderr once the script
+    has run, or written as JSON to the file passed to it.
     """
+    timer = PhaseTimer()
     parser = argparse.ArgumentParser(description="""Bootstrap CI Scripts""")
     parser.add_argument("-d", "--directory",
                         type=str,
@@ -899,19 +2591,73 @@ def main(argv):
     parser.add_argument("--keep-scripts",
                         action="store_true",
                         help="""Don't remove stale scripts.""")
-    args, remainder = parser.parse_known_args(argv)
+    parser.add_argument("--keep-script-versions",
+                        type=int,
+                        default=_SCRIPT_VERSIONS_TO_KEEP,
+                        help=("""Number of versions of the scripts to """
+                              """keep in the container"""))
+    parser.add_argument("--stale-check-ttl",
+                        type=int,
+                        default=_STALE_CHECK_TTL,
+                        help=("""Seconds to wait before checking for """
+                              """more recent scripts again"""))
+    parser.add_argument("--background-stale-check",
+                        action="store_true",
+                        help=("""Check for more recent scripts in the """
+                              """background, using them next time."""))
+    parser.add_argument("--prefetch-scripts",
+                        action="store_true",
+                        help=("""Fetch all scripts up front instead """
+                              """of as they are needed."""))
+    parser.add_argument("--daemon",
+                        action="store_true",
+                        help=("""Run scripts in a long-lived daemon """
+                              """for this container, where possible."""))
+    parser.add_argument("--daemon-idle-timeout",
+                        type=int,
+                        default=_DAEMON_IDLE_TIMEOUT,
+                        help=("""Seconds after which an idle daemon """
+                              """exits"""))
+    parser.add_argument("--serve-daemon",
+                        action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--timings",
+                        type=str,
+                        nargs="?",
+                        const="-",
+                        metavar="FILE",
+                        help=("""Report how long each phase took on """
+                              """stderr, or as JSON to FILE"""))
+
+    with timer.phase("parse arguments"):
+        args, remainder = parser.parse_known_args(argv)
+
+    if args.serve_daemon:
+        return _serve_daemon(args.directory, args.daemon_idle_timeout)
+
+    # Only commands defined in the parent shell, which run scripts
+    # that are already stored in the container, can use the daemon.
+    if args.daemon and args.scripts_directory and not in_daemon:
+        status = _run_in_daemon(args.directory,
+                                argv,
+                                args.daemon_idle_timeout)
+        if status is not None:
+            return status
 
     print_script_to, print_messages_to = _determine_outputs(args.print_to)
 
-    with closing(print_script_to):
+    with closing(print_script_to), timer.reported_to(args.timings):
         parent_shell = construct_parent_shell(args.eval_output,
                                               print_script_to)
         container = ContainerDir(parent_shell,
                                  stale_check=_stale_check_url(args),
+                                 timer=timer,
                                  **(vars(args)))
         util = container.fetch_and_import("util.py")
         # suppress(unused-attribute)
         util.PRINT_MESSAGES_TO = print_messages_to
+        # suppress(unused-attribute)
+        util.HTTP_CLIENT = http_client()
         bootstrap_script = container.script_path("bootstrap.py").fs_path
         bootstrap_script_components = bootstrap_script.split(os.path.sep)
         scripts_path = os.path.sep.join(bootstrap_script_components[:-2])
@@ -928,19 +2674,20 @@ def main(argv):
                                bootstrap_script,
                                container.path(),
                                scripts_path,
-                               None)
+                               None,
+                               daemon=args.daemon)
         _define_script_command("polysquare_cleanup",
                                parent_shell,
                                bootstrap_script,
                                container.path(),
                                scripts_path,
-                               "clean.py")
+                               "clean.py",
+                               daemon=args.daemon)
 
         # Done, pass control to the script we're to run
-        container.fetch_and_import(args.script).run(container,
-                                                    util,
-                                                    parent_shell,
-                                                    argv=remainder)
+        script = container.fetch_and_import(args.script)
+        with timer.phase("run " + args.script):
+            script.run(container, util, parent_shell, argv=remainder)
 
         # Print a final new line so that active messages don't get
         # truncated.
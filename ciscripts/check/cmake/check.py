@@ -45,7 +45,7 @@ def _get_python_container(cont, util, shell):
                                                     py_ver)
 
 
-def _run_style_guide_lint(cont, util, lint_exclude, no_mdl):
+def _run_style_guide_lint(cont, util, lint_exclude, no_mdl, from_git):
     """Run /ciscripts/check/project/lint.py on this cmake project."""
     supps = [
         r"\bNOLINT[^\s]*\b",
@@ -72,20 +72,24 @@ def _run_style_guide_lint(cont, util, lint_exclude, no_mdl):
                                                            "CMakeLists.txt"
                                                        ],
                                                        exclusions=excl,
-                                                       block_regexps=supps)
+                                                       block_regexps=supps,
+                                                       files_from_git=from_git)
 
 
-def _lint_cmake_files(cont, util, namespace, exclusions):
+def _lint_cmake_files(cont, util, namespace, exclusions, from_git):
     """Run cmake specific linters on specified files."""
-    files_to_lint = util.apply_to_files(lambda x: x,
-                                        os.getcwd(),
-                                        matching=[
-                                            "*CMakeLists.txt",
-                                            "*.cmake",
-                                        ],
-                                        not_matching=[
-                                            os.path.join(cont.path(), "*"),
-                                        ] + exclusions)
+    with util.directory_index(cont):
+        files_to_lint = util.apply_to_files(lambda x: x,
+                                            os.getcwd(),
+                                            matching=[
+                                                "*CMakeLists.txt",
+                                                "*.cmake",
+                                            ],
+                                            not_matching=[
+                                                os.path.join(cont.path(),
+                                                             "*"),
+                                            ] + exclusions,
+                                            from_git=from_git)
 
     if len(files_to_lint):
         polysquare_linter_args = files_to_lint + [
@@ -97,23 +101,24 @@ def _lint_cmake_files(cont, util, namespace, exclusions):
             polysquare_linter_args.extend(["--namespace", namespace])
 
         with _get_python_container(cont, util, None).activated(util):
-            util.execute(cont,
-                         util.output_on_fail,
-                         "polysquare-cmake-linter",
-                         *polysquare_linter_args)
-
-            # Set HOME to the user's actual base directory, since
-            # cmakelint depends on it
-            util.execute(cont,
-                         util.output_on_fail,
-                         "cmakelint",
-                         "--filter=-whitespace/extra,"
-                         "-whitespace/indent,"
-                         "-package/consistency",
-                         *files_to_lint,
-                         env={
-                             "HOME": os.path.expanduser("~")
-                         })
+            util.execute_many([
+                util.command(cont,
+                             util.output_on_fail,
+                             "polysquare-cmake-linter",
+                             *polysquare_linter_args),
+                # Set HOME to the user's actual base directory, since
+                # cmakelint depends on it
+                util.command(cont,
+                             util.output_on_fail,
+                             "cmakelint",
+                             "--filter=-whitespace/extra,"
+                             "-whitespace/indent,"
+                             "-package/consistency",
+                             *files_to_lint,
+                             env={
+                                 "HOME": os.path.expanduser("~")
+                             })
+            ])
 
 
 def _generator_cache_is_stale(build_dir, generator):
@@ -213,6 +218,10 @@ def _parse_args(kind, argv):
                         nargs="*",
                         type=str,
                         help="""Patterns of files to exclude from linting""")
+    parser.add_argument("--lint-files-from-git",
+                        help="""Only lint files known to git, or """
+                             """untracked files which are not ignored""",
+                        action="store_true")
     parser.add_argument("--no-mdl",
                         help="""Don't run markdownlint""",
                         action="store_true")
@@ -434,13 +443,15 @@ def check_cmake_like_project(cont,
         _run_style_guide_lint(cont,
                               util,
                               result.lint_exclude or list(),
-                              result.no_mdl)
+                              result.no_mdl,
+                              result.lint_files_from_git)
 
     with util.Task("""Linting {} project""".format(kind)):
         _lint_cmake_files(cont,
                           util,
                           result.cmake_namespace,
-                          result.lint_exclude or list())
+                          result.lint_exclude or list(),
+                          result.lint_files_from_git)
 
     build_dir = cont.named_cache_dir("cmake-build", ephemeral=True)
     proj_dir = os.getcwd()
@@ -531,12 +542,14 @@ def run(cont, util, shell, argv=None):
         del cont
 
         with util.Task("""Preliminary cleanup of cmake project"""):
-            util.apply_to_files(reset_mtime,
-                                build,
-                                matching=NO_CACHE_FILE_PATTERNS)
-            util.apply_to_files(util.force_remove_tree,
-                                build,
-                                matching=REMOVE_FILE_PATTERNS)
+            # Files which are removed don't need their modification
+            # times reset, so check for them first.
+            util.apply_rules(build,
+                             file_rules=[
+                                 (REMOVE_FILE_PATTERNS,
+                                  util.force_remove_tree),
+                                 (NO_CACHE_FILE_PATTERNS, reset_mtime)
+                             ])
 
     check_cmake_like_project(cont,
                              util,
@@ -60,7 +60,7 @@ def run(cont, util, shell, argv=None, override_kwargs=None):
 
     def _after_lint(cont, os_cont, util):
         """Perform conan specific setup."""
-        with py_cont.activated(util), conan_cont.activated(util):
+        with util.activated(py_cont, conan_cont):
             with util.Task("""Downloading dependencies"""):
                 os_cont.execute(cont,
                                 util.running_output,
@@ -95,7 +95,7 @@ def run(cont, util, shell, argv=None, override_kwargs=None):
                 raise error
 
         with util.in_dir(build_dir):
-            with py_cont.activated(util), rb_cont.activated(util):
+            with util.activated(py_cont, rb_cont):
                 yield build_dir
 
     kwargs = {
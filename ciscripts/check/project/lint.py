@@ -36,7 +36,8 @@ def run(cont,  # suppress(too-many-arguments)
         extensions=None,
         directories=None,
         exclusions=None,
-        block_regexps=None):
+        block_regexps=None,
+        files_from_git=False):
     """Run the style guide linters on this project.
 
     By default, polysquare-generic-file-linter will not be run on anything. To
@@ -51,6 +52,9 @@ def run(cont,  # suppress(too-many-arguments)
 
     To exclude certain expressions from being considered by the spellchecker,
     pass them to :block_regexps:
+
+    To only lint files known to git, or untracked files which are not
+    ignored, pass :files_from_git:.
     """
     del argv
 
@@ -101,7 +105,8 @@ def run(cont,  # suppress(too-many-arguments)
             files_to_lint = util.apply_to_files(lambda x: x,
                                                 directory,
                                                 matching,
-                                                not_matching)
+                                                not_matching,
+                                                from_git=files_from_git)
 
             if len(files_to_lint):
                 lint("polysquare-generic-file-linter",
@@ -129,7 +134,8 @@ def run(cont,  # suppress(too-many-arguments)
             files_to_lint = util.apply_to_files(lambda p: p,
                                                 directory,
                                                 matching,
-                                                not_matching)
+                                                not_matching,
+                                                from_git=files_from_git)
 
             if len(files_to_lint) > 0:
                 lint("spellcheck-linter",
@@ -150,16 +156,17 @@ def run(cont,  # suppress(too-many-arguments)
                             lint("mdl", markdown_file)
 
     with _get_python_container(cont, util, shell).activated(util):
-        with util.Task("""Checking files using polysquare style guide """
-                       """linter"""):
-            run_linters_on_code_files(extensions,
-                                      exclusions,
-                                      directories,
-                                      block_regexps)
-
-        with util.Task("""Checking markdown documentation"""):
-            # We don't want to treat code files as documentation, so
-            # implicitly exclude checked code files
-            run_linters_on_markdown_files(extensions + exclusions,
+        with util.directory_index(cont):
+            with util.Task("""Checking files using polysquare style guide """
+                           """linter"""):
+                run_linters_on_code_files(extensions,
+                                          exclusions,
                                           directories,
-                                          no_mdl)
+                                          block_regexps)
+
+            with util.Task("""Checking markdown documentation"""):
+                # We don't want to treat code files as documentation, so
+                # implicitly exclude checked code files
+                run_linters_on_markdown_files(extensions + exclusions,
+                                              directories,
+                                              no_mdl)
@@ -60,15 +60,47 @@ def get_python_version(util, precision):  # suppress(unused-function)
     return _get_python_version_from_specified(version_string, precision)
 
 
-def discover_pythons():
+def _path_fingerprint(util):
+    """Return a fingerprint of PATH and the contents of its directories.
+
+    Adding or removing a file in a directory changes its modification
+    time, so this changes whenever a python might have been installed
+    or removed.
+    """
+    def modification_time(directory):
+        """Return modification time of directory, or None."""
+        try:
+            return os.stat(directory).st_mtime
+        except OSError:
+            return None
+
+    return util.task_fingerprint(env=("PATH", ),
+                                 values=[modification_time(d) for d in
+                                         os.environ.get("PATH",
+                                                        "").split(os.pathsep)])
+
+
+def discover_pythons(container=None, util=None):
     """Search PATH for python installations and return as dictionary.
 
     Each key is a python version and the value corresponds to the location
     of that python installation on disk.
+
+    If :container: and :util: are passed, the result is kept in the
+    container until PATH or the contents of its directories change.
     """
     if len(_KNOWN_PYTHON_INSTALLATIONS.keys()):
         return _KNOWN_PYTHON_INSTALLATIONS
 
+    if container and util:
+        fingerprint = _path_fingerprint(util)
+        result = util.already_completed("_POLYSQUARE_DISCOVERED_PYTHONS",
+                                        container,
+                                        fingerprint)
+        if result is not util.NOT_YET_COMPLETED:
+            _KNOWN_PYTHON_INSTALLATIONS.update(result)
+            return _KNOWN_PYTHON_INSTALLATIONS
+
     for path_component in os.environ.get("PATH", "").split(os.pathsep):
         try:
             dir_contents = os.listdir(path_component)
@@ -99,6 +131,12 @@ def discover_pythons():
             if not python_is_pypy(version_string)
         })
 
+    if container and util:
+        util.register_result("_POLYSQUARE_DISCOVERED_PYTHONS",
+                             _KNOWN_PYTHON_INSTALLATIONS,
+                             container,
+                             fingerprint)
+
     return _KNOWN_PYTHON_INSTALLATIONS
 
 
@@ -333,15 +371,58 @@ def _dependencies_to_update(container, py_path, installed, target):
     return _packages_to_install(installed, requested)
 
 
+def _pip_install_deps_task(util, active_python, target, args, kwargs):
+    """Return name and fingerprint of task installing dependencies.
+
+    The dependencies depend on /setup.py and /requirements.txt, as well
+    as the python they are being installed for, any other packages
+    requested and the options they are installed with.
+    """
+    name = "_POLYSQUARE_PIP_INSTALL_DEPS_{0}_{1}".format(target,
+                                                          active_python)
+    options = sorted("{0}={1}".format(k, v) for k, v in kwargs.items())
+    return (name,
+            util.task_fingerprint(files=[os.path.join(os.getcwd(), f)
+                                         for f in ("setup.py",
+                                                   "requirements.txt")],
+                                  values=[target] + sorted(args) + options))
+
+
+def _is_in_container(cont, path):
+    """Return True if path is inside the directory for cont."""
+    container_path = os.path.normcase(os.path.realpath(cont.path()))
+    return os.path.normcase(os.path.realpath(path)).startswith(
+        os.path.join(container_path, "")
+    )
+
+
 def pip_install_deps(cont, util, target, *args, **kwargs):
     """Install dependencies using pip.
 
     Dependencies are not installed if we've already got them installed. We
-    use a shortcut method to determine that.
+    use a shortcut method to determine that. If they were installed by
+    an earlier invocation and /setup.py and /requirements.txt haven't
+    changed since, then we don't check again. That is only remembered
+    between invocations for a python inside the container, since the
+    packages installed for any other python are not kept with it.
     """
+    active_python = util.which("python")
+    task, fingerprint = _pip_install_deps_task(util,
+                                               active_python,
+                                               target,
+                                               args,
+                                               kwargs)
+    persist_in = None
+    if active_python and _is_in_container(cont, active_python):
+        persist_in = cont
+
+    if util.already_completed(task,
+                              persist_in,
+                              fingerprint) is not util.NOT_YET_COMPLETED:
+        return
+
     _upgrade_pip(cont, util)
 
-    active_python = util.which("python")
     initially_installed_packages = _PACKAGES_FOR_PYTHON[active_python]
 
     to_install = _dependencies_to_update(cont,
@@ -358,3 +439,5 @@ def pip_install_deps(cont, util, target, *args, **kwargs):
 
     if len([p for p in to_install if not p.startswith("-")]):
         _pip_install_internal(cont, util, active_python, **pip_install_kwargs)
+
+    util.register_result(task, True, persist_in, fingerprint)
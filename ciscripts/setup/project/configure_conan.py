@@ -80,7 +80,7 @@ def run(container, util, shell, ver_info, os_cont=None):
     py_cont = _setup_python(container, util, shell)
 
     with util.Task("""Installing conan"""):
-        with py_cont.activated(util):
+        with container.lock("conan"), py_cont.activated(util):
             util.execute(container,
                          util.long_running_suppressed_output(),
                          "pip",
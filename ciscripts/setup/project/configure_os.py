@@ -311,7 +311,9 @@ def run(container,
                    distro_arch=distro_arch)
 
     with util.Task("""Configuring operating system container"""):
-        os_cont = install(distro, distro_version, distro_arch)
+        with container.lock("os-" + subdirectory_name):
+            os_cont = install(distro, distro_version, distro_arch)
+
         util.register_result("_POLYSQUARE_CONFIGURE_OS_" + subdirectory_name,
                              os_cont)
         return os_cont
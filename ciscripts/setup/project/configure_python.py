@@ -14,19 +14,13 @@ import os.path
 
 import platform
 
-import shutil
-
-import tarfile
-
 from collections import defaultdict
 
-from contextlib import closing
 
-
-def _usable_preinstalled_python(container, version):
+def _usable_preinstalled_python(container, util, version):
     """Return any pre-installed python matching version that we can use."""
     py_util = container.fetch_and_import("python_util.py")
-    preinstalled_pythons = py_util.discover_pythons()
+    preinstalled_pythons = py_util.discover_pythons(container, util)
     requested_components = version.count(".") + 1
 
     for candidate_version, candidate_path in preinstalled_pythons.items():
@@ -111,25 +105,6 @@ def get(container, util, shell, ver_info):
 
             py_path = self._installation
 
-            util_mod.apply_to_files(self.delete, py_path, matching=["*.a"])
-
-            util_mod.apply_to_files(self.delete, py_path, matching=["*.pyc"])
-            util_mod.apply_to_files(self.delete, py_path, matching=["*.pyo"])
-            util_mod.apply_to_files(self.delete, py_path, matching=["*.chm"])
-            util_mod.apply_to_files(self.delete, py_path, matching=["*.html"])
-            util_mod.apply_to_files(self.delete, py_path, matching=["*.pyo"])
-            util_mod.apply_to_files(self.delete, py_path, matching=["*.whl"])
-            util_mod.apply_to_files(self.delete,
-                                    py_path,
-                                    matching=["*.egg-link"])
-
-            util_mod.apply_to_directories(util_mod.force_remove_tree,
-                                          py_path,
-                                          matching=["*/test/*"])
-            util_mod.apply_to_directories(util_mod.force_remove_tree,
-                                          py_path,
-                                          matching=["*/tcl/*"])
-
             def reset_mtime(path):
                 """Reset modification time of file at path to 1.
 
@@ -150,15 +125,26 @@ def get(container, util, shell, ver_info):
                 if error.errno == errno.EEXIST:
                     pass
 
-            util_mod.apply_to_files(reset_mtime,
-                                    pkg_path,
-                                    matching=["*.pth"])
-            util_mod.apply_to_files(reset_mtime,
-                                    os.path.join(py_path, "bin"),
-                                    matching=["*"])
-            util_mod.apply_to_files(reset_mtime,
-                                    os.path.join(py_path, "Scripts"),
-                                    matching=["*"])
+            # Walk the installation once, deleting cruft before resetting
+            # the modification times of anything left over.
+            util_mod.apply_rules(py_path,
+                                 file_rules=[
+                                     (["*.a",
+                                       "*.pyc",
+                                       "*.pyo",
+                                       "*.chm",
+                                       "*.html",
+                                       "*.whl",
+                                       "*.egg-link"], self.delete),
+                                     ([os.path.join(pkg_path, "*.pth"),
+                                       os.path.join(py_path, "bin", "*"),
+                                       os.path.join(py_path, "Scripts", "*")],
+                                      reset_mtime)
+                                 ],
+                                 directory_rules=[
+                                     (["*/test/*", "*/tcl/*"],
+                                      util_mod.force_remove_tree)
+                                 ])
 
         def _active_environment(self, tuple_type):
             """Return active environment for python container."""
@@ -244,15 +230,12 @@ def windows_installer(lang_dir, python_build_dir, util, container, shell):
         if not os.path.exists(python_version_container):
             url = ("https://www.python.org/ftp/python/{ver}/"
                    "python-{ver}.msi").format(ver=version)
-            with open(os.path.join(python_build_dir,
-                                   version + "-install.exe"),
-                      "wb") as installer:
-                remote = util.url_opener()(url.format(ver=version))
-                with closing(remote):
-                    installer.write(remote.read())
+            installer = util.download(url,
+                                      os.path.join(python_build_dir,
+                                                   version + "-install.exe"))
 
             with util.Task("""Installing python version """ + version):
-                installer = os.path.realpath(installer.name)
+                installer = os.path.realpath(installer)
                 util.execute(container,
                              util.long_running_suppressed_output(),
                              "msiexec",
@@ -274,22 +257,10 @@ def _virtualenv_script(container, util):
     virtualenv_install = os.path.join(python_venv, "virtualenv.py")
     remote_url = "http://github.com/pypa/virtualenv/tarball/15.0.1"
     if not os.path.exists(virtualenv_install):
-        with container.in_temp_cache_dir() as cache_dir:
-            with util.in_dir(cache_dir):
-                local_name = os.path.join(cache_dir,
-                                          os.path.basename(remote_url))
-                with open(local_name, "wb") as local_file:
-                    remote = util.url_opener()(remote_url)
-                    with closing(remote):
-                        local_file.write(remote.read())
-
-                with tarfile.open(local_name) as local_tar:
-                    local_tar.extractall()
-
-                directory_name = [d for d in os.listdir(".")
-                                  if os.path.basename(remote_url) not in d][0]
-                shutil.rmtree(python_venv)
-                shutil.copytree(directory_name, python_venv)
+        # The tarball has a single directory named after the commit.
+        util.download_and_extract(remote_url,
+                                  python_venv,
+                                  strip_components=1)
 
     return virtualenv_install
 
@@ -360,6 +331,7 @@ def run(container, util, shell, ver_info):
     lang_dir = container.language_dir("python")
     python_build_dir = os.path.join(lang_dir, "build")
     usable = _usable_preinstalled_python(container,
+                                         util,
                                          ".".join(version.split(".")[:2]))
 
     if usable:
@@ -372,11 +344,15 @@ def run(container, util, shell, ver_info):
         installer = windows_installer
 
     with util.Task("""Configuring python"""):
-        python_container = installer(lang_dir,
-                                     python_build_dir,
-                                     util,
-                                     container,
-                                     shell)(version)
+        # Other processes sharing this container may be installing this
+        # version of python too, wait for them to finish and then use
+        # their installation.
+        with container.lock("python-" + version):
+            python_container = installer(lang_dir,
+                                         python_build_dir,
+                                         util,
+                                         container,
+                                         shell)(version)
 
         util.register_result("_POLYSQUARE_CONFIGURE_PY_" + version,
                              python_container)
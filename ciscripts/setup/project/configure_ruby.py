@@ -16,8 +16,6 @@ import platform
 
 from collections import defaultdict, namedtuple
 
-from contextlib import closing
-
 GemDirs = namedtuple("GemDirs", "system site home")
 
 
@@ -78,17 +76,14 @@ def get(container, util, shell, ver_info):
 
             rb_path = self._installation
 
-            util_mod.apply_to_files(self.delete, rb_path, matching=["*.a"])
-            util_mod.apply_to_files(self.delete, rb_path, matching=["*.chm"])
-            util_mod.apply_to_files(self.delete, rb_path, matching=["*.pdf"])
-            util_mod.apply_to_files(self.delete, rb_path, matching=["*.html"])
-
-            util_mod.apply_to_files(self.delete,
-                                    rb_path,
-                                    matching=["*unins000.exe"])
             util_mod.apply_to_files(self.delete,
                                     rb_path,
-                                    matching=["*unins000.dat"])
+                                    matching=["*.a",
+                                              "*.chm",
+                                              "*.pdf",
+                                              "*.html",
+                                              "*unins000.exe",
+                                              "*unins000.dat"])
 
         @staticmethod
         def _get_gem_dirs(user_installation, system_installation, version):
@@ -261,14 +256,12 @@ def windows_ruby_installer(lang_dir, ruby_build_dir, container, util, shell):
         if not os.path.exists(ruby_version_container):
             url = ("http://dl.bintray.com/oneclick/rubyinstaller/"
                    "rubyinstaller-{ver}.exe").format(ver=version)
-            with open(os.path.join(ruby_build_dir,
-                                   version + "-install.exe"),
-                      "wb") as installer:
-                with closing(util.url_opener()(url)) as remote:
-                    installer.write(remote.read())
+            installer = util.download(url,
+                                      os.path.join(ruby_build_dir,
+                                                   version + "-install.exe"))
 
             with util.Task("""Installing ruby version """ + version):
-                installer = os.path.realpath(installer.name)
+                installer = os.path.realpath(installer)
                 util.execute(container,
                              util.long_running_suppressed_output(),
                              installer,
@@ -365,11 +358,15 @@ def run(container, util, shell, ver_info):
         elif platform.system() == "Windows":
             ruby_installer = windows_ruby_installer
 
-        ruby_container = ruby_installer(lang_dir,
-                                        ruby_build_dir,
-                                        container,
-                                        util,
-                                        shell)(version)
+        # Other processes sharing this container may be installing this
+        # version of ruby too, wait for them to finish and then use
+        # their installation.
+        with container.lock("ruby-" + version):
+            ruby_container = ruby_installer(lang_dir,
+                                            ruby_build_dir,
+                                            container,
+                                            util,
+                                            shell)(version)
 
         util.register_result("_POLYSQUARE_CONFIGURE_RB_" + version,
                              ruby_container)
@@ -5,16 +5,24 @@
 # See /LICENCE.md for Copyright information
 """General utility functions which are made available to all other scripts."""
 
+import codecs
+
 import errno
 
 import fnmatch
 
 import hashlib
 
+import math
+
 import os
 
 import platform
 
+import re
+
+import select
+
 import shutil
 
 import stat
@@ -27,9 +35,11 @@ import tempfile
 
 import threading
 
-from collections import defaultdict
+import time
 
-from contextlib import contextmanager
+from collections import defaultdict, namedtuple
+
+from contextlib import closing, contextmanager
 
 try:
     from Queue import Queue, Empty
@@ -37,6 +47,11 @@ except ImportError:
     # suppress(F811,E301,E101,F401,import-error,unused-import)
     from queue import Queue, Empty
 
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
 
 _PREFERRED_VERSIONS = {
     "python2": defaultdict(lambda: "2.7.9",
@@ -66,22 +81,28 @@ def override_preferred_version(language, platform, version):
 
 
 PRINT_MESSAGES_TO = None
+HTTP_CLIENT = None
 
 
-def _write_log_safe(message):
+def _write_log_safe(message, flush=True):
     r"""Detect if writing to a file and replace \r with \n ."""
     fileobj = PRINT_MESSAGES_TO if PRINT_MESSAGES_TO else sys.stderr
     if not getattr(fileobj, "isatty", lambda: False)():
         message = message.replace("\r", "")
 
     fileobj.write(message)
-    fileobj.flush()
+    if flush:
+        fileobj.flush()
 
 
-def print_message(message):
-    """Print to PRINT_MESSAGES_TO."""
+def print_message(message, flush=True):
+    """Print to PRINT_MESSAGES_TO.
+
+    Pass :flush: as False if more output is about to follow.
+    """
     _write_log_safe(message.encode(sys.getdefaultencoding(),
-                                   "replace").decode("utf-8"))
+                                   "replace").decode("utf-8"),
+                    flush)
 
 
 _COMPLETED_TASKS = dict()
@@ -89,30 +110,115 @@ NOT_YET_COMPLETED = object()
 _NO_TASK_CACHING = False
 
 
-def already_completed(name):
+def task_fingerprint(files=(), env=(), values=()):
+    """Return a fingerprint of the inputs to a task.
+
+    The fingerprint covers the contents of each of :files:, the value of
+    each environment variable named in :env: and each of :values:. Pass
+    it to already_completed and register_result to keep the result of a
+    task for as long as its inputs stay the same.
+    """
+    digest = hashlib.sha1()
+
+    for path in files:
+        digest.update(path.encode("utf-8") + b"\0")
+        try:
+            with open(path, "rb") as input_file:
+                digest.update(input_file.read())
+        except IOError:
+            digest.update(b"\0missing")
+
+    for key in env:
+        value = os.environ.get(key, "")
+        digest.update(u"{0}={1}\0".format(key, value).encode("utf-8"))
+
+    for value in values:
+        digest.update(u"{0}\0".format(value).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def _task_result_path(container, name):
+    """Return path to the file storing the result of task name."""
+    return os.path.join(container.named_cache_dir("task-results",
+                                                  ephemeral=False),
+                        re.sub(r"[^A-Za-z0-9_.-]", "_", name) + ".json")
+
+
+def already_completed(name, container=None, fingerprint=None):
     """Return stored value if task with name has been completed.
 
     Otherwise return NOT_YET_COMPLETED. This allows us to return None.
+
+    If :container: and :fingerprint: are passed, the result is also looked
+    for in the container, where it was stored by an earlier invocation.
+    It is only returned if the inputs to the task had the same fingerprint.
     """
     if _NO_TASK_CACHING:
         return NOT_YET_COMPLETED
 
+    key = name if fingerprint is None else name + ":" + fingerprint
+
     try:
-        return _COMPLETED_TASKS[name]
-    except KeyError:
+        return _COMPLETED_TASKS[key]
+    except KeyError:  # suppress(pointless-except)
+        pass
+
+    if container is None or fingerprint is None:
+        return NOT_YET_COMPLETED
+
+    import json
+
+    try:
+        with open(_task_result_path(container, name), "r") as result_file:
+            stored = json.load(result_file)
+    except (IOError, ValueError):
+        return NOT_YET_COMPLETED
+
+    if stored.get("fingerprint", None) != fingerprint:
         return NOT_YET_COMPLETED
 
+    _COMPLETED_TASKS[key] = stored["result"]
+    return _COMPLETED_TASKS[key]
+
 
-def register_result(name, result):
+def register_result(name, result, container=None, fingerprint=None):
     """Register the result of the task :name:.
 
     It will be automatically returned again later if
     already_completed is called with :name:.
+
+    If :container: and :fingerprint: are passed, the result is also
+    stored in the container, so that later invocations can use it
+    if the inputs to the task have the same fingerprint. The result
+    must be serializable as JSON.
     """
     if _NO_TASK_CACHING:
         return
 
-    _COMPLETED_TASKS[name] = result
+    if fingerprint is None:
+        _COMPLETED_TASKS[name] = result
+        return
+
+    _COMPLETED_TASKS[name + ":" + fingerprint] = result
+
+    if container is not None:
+        import json
+
+        path = _task_result_path(container, name)
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                                 prefix=".tmp-")
+        with os.fdopen(descriptor, "w") as result_file:
+            json.dump({"fingerprint": fingerprint, "result": result},
+                      result_file)
+
+        getattr(os, "replace", os.rename)(temp_path, path)
+
+
+def _environment_variable_changed(key):
+    """Forget anything that depended on the previous value of key."""
+    if key in ("PATH", "PATHEXT"):
+        invalidate_executable_paths()
 
 
 def overwrite_environment_variable(parent, key, value):
@@ -122,6 +228,8 @@ def overwrite_environment_variable(parent, key, value):
     elif os.environ.get(key, None):
         del os.environ[key]
 
+    _environment_variable_changed(key)
+
     if parent:
         parent.overwrite_environment_variable(key, value)
 
@@ -132,6 +240,8 @@ def prepend_environment_variable(parent, key, value):
                                          os.pathsep,
                                          os.environ.get(key) or "")
 
+    _environment_variable_changed(key)
+
     if parent:
         parent.prepend_environment_variable(key, value)
 
@@ -140,16 +250,22 @@ def prepend_environment_variable(parent, key, value):
 # it inconsistent with other names or loosing descriptiveness
 #
 # suppress(invalid-name)
-def remove_from_environment_variable(parent, key, value):
-    """Remove value from an environment variable list in key."""
+def remove_from_environment_variable(parent, key, *values):
+    """Remove values from an environment variable list in key.
+
+    The parent shell is given the resulting value of key, so that
+    evaluating its script doesn't need to compute it.
+    """
     environ_list = maybe_environ(key).split(os.pathsep)
-    environ_list.remove(value)
+    for value in values:
+        environ_list.remove(value)
 
     os.environ[key] = os.pathsep.join(environ_list)
 
-    # See http://stackoverflow.com/questions/370047/
+    _environment_variable_changed(key)
+
     if parent:
-        parent.remove_from_environment_variable(key, value)
+        parent.overwrite_environment_variable(key, os.environ[key])
 
 
 def maybe_environ(key):
@@ -160,40 +276,468 @@ def maybe_environ(key):
         return ""
 
 
-def _match_all(abs_dir, matching, not_matching):
-    """Return all directories in abs_dirs matching all expressions."""
-    num_not_matching = 0
+class _EnvironmentChange(object):  # suppress(too-few-public-methods)
+    """A pending change to an environment variable."""
 
-    for expression in matching:
-        if not fnmatch.fnmatch(abs_dir, expression):
-            num_not_matching += 1
+    def __init__(self, original):
+        """Initialize this change for a key with original value."""
+        super(_EnvironmentChange, self).__init__()
+        self.original = original
+        self.value = original
+        self.parents = []
 
-    if num_not_matching == len(matching):
-        return False
 
-    for expression in not_matching:
-        if fnmatch.fnmatch(abs_dir, expression):
-            return False
+def _write_change_to_parent(parent, key, change):
+    """Write change in key to parent.
 
-    return True
+    If change just put something in front of the original value,
+    then that is prepended, otherwise key is overwritten.
+    """
+    suffix = os.pathsep + (change.original or "")
+    if (change.value is not None and
+            len(change.value) > len(suffix) and
+            change.value.endswith(suffix)):
+        parent.prepend_environment_variable(key,
+                                            change.value[:-len(suffix)])
+    else:
+        parent.overwrite_environment_variable(key, change.value)
+
+
+class EnvironmentTransaction(object):
+    """A set of changes to environment variables, applied together.
+
+    Changes are recorded as they are made and can be read back using
+    get. When the transaction is committed, only keys with a different
+    value to the one they had before the transaction are written to
+    os.environ and to the parent shells that changed them.
+    """
+
+    def __init__(self, parent, changes=None):
+        """Initialize this transaction, writing changes to parent."""
+        super(EnvironmentTransaction, self).__init__()
+        self._parent = parent
+        self._changes = changes if changes is not None else dict()
+
+    def joined(self, parent):
+        """Get a transaction writing changes to parent as part of this one."""
+        return EnvironmentTransaction(parent, self._changes)
+
+    def get(self, key, default=None):
+        """Get the value of key, as of the changes made so far."""
+        try:
+            value = self._changes[key].value
+        except KeyError:
+            value = os.environ.get(key, None)
+
+        return default if value is None else value
+
+    def _record(self, key, value):
+        """Record that key now has value."""
+        try:
+            change = self._changes[key]
+        except KeyError:
+            change = _EnvironmentChange(os.environ.get(key, None))
+            self._changes[key] = change
+
+        change.value = value
+        if self._parent and self._parent not in change.parents:
+            change.parents.append(self._parent)
+
+    def overwrite(self, key, value):
+        """Overwrite key with value, or unset it if value is None."""
+        self._record(key, str(value) if value is not None else None)
+
+    def prepend(self, key, value):
+        """Prepend value to the environment variable list in key."""
+        self._record(key, "{0}{1}{2}".format(str(value),
+                                             os.pathsep,
+                                             self.get(key, "")))
+
+    def remove(self, key, *values):
+        """Remove values from the environment variable list in key."""
+        environ_list = self.get(key, "").split(os.pathsep)
+        for value in values:
+            environ_list.remove(value)
+
+        self._record(key, os.pathsep.join(environ_list))
+
+    def commit(self):
+        """Write the changed keys to os.environ and parent shells."""
+        for key in sorted(self._changes.keys()):
+            change = self._changes[key]
+            if change.value == change.original:
+                continue
+
+            if change.value is not None:
+                os.environ[key] = change.value
+            else:
+                os.environ.pop(key, None)
+
+            _environment_variable_changed(key)
+
+            for parent in change.parents:
+                _write_change_to_parent(parent, key, change)
+
+        self._changes.clear()
+
+
+_ENVIRONMENT_TRANSACTIONS = []
+
+
+@contextmanager
+def environment_transaction(parent):
+    """Make changes to the environment in an EnvironmentTransaction.
+
+    Transactions started while another is in progress become part of
+    it, and their changes are applied when the outermost transaction
+    finishes. Nothing is applied if an exception is raised.
+    """
+    if _ENVIRONMENT_TRANSACTIONS:
+        yield _ENVIRONMENT_TRANSACTIONS[-1].joined(parent)
+        return
+
+    transaction = EnvironmentTransaction(parent)
+    _ENVIRONMENT_TRANSACTIONS.append(transaction)
+    try:
+        yield transaction
+    finally:
+        _ENVIRONMENT_TRANSACTIONS.pop()
+
+    transaction.commit()
+
+
+def _exit_contexts(contexts):
+    """Exit each of contexts, in the opposite order to entering them."""
+    for context in reversed(contexts):
+        context.__exit__(None, None, None)
+
+
+@contextmanager
+def activated(*containers):
+    """Proceed with all containers activated.
+
+    Each container is activated as it would be by its own activated
+    method, but the changes to the environment made to activate all of
+    them are applied together, as are the changes made to deactivate
+    them afterwards.
+    """
+    contexts = [c.activated(sys.modules[__name__]) for c in containers]
+    entered = list()
+
+    with environment_transaction(None):
+        try:
+            for context in contexts:
+                context.__enter__()
+                entered.append(context)
+        except BaseException:
+            # Nothing is applied if activation fails part of the way
+            # through, but the containers already activated in this
+            # transaction are deactivated, so their contexts are closed.
+            _exit_contexts(entered)
+            raise
+
+    try:
+        yield
+    finally:
+        with environment_transaction(None):
+            _exit_contexts(entered)
+
+
+_SCANDIR = getattr(os, "scandir", None)
+
+# Seconds after its last modification before anything recorded about a
+# file or directory is reused. They can change again within the
+# resolution of their modification time without it changing.
+_MTIME_MARGIN = 2.0
+
+_DIRECTORY_INDEXES = []
+
+
+def _scan_directory(directory):
+    """Return path, whether it is a directory and a link for each entry."""
+    if _SCANDIR is not None:
+        return [(e.path, e.is_dir(), e.is_symlink())
+                for e in _SCANDIR(directory)]
+
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        entries.append((path, os.path.isdir(path), os.path.islink(path)))
+
+    return entries
+
+
+class DirectoryIndex(object):
+    """Listings of directories, keyed by their modification times.
+
+    A directory is only scanned again if its modification time changed
+    since it was last listed.
+    """
+
+    def __init__(self, listings=None):
+        """Initialize this index with previously recorded listings."""
+        super(DirectoryIndex, self).__init__()
+        self.listings = listings or dict()
+        self.changed = False
+
+    def list_directory(self, directory):
+        """Return path, whether it is a directory and a link for entries."""
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            if self.listings.pop(directory, None) is not None:
+                self.changed = True
+            raise
+
+        recorded = self.listings.get(directory, None)
+        if recorded is not None and recorded[0] == mtime:
+            return [(os.path.join(directory, name), is_directory, is_link)
+                    for name, is_directory, is_link in recorded[1]]
+
+        entries = _scan_directory(directory)
+
+        if time.time() - mtime > _MTIME_MARGIN:
+            self.listings[directory] = [
+                mtime,
+                [[os.path.basename(path), is_directory, is_link]
+                 for path, is_directory, is_link in entries]
+            ]
+            self.changed = True
+        elif recorded is not None:
+            del self.listings[directory]
+            self.changed = True
+
+        return entries
+
+
+@contextmanager
+def directory_index(container):
+    """Reuse listings of unchanged directories while walking trees.
+
+    The listings are stored in the container, so that they can be reused
+    by later invocations. If an index is already in use, then it is
+    used instead.
+    """
+    if _DIRECTORY_INDEXES:
+        yield _DIRECTORY_INDEXES[-1]
+        return
+
+    import json
+
+    path = os.path.join(container.named_cache_dir("directory-index",
+                                                  ephemeral=False),
+                        "index.json")
+
+    try:
+        with open(path, "r") as index_file:
+            index = DirectoryIndex(json.load(index_file))
+    except (IOError, ValueError):
+        index = DirectoryIndex()
+
+    _DIRECTORY_INDEXES.append(index)
+
+    try:
+        yield index
+    finally:
+        _DIRECTORY_INDEXES.pop()
+
+        if index.changed:
+            descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                                     prefix=".tmp-")
+            with os.fdopen(descriptor, "w") as index_file:
+                json.dump(index.listings, index_file)
 
+            getattr(os, "replace", os.rename)(temp_path, path)
 
-def apply_to_files(func, tree_node, matching=None, not_matching=None):
+
+def _list_directory(directory):
+    """Return path, whether it is a directory and a link for each entry."""
+    if _DIRECTORY_INDEXES:
+        return _DIRECTORY_INDEXES[-1].list_directory(directory)
+
+    return _scan_directory(directory)
+
+
+def _walk(tree_node, prune=None):
+    """Yield each path in tree_node and whether it is a directory.
+
+    Like os.walk, the entries in each directory are listed before they
+    are yielded, and directories are descended into afterwards unless
+    they are symbolic links, no longer exist or 'prune' returns True
+    for them.
+    """
+    pending = [tree_node]
+    while pending:
+        directory = pending.pop()
+        if prune is not None and prune(directory):
+            continue
+
+        try:
+            entries = _list_directory(directory)
+        except OSError:
+            continue
+
+        directories = []
+        for path, is_directory, is_link in entries:
+            if is_directory:
+                directories.append((path, is_link))
+            else:
+                yield path, False
+
+        for path, _ in directories:
+            yield path, True
+
+        pending.extend(reversed([p for p, is_link in directories
+                                 if not is_link]))
+
+
+class _RuleMatcher(object):  # suppress(too-few-public-methods)
+    """Match paths against the patterns of many rules at once.
+
+    The patterns of all the rules are compiled into a single regular
+    expression, with a group for each rule.
+    """
+
+    def __init__(self, rules):
+        """Initialize this matcher with a list of patterns for each rule."""
+        super(_RuleMatcher, self).__init__()
+        alternatives = []
+        for index, patterns in enumerate(rules):
+            if patterns:
+                translated = [fnmatch.translate(os.path.normcase(p))
+                              for p in patterns]
+                alternatives.append("(?P<rule{0}>{1})".format(
+                    index,
+                    "|".join(translated)
+                ))
+
+        self._expression = None
+        if alternatives:
+            self._expression = re.compile("|".join(alternatives))
+
+    def match(self, path):
+        """Return index of the first rule matching path, or None."""
+        if self._expression is None:
+            return None
+
+        match = self._expression.match(os.path.normcase(path))
+        return int(match.lastgroup[len("rule"):]) if match else None
+
+
+def _pruning_excluded_subtrees(not_matching):
+    """Return a function which is True for wholly excluded directories.
+
+    If a directory followed by a separator matches a pattern ending in
+    a wildcard, then so does everything beneath it, so that directory
+    does not need to be walked at all.
+    """
+    subtrees = _RuleMatcher([[p for p in not_matching if p.endswith("*")]])
+
+    def prune(directory):
+        """Return True if everything in directory is excluded."""
+        return subtrees.match(os.path.join(directory, "")) is not None
+
+    return prune
+
+
+def _git_files(tree_node):
+    """Return files in tree_node known to git, or None if not a checkout.
+
+    Untracked files are included, unless they are ignored.
+    """
+    try:
+        with open(os.devnull, "w") as devnull:
+            listing = subprocess.Popen(["git",
+                                        "ls-files",
+                                        "-z",
+                                        "--cached",
+                                        "--others",
+                                        "--exclude-standard"],
+                                       cwd=tree_node,
+                                       stdout=subprocess.PIPE,
+                                       stderr=devnull,
+                                       universal_newlines=True)
+            output = listing.communicate()[0]
+    except OSError:
+        return None
+
+    if listing.returncode != 0:
+        return None
+
+    # Tracked files which were deleted are still in the index, and
+    # submodules are directories.
+    files = [os.path.join(tree_node, *name.split("/"))
+             for name in sorted(set(output.split("\0"))) if name]
+    return [f for f in files if os.path.isfile(f)]
+
+
+def _iterate_matching(tree_node,  # suppress(too-many-arguments)
+                      directories,
+                      matching,
+                      not_matching,
+                      from_git=False):
+    """Yield files or directories in tree_node matching patterns."""
+    include = _RuleMatcher([matching or list()])
+    exclude = _RuleMatcher([not_matching or list()])
+    prune = _pruning_excluded_subtrees(not_matching or list())
+
+    files = _git_files(tree_node) if from_git and not directories else None
+    if files is not None:
+        paths = [(f, False) for f in files]
+    else:
+        paths = _walk(tree_node, prune)
+
+    for path, is_directory in paths:
+        if (is_directory == directories and
+                include.match(path) is not None and
+                exclude.match(path) is None):
+            yield path
+
+
+def iterate_files(tree_node, matching=None, not_matching=None, from_git=False):
+    """Yield all files in tree_node, recursively, as they are found.
+
+    Files are yielded if they match any of 'matching', but not if they
+    match any of 'not_matching'. Directories in which every path would
+    match a pattern in 'not_matching' ending in a wildcard, like
+    "*/build/*", are not walked.
+
+    If 'from_git' is True and tree_node is in a git checkout, then files
+    are listed by git instead, so only files in the index and untracked
+    files which are not ignored are considered.
+    """
+    return _iterate_matching(tree_node,
+                             False,
+                             matching,
+                             not_matching,
+                             from_git)
+
+
+def iterate_directories(tree_node, matching=None, not_matching=None):
+    """Yield all directories in tree_node, recursively, as they are found.
+
+    Directories are yielded if they match any of 'matching', but not if
+    they match any of 'not_matching'. Directories removed after being
+    yielded are not descended into.
+    """
+    return _iterate_matching(tree_node, True, matching, not_matching)
+
+
+def apply_to_files(func,
+                   tree_node,
+                   matching=None,
+                   not_matching=None,
+                   from_git=False):
     """Apply recursively to all files in tree_node.
 
     Function will be applied to all filenames matching 'matching', but
     will not be applied to any file matching matching 'not_matching'.
+    If 'from_git' is True, files are listed by git, as in iterate_files.
     """
-    result = []
-    matching = [os.path.normcase(m) for m in matching or list()]
-    not_matching = [os.path.normcase(m) for m in not_matching or list()]
-    for root, _, filenames in os.walk(tree_node):
-        abs_files = [os.path.join(root, f) for f in filenames]
-        result.extend([func(f) for f in abs_files if _match_all(f,
-                                                                matching,
-                                                                not_matching)])
-
-    return result
+    return [func(f) for f in iterate_files(tree_node,
+                                           matching,
+                                           not_matching,
+                                           from_git)]
 
 
 def apply_to_directories(func, tree_node, matching=None, not_matching=None):
@@ -202,16 +746,33 @@ def apply_to_directories(func, tree_node, matching=None, not_matching=None):
     Function will be applied to all filenames matching 'matching', but
     will not be applied to any file matching matching 'not_matching'.
     """
-    result = []
-    matching = [os.path.normcase(m) for m in matching or list()]
-    not_matching = [os.path.normcase(m) for m in not_matching or list()]
-    for root, directories, _, in os.walk(tree_node):
-        abs_dirs = [os.path.join(root, d) for d in directories]
-        result.extend([func(d) for d in abs_dirs if _match_all(d,
-                                                               matching,
-                                                               not_matching)])
+    return [func(d) for d in iterate_directories(tree_node,
+                                                 matching,
+                                                 not_matching)]
 
-    return result
+
+def apply_rules(tree_node, file_rules=(), directory_rules=()):
+    """Apply rules to all files and directories in tree_node in one walk.
+
+    Each rule is a tuple of a list of patterns and a function. Each file
+    is passed to the function of the first of 'file_rules' with a pattern
+    matching it, and each directory to the function of the first of
+    'directory_rules' matching it. Directories which no longer exist
+    after their function is applied are not descended into.
+    """
+    file_matcher = _RuleMatcher([patterns for patterns, _ in file_rules])
+    directory_matcher = _RuleMatcher([p for p, _ in directory_rules])
+
+    for path, is_directory in _walk(tree_node):
+        if is_directory:
+            rules = directory_rules
+            index = directory_matcher.match(path)
+        else:
+            rules = file_rules
+            index = file_matcher.match(path)
+
+        if index is not None:
+            rules[index][1](path)
 
 
 class IndentedLogger(object):
@@ -255,7 +816,7 @@ class IndentedLogger(object):
             IndentedLogger._printed_on_secondary_indents = False
 
     @staticmethod
-    def message(message_to_print):
+    def message(message_to_print, flush=True):
         """Print a message, with a pre-newline, splitting on newlines."""
         if IndentedLogger._indent_level > 0:
             IndentedLogger._printed_on_secondary_indents = True
@@ -263,7 +824,7 @@ class IndentedLogger(object):
         indent = IndentedLogger._indent_level * "    "
         formatted = message_to_print.replace("\r", "\r" + indent)
         formatted = formatted.replace("\n", "\n" + indent)
-        print_message(formatted)
+        print_message(formatted, flush)
 
     @staticmethod
     def dot():
@@ -313,197 +874,705 @@ def thread_output(*args, **kwargs):
     thread.join()
 
 
-def running_output(process, outputs):
-    """Show output of process as it runs."""
-    state = type("State",
-                 (object, ),
-                 {
-                     "printed_message": False,
-                     "read_first_byte": False
-                 })
-
-    def output_printer(file_handle):
-        """Thread that prints the output of this process."""
-        character = bytearray()
-        while True:
-            character += file_handle.read(1)
-            try:
-                if character:
-                    if not state.read_first_byte:
-                        state.read_first_byte = True
-
-                        if character != "\n":
-                            IndentedLogger.message("\n")
-
-                    # If this fails, then we will just read further characters
-                    # until the decode succeeds.
-                    IndentedLogger.message(character.decode("utf-8"))
-                    state.printed_message = True
-                    character = bytearray()
-                else:
-                    return
-            except UnicodeDecodeError:
-                continue
+_READ_SIZE = 64 * 1024
+_FLUSH_INTERVAL = 0.1
+_PARTIAL_LINE_TIMEOUT = 1.0
+_PARTIAL_LINE_LIMIT = 4096
+_POLL_INTERVAL = 0.05
+_TIMEOUT_EXPIRED = getattr(subprocess, "TimeoutExpired", None)
 
-    stdout = threading.Thread(target=output_printer, args=(outputs[0], ))
 
-    stdout.start()
-    stderr_lines = list(outputs[1])
+class _SelectorEvents(object):
+    """Wait for chunks to be read from files, using a selector."""
 
-    try:
-        status = process.wait()
-    finally:
-        stdout.join()
+    def __init__(self):
+        """Initialize this waiter."""
+        super(_SelectorEvents, self).__init__()
+        self._selector = selectors.DefaultSelector()
+        self.open_files = 0
 
-    # Print a new line before printing any stderr messages
-    if len(stderr_lines):
-        IndentedLogger.message("\n")
+    def register(self, file_handle, key):
+        """Read chunks from file_handle, returning them with key."""
+        self._selector.register(file_handle.fileno(),
+                                selectors.EVENT_READ,
+                                key)
+        self.open_files += 1
 
-        for line in stderr_lines:
-            IndentedLogger.message(line.decode("utf-8"))
-            state.printed_message = True
+    def wait(self, timeout):
+        """Wait up to timeout seconds for chunks to be read.
 
-    if state.printed_message:
-        print_message("\n")
+        Returns a list of tuples of the key the chunk was read for,
+        the chunk itself, and whether more is probably waiting to be
+        read. An empty chunk is returned when a file reaches EOF.
+        """
+        chunks = []
+        for key, _ in self._selector.select(timeout):
+            chunk = os.read(key.fd, _READ_SIZE)
+            if not chunk:
+                self._selector.unregister(key.fd)
+                self.open_files -= 1
 
-    return status
+            chunks.append((key.data, chunk, len(chunk) == _READ_SIZE))
 
+        return chunks
 
-def _maybe_use_running_output(process, outputs):
-    """Use running_output if user requested verbose output."""
-    if os.environ.get("POLYSQUARE_ALWAYS_PRINT_PROCESS_OUTPUT", None):
-        return running_output(process, outputs)
+    def close(self):
+        """Stop waiting for chunks."""
+        self._selector.close()
 
-    return None
 
+class _PollEvents(object):
+    """Wait for chunks to be read from files, using select.poll.
 
-def output_on_fail(process, outputs):
-    """Capture output, displaying it if the process fails."""
-    status = _maybe_use_running_output(process, outputs)
-    if status is not None:
-        return status
+    This is used where the selectors module isn't available, like
+    python 2.7. Where poll isn't available either, select.select is used.
+    """
 
-    def reader(handle, input_queue):
-        """Thread which reads handle, until EOF."""
-        input_queue.put(handle.read())
+    def __init__(self):
+        """Initialize this waiter."""
+        super(_PollEvents, self).__init__()
+        self._poll = select.poll() if hasattr(select, "poll") else None
+        self._keys = dict()
+        self.open_files = 0
 
-    with thread_output(target=reader, args=(outputs[0], )) as stdout_queue:
-        with thread_output(target=reader,
-                           args=(outputs[1], )) as stderr_queue:
-            stdout = stdout_queue.get()
-            stderr = stderr_queue.get()
+    def register(self, file_handle, key):
+        """Read chunks from file_handle, returning them with key."""
+        descriptor = file_handle.fileno()
+        self._keys[descriptor] = key
+        if self._poll is not None:
+            self._poll.register(descriptor, select.POLLIN | select.POLLPRI)
 
-    status = process.wait()
+        self.open_files += 1
 
-    if status != 0:
-        IndentedLogger.message("\n")
-        IndentedLogger.message(stdout.decode("utf-8"))
-        IndentedLogger.message(stderr.decode("utf-8"))
+    def _ready(self, timeout):
+        """Return descriptors that can be read within timeout seconds."""
+        try:
+            if self._poll is None:
+                return select.select(list(self._keys), [], [], timeout)[0]
 
-    return status
+            if timeout is not None:
+                timeout = int(math.ceil(timeout * 1000))
 
+            return [descriptor for descriptor, _ in self._poll.poll(timeout)]
+        except (select.error, OSError) as error:
+            # Older pythons don't retry when interrupted by a signal.
+            if error.args[0] != errno.EINTR:
+                raise
 
-def long_running_suppressed_output(dot_timeout=10):
-    """Print dots in a separate thread until our process is done."""
-    def strategy(process, outputs):
-        """Partially applied strategy to be passed to execute."""
-        status = _maybe_use_running_output(process, outputs)
-        if status is not None:
-            return status
+            return []
 
-        def print_dots(status_queue):
-            """Print a dot every dot_timeout seconds."""
-            while True:
-                # Exit when something gets written to the pipe
-                try:
-                    status_queue.get(True, dot_timeout)
-                    return
-                except Empty:
-                    IndentedLogger.dot()
+    def wait(self, timeout):
+        """Wait up to timeout seconds for chunks to be read.
 
-        status_queue = Queue()
-        dots_thread = threading.Thread(target=print_dots,
-                                       args=(status_queue, ))
-        dots_thread.start()
+        Returns chunks in the same way that _SelectorEvents.wait does.
+        """
+        chunks = []
+        for descriptor in self._ready(timeout):
+            chunk = os.read(descriptor, _READ_SIZE)
+            key = self._keys[descriptor]
+            if not chunk:
+                del self._keys[descriptor]
+                if self._poll is not None:
+                    self._poll.unregister(descriptor)
 
-        try:
-            status = output_on_fail(process, outputs)
-        finally:
-            status_queue.put("done")
-            dots_thread.join()
+                self.open_files -= 1
 
-        return status
+            chunks.append((key, chunk, len(chunk) == _READ_SIZE))
 
-    return strategy
+        return chunks
 
+    def close(self):
+        """Stop waiting for chunks."""
+        self._keys.clear()
 
-@contextmanager
-def close_file_pair(pair):
-    """Close the pair of files on exit."""
-    try:
-        yield pair
-    finally:
-        pair[0].close()
-        pair[1].close()
 
+class _ThreadEvents(object):
+    """Wait for chunks to be read from files, using a thread for each.
 
-@contextmanager
-def in_dir(path):
-    """Execute statements in this context in path."""
-    cwd = os.getcwd()
-    os.chdir(path)
+    This is used where pipes can't be selected on, like Windows.
+    """
 
-    try:
-        yield
-    finally:
-        os.chdir(cwd)
+    def __init__(self):
+        """Initialize this waiter."""
+        super(_ThreadEvents, self).__init__()
+        self._chunks = Queue()
+        self._threads = []
+        self.open_files = 0
+
+    def register(self, file_handle, key):
+        """Read chunks from file_handle, returning them with key."""
+        def reader():
+            """Thread which reads file_handle, until EOF."""
+            descriptor = file_handle.fileno()
+            while True:
+                chunk = os.read(descriptor, _READ_SIZE)
+                self._chunks.put((key, chunk, len(chunk) == _READ_SIZE))
+                if not chunk:
+                    return
 
+        thread = threading.Thread(target=reader)
+        thread.start()
+        self._threads.append(thread)
+        self.open_files += 1
 
-def process_shebang(args):
-    """Process any shebangs.
+    def wait(self, timeout):
+        """Wait up to timeout seconds for chunks to be read."""
+        try:
+            chunks = [self._chunks.get(True, timeout)]
+        except Empty:
+            return []
 
-    This needs to be done by us, because it is not done automatically
-    on some operating systems, like Windows.
-    """
-    path_to_exec = which(args[0])
+        while True:
+            try:
+                chunks.append(self._chunks.get_nowait())
+            except Empty:
+                break
 
-    if path_to_exec is None:
-        msg = """Can't find binary {0} in PATH""".format(args[0])
-        raise RuntimeError(msg)
+        self.open_files -= len([c for c in chunks if not c[1]])
+        return chunks
 
-    # If the first argument's extension is in PATHEXT then we can just
-    # execute it directly - the operating system will know what to do.
-    #
-    # Note that we can't use the default "" value, since nothing in
-    # PATHEXT indicates that the variable was not set and the operating
-    # system doesn't have default associations for certain extensions.
-    if os.environ.get("PATHEXT", None):
-        for ext in os.environ["PATHEXT"].split(os.pathsep):
-            if os.path.splitext(args[0])[1] == ext:
-                return args
+    def close(self):
+        """Stop waiting for chunks, once all threads are done."""
+        for thread in self._threads:
+            thread.join()
 
-    try:
-        with open(path_to_exec, "rt") as exec_file:
-            if exec_file.read(2) == "#!":
-                shebang = exec_file.readline().strip().replace("\n", "")
-                shebang_args = shebang.split(" ")
 
-                # Try to handle the case where the shebang executable
-                # does not exist by taking the basename.
-                if not os.path.exists(shebang_args[0]):
-                    shebang_args[0] = os.path.basename(shebang_args[0])
+def _wait_for_process(process, timeout):
+    """Wait up to timeout seconds for process to exit."""
+    if timeout is None:
+        process.wait()
+    elif _TIMEOUT_EXPIRED is None:
+        time.sleep(min(timeout, _POLL_INTERVAL))
+    else:
+        try:
+            process.wait(timeout=timeout)
+        except _TIMEOUT_EXPIRED:  # suppress(pointless-except)
+            pass
 
-                return shebang_args + [path_to_exec] + list(args[1:])
-    # If we couldn't decode the file, it is probably a binary file, so
-    # just execute it directly.
-    except UnicodeDecodeError:  # suppress(pointless-except)
-        pass
 
-    return args
+class _Watch(object):  # suppress(too-few-public-methods)
+    """A process being watched by a ProcessSupervisor."""
 
+    def __init__(self, process, on_output, on_exit, tick, on_tick):
+        """Initialize this watch."""
+        super(_Watch, self).__init__()
+        self.process = process
+        self.on_output = on_output
+        self.on_exit = on_exit
+        self.tick = tick
+        self.on_tick = on_tick
+        self.next_tick = time.time() + tick if on_tick else None
+        self.open_streams = 0
 
-def _try_ignoring_ent_and_perm(func, *args, **kwargs):
-    """Invoke func, ignoring OSError arising from ENOENT and EPERM."""
+
+class ProcessSupervisor(object):
+    """Watch processes, their output and periodic ticks on one loop.
+
+    Output is read with a selector, or with poll where selectors is not
+    available. On Windows, where pipes can't be waited on, it is read
+    with a thread for each stream. Call watch for each process, then
+    run to wait until they have all exited.
+    """
+
+    def __init__(self):
+        """Initialize this supervisor."""
+        super(ProcessSupervisor, self).__init__()
+        if platform.system() == "Windows":
+            self._events = _ThreadEvents()
+        elif selectors is not None:
+            self._events = _SelectorEvents()
+        else:
+            self._events = _PollEvents()
+
+        self._watches = []
+
+    def watch(self,
+              process,
+              streams=(),
+              on_output=None,
+              on_exit=None,
+              tick=None,
+              on_tick=None):
+        """Watch process until it exits.
+
+        :on_output: is called with the index of the stream in :streams:,
+        each chunk read from it and whether more is probably waiting to
+        be read. It is called with an empty chunk at the end of the
+        stream. :on_tick: is called every :tick: seconds while the
+        process runs and :on_exit: is called with its exit status once
+        it has exited and all of its streams have ended.
+        """
+        watch = _Watch(process, on_output, on_exit, tick, on_tick)
+        for index, stream in enumerate(streams):
+            self._events.register(stream, (watch, index))
+            watch.open_streams += 1
+
+        self._watches.append(watch)
+
+    def _next_tick_in(self, now):
+        """Return seconds until the next tick, or None."""
+        ticks = [w.next_tick for w in self._watches if w.next_tick]
+        return max(0, min(ticks) - now) if ticks else None
+
+    def _wait(self):
+        """Wait for output, ticks or processes to exit."""
+        timeout = self._next_tick_in(time.time())
+        exiting = [w for w in self._watches if not w.open_streams]
+
+        if self._events.open_files:
+            if exiting:
+                timeout = min(_POLL_INTERVAL, timeout or _POLL_INTERVAL)
+
+            for (watch, index), chunk, more in self._events.wait(timeout):
+                if not chunk:
+                    watch.open_streams -= 1
+
+                if watch.on_output:
+                    watch.on_output(index, chunk, more)
+        elif len(exiting) == 1:
+            _wait_for_process(exiting[0].process, timeout)
+        else:
+            time.sleep(min(_POLL_INTERVAL, timeout or _POLL_INTERVAL))
+
+    def _tick(self):
+        """Call on_tick for each watch that is due a tick."""
+        now = time.time()
+        for watch in self._watches:
+            if watch.next_tick and watch.next_tick <= now:
+                watch.next_tick = max(watch.next_tick + watch.tick, now)
+                watch.on_tick()
+
+    def _reap(self):
+        """Finish watching processes that have exited."""
+        for watch in list(self._watches):
+            if watch.open_streams:
+                continue
+
+            status = watch.process.poll()
+            if status is not None:
+                self._watches.remove(watch)
+                if watch.on_exit:
+                    watch.on_exit(status)
+
+    def run(self):
+        """Run until all watched processes have exited."""
+        try:
+            while self._watches:
+                self._wait()
+                self._tick()
+                self._reap()
+        finally:
+            self._events.close()
+
+
+def _run_supervised(watch, process, outputs):
+    """Watch process with watch on its own supervisor, returning status."""
+    supervisor = ProcessSupervisor()
+    watch(supervisor, process, outputs)
+    supervisor.run()
+    return process.returncode
+
+
+class _OutputPrinter(object):
+    """Print chunks of output from several streams with IndentedLogger.
+
+    Chunks are decoded incrementally, so a character split across
+    two chunks is printed once both have arrived. Only whole lines
+    are printed, so that lines from different streams are not mixed
+    together, unless tick is called twice without any output arriving
+    in between, or a partial line gets longer than _PARTIAL_LINE_LIMIT
+    or older than _PARTIAL_LINE_TIMEOUT. If :started: is passed, each
+    line is prefixed with the number of seconds since then. The output
+    is only flushed when no more is waiting to be read, or if it hasn't
+    been flushed for a while.
+    """
+
+    def __init__(self, streams, started=None):
+        """Initialize this printer for a number of streams."""
+        super(_OutputPrinter, self).__init__()
+        self._decoders = [codecs.getincrementaldecoder("utf-8")("replace")
+                          for _ in range(streams)]
+        self._partial_lines = [""] * streams
+        self._partial_lines_since = [0] * streams
+        self._started = started
+        self._unfinished_line_from = None
+        self._last_flush = 0
+        self._received_chunk = False
+        self.printed_message = False
+
+    def _timestamped(self, text):
+        """Prefix each line in text with a timestamp."""
+        stamp = "[{0:8.3f}] ".format(time.time() - self._started)
+        lines = text.split("\n")
+        stamped = [(stamp + line) if line else line for line in lines[1:]]
+
+        if self._unfinished_line_from is None and lines[0]:
+            lines[0] = stamp + lines[0]
+
+        return "\n".join(lines[:1] + stamped)
+
+    def _print(self, stream, text, more_waiting):
+        """Print text from stream."""
+        if not text:
+            return
+
+        if self._unfinished_line_from not in (None, stream):
+            IndentedLogger.message("\n", flush=False)
+            self._unfinished_line_from = None
+
+        if not self.printed_message and not text.startswith("\n"):
+            IndentedLogger.message("\n", flush=False)
+
+        if self._started is not None:
+            text = self._timestamped(text)
+
+        now = time.time()
+        flush = not more_waiting or now - self._last_flush > _FLUSH_INTERVAL
+        IndentedLogger.message(text, flush=flush)
+        self.printed_message = True
+        self._unfinished_line_from = (None if text.endswith("\n")
+                                      else stream)
+
+        if flush:
+            self._last_flush = now
+
+    def _partial_line_due(self, stream, now):
+        """Return True if the partial line from stream should be printed."""
+        partial_line = self._partial_lines[stream]
+        return bool(partial_line) and (
+            len(partial_line) >= _PARTIAL_LINE_LIMIT or
+            now - self._partial_lines_since[stream] >= _PARTIAL_LINE_TIMEOUT
+        )
+
+    def print_chunk(self, stream, chunk, more_waiting=False):
+        """Print chunk from stream, or the rest of it if chunk is empty."""
+        self._received_chunk = True
+        now = time.time()
+        previous_partial_line = self._partial_lines[stream]
+        text = previous_partial_line + self._decoders[stream].decode(
+            chunk,
+            final=not chunk
+        )
+
+        if chunk:
+            end_of_lines = text.rfind("\n") + 1
+            self._partial_lines[stream] = text[end_of_lines:]
+            text = text[:end_of_lines]
+
+            # The partial line left over started in this chunk, unless
+            # this chunk only continued the partial line before it.
+            if end_of_lines or not previous_partial_line:
+                self._partial_lines_since[stream] = now
+
+            if self._partial_line_due(stream, now):
+                text += self._partial_lines[stream]
+                self._partial_lines[stream] = ""
+        else:
+            self._partial_lines[stream] = ""
+
+        self._print(stream, text, more_waiting)
+
+    def tick(self):
+        """Print partial lines if nothing was received since last tick.
+
+        Partial lines that have been waiting for a while are also printed,
+        even if more output is still arriving.
+        """
+        now = time.time()
+        for stream, text in enumerate(self._partial_lines):
+            if not self._received_chunk or self._partial_line_due(stream,
+                                                                  now):
+                self._partial_lines[stream] = ""
+                self._print(stream, text, False)
+
+        self._received_chunk = False
+
+
+def _always_print_output():
+    """Return True if the user requested verbose output."""
+    return bool(os.environ.get("POLYSQUARE_ALWAYS_PRINT_PROCESS_OUTPUT",
+                               None))
+
+
+def _watch_running_output(supervisor, process, outputs):
+    """Show output of process as it runs, using supervisor."""
+    started = None
+    if os.environ.get("POLYSQUARE_TIMESTAMP_PROCESS_OUTPUT", None):
+        started = time.time()
+
+    printer = _OutputPrinter(len(outputs), started)
+
+    def on_exit(status):
+        """Print a trailing newline if anything was printed."""
+        del status
+
+        if printer.printed_message:
+            print_message("\n")
+
+    supervisor.watch(process,
+                     outputs,
+                     on_output=printer.print_chunk,
+                     on_exit=on_exit,
+                     tick=_PARTIAL_LINE_TIMEOUT,
+                     on_tick=printer.tick)
+
+
+def running_output(process, outputs):
+    """Show output of process as it runs.
+
+    Standard output and standard error are shown as they arrive. If
+    POLYSQUARE_TIMESTAMP_PROCESS_OUTPUT is set, each line is prefixed
+    with the number of seconds since the process started.
+    """
+    return _run_supervised(_watch_running_output, process, outputs)
+
+
+running_output.watch = _watch_running_output
+
+
+_FAILURE_OUTPUT_LINES = 200
+_FAILURE_OUTPUT_BYTES = 256 * 1024
+
+
+def _captures_output_to_file(output_strategy):
+    """Return True if output_strategy wants output written to a file."""
+    if _always_print_output():
+        return False
+
+    return getattr(output_strategy, "captures_output_to_file", False)
+
+
+def _capture_directory(container):
+    """Return directory to capture the output of processes in.
+
+    None is returned for objects standing in for a container which
+    don't have a cache, meaning that the temporary directory is used.
+    """
+    try:
+        directory = container.named_cache_dir("process-output")
+        if os.path.isdir(directory):
+            return directory
+    except (AttributeError, TypeError):  # suppress(pointless-except)
+        pass
+
+    return None
+
+
+def _open_capture_file(directory, program):
+    """Open a file in directory to capture the output of program."""
+    return tempfile.NamedTemporaryFile(mode="w+b",
+                                       dir=directory,
+                                       prefix=os.path.basename(program) + "-",
+                                       suffix=".log",
+                                       delete=False)
+
+
+def _show_captured_output(capture_file):
+    """Show the end of the output in capture_file, and where it is.
+
+    At most POLYSQUARE_FAILURE_OUTPUT_LINES lines are shown, which
+    defaults to _FAILURE_OUTPUT_LINES.
+    """
+    max_lines = int(os.environ.get("POLYSQUARE_FAILURE_OUTPUT_LINES",
+                                   _FAILURE_OUTPUT_LINES))
+
+    capture_file.seek(0, os.SEEK_END)
+    start = max(0, capture_file.tell() - _FAILURE_OUTPUT_BYTES)
+    capture_file.seek(start)
+    lines = capture_file.read().decode("utf-8", "replace").splitlines(True)
+
+    # The first line is probably incomplete if we didn't start reading
+    # from the beginning.
+    if start:
+        lines = lines[1:]
+
+    IndentedLogger.message("\n")
+    if start or len(lines) > max_lines:
+        IndentedLogger.message("""(Only the end of the output """
+                               """is shown)\n""")
+
+    IndentedLogger.message("".join(lines[-max_lines:] if max_lines else []))
+    IndentedLogger.message("""\n(Full output is in {0})\n""".format(
+        capture_file.name
+    ))
+
+
+def _watch_output_on_fail(supervisor,
+                          process,
+                          outputs,
+                          tick=None,
+                          on_tick=None):
+    """Capture output of process, showing it if it fails, using supervisor.
+
+    If outputs are pipes instead of a file, then they are copied to a
+    temporary file.
+    """
+    if _always_print_output():
+        return _watch_running_output(supervisor, process, outputs)
+
+    if len(outputs) == 1:
+        capture_file = outputs[0]
+        streams = ()
+    else:
+        capture_file = _open_capture_file(None, "process")
+        streams = outputs
+
+    def on_output(stream, chunk, more_waiting):
+        """Copy chunk to capture_file."""
+        del stream
+        del more_waiting
+
+        capture_file.write(chunk)
+
+    def on_exit(status):
+        """Show captured output if process failed."""
+        capture_file.flush()
+        if status != 0:
+            _show_captured_output(capture_file)
+
+        if capture_file is not outputs[0]:
+            capture_file.close()
+            if status == 0:
+                os.remove(capture_file.name)
+
+    supervisor.watch(process,
+                     streams,
+                     on_output=on_output,
+                     on_exit=on_exit,
+                     tick=tick,
+                     on_tick=on_tick)
+
+
+def output_on_fail(process, outputs):
+    """Capture output, displaying it if the process fails.
+
+    When used with execute, the process writes its output straight to
+    a file in the container, and only the end of that file is shown if
+    the process fails.
+    """
+    return _run_supervised(_watch_output_on_fail, process, outputs)
+
+
+output_on_fail.watch = _watch_output_on_fail
+output_on_fail.captures_output_to_file = True
+
+
+def long_running_suppressed_output(dot_timeout=10):
+    """Print dots every dot_timeout seconds until our process is done."""
+    def watch(supervisor, process, outputs):
+        """Watch process, printing dots while it runs."""
+        if _always_print_output():
+            return _watch_running_output(supervisor, process, outputs)
+
+        return _watch_output_on_fail(supervisor,
+                                     process,
+                                     outputs,
+                                     tick=dot_timeout,
+                                     on_tick=IndentedLogger.dot)
+
+    def strategy(process, outputs):
+        """Partially applied strategy to be passed to execute."""
+        return _run_supervised(watch, process, outputs)
+
+    strategy.watch = watch
+    strategy.captures_output_to_file = True
+    return strategy
+
+
+@contextmanager
+def close_file_pair(pair):
+    """Close the files in pair on exit."""
+    try:
+        yield pair
+    finally:
+        for file_handle in pair:
+            file_handle.close()
+
+
+@contextmanager
+def in_dir(path):
+    """Execute statements in this context in path."""
+    cwd = os.getcwd()
+    os.chdir(path)
+
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+_SHEBANGS = dict()
+
+
+def _read_shebang(path):
+    """Return the arguments in the shebang of path, or None.
+
+    The result is kept for as long as the file at path has the same
+    inode, size and modification time.
+    """
+    stat_result = os.stat(path)
+    key = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime)
+
+    try:
+        cached_key, shebang_args = _SHEBANGS[path]
+        if cached_key == key:
+            return list(shebang_args) if shebang_args else None
+    except KeyError:  # suppress(pointless-except)
+        pass
+
+    shebang_args = None
+
+    try:
+        with open(path, "rt") as exec_file:
+            if exec_file.read(2) == "#!":
+                shebang = exec_file.readline().strip().replace("\n", "")
+                shebang_args = shebang.split(" ")
+    # If we couldn't decode the file, it is probably a binary file, so
+    # just execute it directly.
+    except UnicodeDecodeError:  # suppress(pointless-except)
+        pass
+
+    _SHEBANGS[path] = (key, shebang_args)
+    return list(shebang_args) if shebang_args else None
+
+
+def process_shebang(args):
+    """Process any shebangs.
+
+    This needs to be done by us, because it is not done automatically
+    on some operating systems, like Windows.
+    """
+    path_to_exec = which(args[0])
+
+    if path_to_exec is None:
+        msg = """Can't find binary {0} in PATH""".format(args[0])
+        raise RuntimeError(msg)
+
+    # If the first argument's extension is in PATHEXT then we can just
+    # execute it directly - the operating system will know what to do.
+    #
+    # Note that we can't use the default "" value, since nothing in
+    # PATHEXT indicates that the variable was not set and the operating
+    # system doesn't have default associations for certain extensions.
+    if os.environ.get("PATHEXT", None):
+        for ext in os.environ["PATHEXT"].split(os.pathsep):
+            if os.path.splitext(args[0])[1] == ext:
+                return args
+
+    shebang_args = _read_shebang(path_to_exec)
+    if shebang_args:
+        # Try to handle the case where the shebang executable
+        # does not exist by taking the basename.
+        if not os.path.exists(shebang_args[0]):
+            shebang_args[0] = os.path.basename(shebang_args[0])
+
+        return shebang_args + [path_to_exec] + list(args[1:])
+
+    return args
+
+
+def _try_ignoring_ent_and_perm(func, *args, **kwargs):
+    """Invoke func, ignoring OSError arising from ENOENT and EPERM."""
     try:
         func(*args, **kwargs)
     except OSError as err:
@@ -543,15 +1612,14 @@ def force_remove_tree(directory):
             subprocess.check_call(["rm", "-rf", directory])
 
 
-def execute(container, output_strategy, *args, **kwargs):
-    """A thin wrapper around subprocess.Popen.
+def _start_process(container, output_strategy, args, kwargs):
+    """Start a process for args, as execute does.
 
-    This class encapsulates a single command. The first argument to the
-    constructor specifies how this command's output should be handled
-    (either suppressed, or forwarded to stderr). Remaining arguments
-    will be passed to Popen.
+    Returns the command line, the process, its outputs and the file
+    capturing its output, if any.
     """
     env = os.environ.copy()
+    capture_file = None
 
     if kwargs.get("env"):
         env.update(kwargs["env"])
@@ -577,32 +1645,325 @@ def execute(container, output_strategy, *args, **kwargs):
                                                              repr(value),
                                                              type(value)))
 
-        process = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   env=env)
+        # Strategies which capture output to a file get the output of
+        # the process written straight to that file, instead of
+        # reading it through pipes.
+        if _captures_output_to_file(output_strategy):
+            capture_file = _open_capture_file(_capture_directory(container),
+                                              cmd[0])
+            outputs = (capture_file, )
+            process = subprocess.Popen(cmd,
+                                       stdout=capture_file,
+                                       stderr=subprocess.STDOUT,
+                                       env=env)
+        else:
+            process = subprocess.Popen(cmd,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       env=env)
+            outputs = (process.stdout, process.stderr)
     except OSError as error:
+        if capture_file is not None:
+            capture_file.close()
+            os.remove(capture_file.name)
+
         raise Exception(u"""Failed to execute """
                         u"""{0} - {1}""".format(" ".join(cmd), str(error)))
 
-    with close_file_pair((process.stdout, process.stderr)) as outputs:
+    return cmd, process, outputs, capture_file
+
+
+def _finish_process(container, cmd, status, capture_file, kwargs):
+    """Report the exit status of a process started by _start_process."""
+    # The captured output is kept in case the process failed, so
+    # that it can be looked at later.
+    if capture_file is not None and status == 0:
+        os.remove(capture_file.name)
+
+    instant_fail = kwargs.get("instant_fail") or False
+
+    if status != 0:
+        IndentedLogger.message(u"""!!! Process {0}\n""".format(cmd[0]))
+        for arg in cmd[1:]:
+            IndentedLogger.message(u"""!!!         {0}\n""".format(arg))
+        IndentedLogger.message(u"""!!! failed with {0}\n""".format(status))
+        if not kwargs.get("allow_failure", None):
+            container.note_failure(instant_fail)
+
+    return status
+
+
+def execute(container, output_strategy, *args, **kwargs):
+    """A thin wrapper around subprocess.Popen.
+
+    This class encapsulates a single command. The first argument to the
+    constructor specifies how this command's output should be handled
+    (either suppressed, or forwarded to stderr). Remaining arguments
+    will be passed to Popen.
+    """
+    cmd, process, outputs, capture_file = _start_process(container,
+                                                         output_strategy,
+                                                         args,
+                                                         kwargs)
+
+    with close_file_pair(outputs):
         status = output_strategy(process, outputs)
 
-        instant_fail = kwargs.get("instant_fail") or False
+    return _finish_process(container, cmd, status, capture_file, kwargs)
 
-        if status != 0:
-            IndentedLogger.message(u"""!!! Process {0}\n""".format(cmd[0]))
-            for arg in cmd[1:]:
-                IndentedLogger.message(u"""!!!         {0}\n""".format(arg))
-            IndentedLogger.message(u"""!!! failed with {0}\n""".format(status))
-            if not kwargs.get("allow_failure", None):
-                container.note_failure(instant_fail)
 
-        return status
+Command = namedtuple("Command", "container output_strategy args kwargs")
+
+
+def command(container, output_strategy, *args, **kwargs):
+    """Describe a command for execute_many.
+
+    This takes the same arguments as execute.
+    """
+    return Command(container, output_strategy, args, kwargs)
+
+
+def _cpu_count():
+    """Return the number of CPUs, or 1 if it can't be found."""
+    import multiprocessing
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+@contextmanager
+def _messages_printed_to(fileobj):
+    """Print messages to fileobj in this context."""
+    global PRINT_MESSAGES_TO  # suppress(global-statement)
+
+    previous = PRINT_MESSAGES_TO
+    PRINT_MESSAGES_TO = fileobj
+
+    try:
+        yield
+    finally:
+        PRINT_MESSAGES_TO = previous
+
+
+def _printing_to(fileobj, function):
+    """Return a function calling function, printing messages to fileobj."""
+    if function is None:
+        return None
+
+    def wrapped(*args):
+        """Call function, printing messages to fileobj."""
+        with _messages_printed_to(fileobj):
+            return function(*args)
+
+    return wrapped
+
+
+class _BufferedSupervisor(object):  # suppress(too-few-public-methods)
+    """Watch a process on supervisor, buffering what it prints.
+
+    Ticks which print progress dots are not buffered, since they show
+    that something is still happening. Other ticks, which print output
+    of the process, are. Once the process has exited, :on_exit: is
+    called with its status.
+    """
+
+    def __init__(self, supervisor, buffer, on_exit):
+        """Initialize this buffered supervisor."""
+        super(_BufferedSupervisor, self).__init__()
+        self._supervisor = supervisor
+        self._buffer = buffer
+        self._on_exit = on_exit
+
+    def watch(self,
+              process,
+              streams=(),
+              on_output=None,
+              on_exit=None,
+              tick=None,
+              on_tick=None):
+        """Watch process, as ProcessSupervisor.watch does."""
+        strategy_on_exit = _printing_to(self._buffer, on_exit)
+
+        def buffered_on_exit(status):
+            """Call on_exit for the strategy, then self._on_exit."""
+            if strategy_on_exit:
+                strategy_on_exit(status)
+
+            self._on_exit(status)
+
+        if on_tick != IndentedLogger.dot:
+            on_tick = _printing_to(self._buffer, on_tick)
+
+        self._supervisor.watch(process,
+                               streams,
+                               on_output=_printing_to(self._buffer,
+                                                      on_output),
+                               on_exit=buffered_on_exit,
+                               tick=tick,
+                               on_tick=on_tick)
+
+
+def execute_many(commands, jobs=None):
+    """Execute each of commands, running some at the same time.
+
+    Each command is made with the command function. At most :jobs:
+    commands run at once, which defaults to the number of CPUs. The
+    output of each command is printed together once it finishes and
+    its failures are noted on its container, as execute does. If a
+    command with instant_fail set fails, the other commands are stopped
+    before the failure is noted.
+
+    Returns the exit status of each command. Output strategies without
+    a watch function block other commands from starting while they run.
+    """
+    import io
+
+    statuses = [None] * len(commands)
+    pending = list(enumerate(commands))
+    running = dict()
+    instant_failures = []
+    supervisor = ProcessSupervisor()
+
+    def start_next():
+        """Start the next pending command, unless a command failed."""
+        if instant_failures or not pending:
+            return
+
+        index, (container, output_strategy, args, kwargs) = pending.pop(0)
+        buffer = io.StringIO()
+        cmd, process, outputs, capture_file = _start_process(
+            container,
+            output_strategy,
+            args,
+            kwargs
+        )
+
+        def on_exit(status):
+            """Report status, show buffered output and start another."""
+            del running[index]
+            for output in outputs:
+                output.close()
+
+            if instant_failures:
+                if capture_file is not None and status == 0:
+                    os.remove(capture_file.name)
+
+                _write_log_safe(buffer.getvalue())
+                return
+
+            failed_instantly = (status != 0 and
+                                kwargs.get("instant_fail") and
+                                not kwargs.get("allow_failure"))
+            if failed_instantly:
+                # Stop the other commands, and note the failure once
+                # they have exited.
+                instant_failures.append((container, cmd, status))
+                for other in running.values():
+                    other.terminate()
+            else:
+                with _messages_printed_to(buffer):
+                    _finish_process(container,
+                                    cmd,
+                                    status,
+                                    capture_file,
+                                    kwargs)
+
+            statuses[index] = status
+            _write_log_safe(buffer.getvalue())
+            start_next()
+
+        running[index] = process
+        watch = getattr(output_strategy, "watch", None)
+        if watch is not None:
+            watch(_BufferedSupervisor(supervisor, buffer, on_exit),
+                  process,
+                  outputs)
+        else:
+            with _messages_printed_to(buffer):
+                status = output_strategy(process, outputs)
+
+            on_exit(status)
+
+    try:
+        for _ in range(min(jobs or _cpu_count(), len(pending))):
+            start_next()
+
+        supervisor.run()
+    finally:
+        for process in running.values():
+            process.terminate()
+
+    for container, cmd, status in instant_failures:
+        _finish_process(container,
+                        cmd,
+                        status,
+                        None,
+                        {"instant_fail": True})
+
+    return statuses
+
+
+_EXECUTABLE_PATHS = dict()
+
+
+def invalidate_executable_paths():
+    """Forget all executable paths found by which."""
+    _EXECUTABLE_PATHS.clear()
+
+
+def _directory_mtimes(directories):
+    """Return modification times of directories, or None if missing."""
+    mtimes = []
+    for directory in directories:
+        try:
+            mtimes.append(os.stat(directory).st_mtime)
+        except OSError:
+            mtimes.append(None)
+
+    return mtimes
 
 
 def which(executable):
-    """Full path to executable."""
+    """Full path to executable.
+
+    Results are kept for each value of PATH and PATHEXT, until one of the
+    directories that was searched is modified. They are not kept if one
+    of those directories was modified within the last _MTIME_MARGIN
+    seconds, since it could change again without its modification time
+    changing.
+    """
+    if os.path.dirname(executable):
+        return _search_path(executable)[1]
+
+    key = (os.environ.get("PATH", None),
+           os.environ.get("PATHEXT", None),
+           os.getcwd(),
+           executable)
+
+    try:
+        directories, mtimes, full_path = _EXECUTABLE_PATHS[key]
+        if _directory_mtimes(directories) == mtimes:
+            return full_path
+    except KeyError:  # suppress(pointless-except)
+        pass
+
+    directories, full_path = _search_path(executable)
+    mtimes = _directory_mtimes(directories)
+    settled = time.time() - _MTIME_MARGIN
+    if all(mtime is None or mtime < settled for mtime in mtimes):
+        _EXECUTABLE_PATHS[key] = (directories, mtimes, full_path)
+
+    return full_path
+
+
+def _search_path(executable):
+    """Search PATH for executable.
+
+    Returns the directories that were searched and the full path to
+    executable, or None if it was not found.
+    """
     def is_executable(path):
         """True if path exists and is executable."""
         return (os.path.exists(path) and
@@ -622,17 +1983,19 @@ def which(executable):
         return (os.environ.get("PATHEXT") or "").split(os.pathsep)
 
     seen = set()
+    searched = []
 
     for path in [normalize(p) for p in path_list()]:
         if path not in seen:
+            searched.append(path)
             for ext in [""] + pathext_list():
                 full_path = os.path.join(path, executable) + ext
                 if is_executable(full_path):
-                    return full_path
+                    return searched, full_path
 
             seen.add(path)
 
-    return None
+    return searched, None
 
 
 def where_unavailable(executable,
@@ -686,11 +2049,9 @@ def store_file_mtime_in(source, output_filename):
 
 # suppress(unused-function)
 def store_current_mtime_in(filename):
-    """Store current modification time in filename."""
-    with tempfile.NamedTemporaryFile() as temp:
-        temp.write("contents".encode())
-        temp.flush()
-        store_file_mtime_in(temp.name, filename)
+    """Store current time in filename."""
+    with open(filename, "w") as mtime_file:
+        mtime_file.write(repr(time.time()))
 
 
 def fetch_mtime_from(filename):
@@ -702,27 +2063,176 @@ def fetch_mtime_from(filename):
         return float(0)
 
 
-def exists_and_is_more_recent(cont, filename, mtime):
-    """Return true if this filename exists and is more recent."""
-    if not os.path.exists(filename):
-        return False
+# Once a stamp log has this many times as many records as paths, it is
+# rewritten with only the latest record for each path.
+_STAMP_LOG_COMPACTION_RATIO = 2
+
+_STAMP_STORES = dict()
+
+
+class StampStore(object):
+    """Modification times of many paths, kept in a single log file.
+
+    Stamps are appended to the log in batches, with later records for
+    a path replacing earlier ones. The log is only read again if it was
+    changed by someone else. If lock is passed, it is called to get a
+    context manager which is held while the log is written, so that
+    other processes sharing the log don't lose each other's stamps when
+    it is compacted.
+    """
+
+    def __init__(self, path, lock=None):
+        """Initialize this store, keeping its log at path."""
+        super(StampStore, self).__init__()
+        self._path = path
+        self._lock = lock
+        self._stamps = None
+        self._records = 0
+        self._seen = None
+
+    def _signature(self):
+        """Return a tuple which changes when the log changes."""
+        try:
+            log_stat = os.stat(self._path)
+        except OSError:
+            return None
+
+        return (log_stat.st_ino, log_stat.st_size, log_stat.st_mtime)
+
+    def _load(self):
+        """Return stamps in the log, reading it again if it changed."""
+        signature = self._signature()
+        if self._stamps is not None and signature == self._seen:
+            return self._stamps
+
+        import json
+
+        self._stamps = dict()
+        self._records = 0
+        self._seen = signature
+
+        try:
+            with open(self._path, "r") as log:
+                for line in log:
+                    try:
+                        path, stamp = json.loads(line)
+                    except ValueError:
+                        # A record which was only partially written.
+                        continue
+
+                    self._stamps[path] = stamp
+                    self._records += 1
+        except IOError:  # suppress(pointless-except)
+            pass
+
+        return self._stamps
+
+    def get(self, path, default=None):
+        """Return the stamp for path, or default if there isn't one."""
+        return self._load().get(path, default)
+
+    def get_many(self, paths):
+        """Return a dictionary of the stamps stored for paths."""
+        stamps = self._load()
+        return dict((p, stamps[p]) for p in paths if p in stamps)
+
+    def put(self, path, stamp):
+        """Store stamp for path."""
+        self.put_many({path: stamp})
+
+    def put_many(self, stamps):
+        """Store each stamp in the dictionary stamps."""
+        if self._lock is None:
+            self._write(stamps)
+        else:
+            with self._lock():
+                self._write(stamps)
+
+    def _write(self, stamps):
+        """Write stamps to the log, compacting it if it grew too large."""
+        import json
+
+        # The log is read again first if it was changed, so that stamps
+        # stored by others since are kept if it is compacted.
+        current = self._load()
+        current.update(stamps)
+        self._records += len(stamps)
+
+        if self._records > _STAMP_LOG_COMPACTION_RATIO * len(current):
+            descriptor, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self._path),
+                prefix=".tmp-"
+            )
+            with os.fdopen(descriptor, "w") as log:
+                log.write("".join(json.dumps([p, s]) + "\n"
+                                  for p, s in current.items()))
+
+            getattr(os, "replace", os.rename)(temp_path, self._path)
+            self._records = len(current)
+        else:
+            with open(self._path, "a") as log:
+                log.write("".join(json.dumps([p, s]) + "\n"
+                                  for p, s in stamps.items()))
+
+        self._seen = self._signature()
+
+
+def _stamp_store_in(cont, directory, name):
+    """Return the store with the log called name in directory in cont.
+
+    The log is written while holding a lock in cont, since other
+    processes may share it.
+    """
+    path = os.path.join(directory, name + ".log")
+    lock_name = "stamps-{0}-{1}".format(os.path.basename(directory), name)
 
-    mtimes_dir = cont.named_cache_dir("mtimes")
-    digest = os.path.join(mtimes_dir,
-                          hashlib.md5(filename.encode("utf-8")).hexdigest())
-    fetched_mtime = fetch_mtime_from(digest)
+    try:
+        return _STAMP_STORES[path]
+    except KeyError:
+        _STAMP_STORES[path] = StampStore(path,
+                                         lambda: cont.lock(lock_name))
+        return _STAMP_STORES[path]
 
-    if fetched_mtime > mtime:
-        return True
-    elif fetched_mtime == 0:
-        # No mtime was stored on disk, get filesystem mtime and store
-        # it for caching later. We don't usually use the filesystem
-        # mtime since it isn't tar safe.
-        store_file_mtime_in(filename, digest)
-        if os.stat(filename).st_mtime > mtime:
-            return True
 
-    return False
+def stamp_store(cont, persistent=False):
+    """Return the store of modification times in cont.
+
+    The store is wiped out when the container is cleaned, unless
+    persistent is True, in which case a separate store is used.
+    """
+    return _stamp_store_in(cont,
+                           cont.named_cache_dir("mtimes-persistent"
+                                                if persistent else "mtimes",
+                                                ephemeral=not persistent),
+                           "stamps")
+
+
+def more_recent_files(cont, filenames, mtime, persistent=False):
+    """Return those of filenames which exist and are more recent than mtime.
+
+    The modification time of each file is stored in the container the
+    first time it is seen, and that stored time is used afterwards. We
+    don't usually use the filesystem mtime since it isn't tar safe.
+    """
+    existing = [f for f in filenames if os.path.exists(f)]
+    if not existing:
+        return list()
+
+    store = stamp_store(cont, persistent)
+    stamps = store.get_many(existing)
+    unseen = dict((f, os.stat(f).st_mtime)
+                  for f in existing if not stamps.get(f, 0))
+
+    if unseen:
+        store.put_many(unseen)
+        stamps.update(unseen)
+
+    return [f for f in existing if stamps[f] > mtime]
+
+
+def exists_and_is_more_recent(cont, filename, mtime, persistent=False):
+    """Return true if this filename exists and is more recent."""
+    return len(more_recent_files(cont, [filename], mtime, persistent)) > 0
 
 
 # suppress(unused-function)
@@ -732,6 +2242,131 @@ def where_more_recent(cont, filename, mtime, func, *args, **kwargs):
         return func(*args, **kwargs)
 
 
+def _file_digest(path, algorithm="sha1"):
+    """Return digest of the contents of the file at path, or None."""
+    digest = hashlib.new(algorithm)
+
+    try:
+        with open(path, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(_READ_SIZE), b""):
+                digest.update(chunk)
+    except IOError:
+        return None
+
+    return digest.hexdigest()
+
+
+def _stat_key(stat_result):
+    """Return inode, size and modification time in nanoseconds."""
+    mtime_ns = getattr(stat_result, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(stat_result.st_mtime * 1000000000)
+
+    return [stat_result.st_ino, stat_result.st_size, mtime_ns]
+
+
+def _map_in_threads(function, items, jobs=None):
+    """Return function applied to each of items, using up to jobs threads.
+
+    This is only worthwhile where function releases the global interpreter
+    lock, as hashing large buffers does.
+    """
+    jobs = min(jobs or _cpu_count(), len(items))
+    if jobs <= 1:
+        return [function(item) for item in items]
+
+    from multiprocessing.dummy import Pool
+
+    pool = Pool(jobs)
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fingerprints_dir(cont):
+    """Return directory where fingerprints are stored in cont."""
+    return cont.named_cache_dir("fingerprints", ephemeral=False)
+
+
+def file_digests(cont, filenames, jobs=None):
+    """Return a dictionary of digests of the contents of filenames.
+
+    Digests are stored in the container along with the inode, size and
+    modification time of each file, so files which haven't changed are
+    not hashed again. Other files are hashed using up to jobs threads.
+    The digest of a file which doesn't exist is None.
+    """
+    store = _stamp_store_in(cont, _fingerprints_dir(cont), "files")
+    recorded = store.get_many(filenames)
+    digests = dict()
+    keys = dict()
+
+    for filename in filenames:
+        try:
+            keys[filename] = _stat_key(os.stat(filename))
+        except OSError:
+            digests[filename] = None
+            continue
+
+        stamp = recorded.get(filename, None)
+        if stamp is not None and stamp[:3] == keys[filename]:
+            digests[filename] = stamp[3]
+
+    unhashed = sorted(set(keys.keys()) - set(digests.keys()))
+    digests.update(zip(unhashed, _map_in_threads(_file_digest,
+                                                 unhashed,
+                                                 jobs)))
+
+    settled = (time.time() - _MTIME_MARGIN) * 1000000000
+    stamps = dict((f, keys[f] + [digests[f]]) for f in unhashed
+                  if digests[f] is not None and keys[f][2] < settled)
+    if stamps:
+        store.put_many(stamps)
+
+    return digests
+
+
+def fingerprint(cont, inputs, jobs=None):
+    """Return a digest of the contents of the files and trees in inputs."""
+    filenames = []
+    for path in inputs:
+        if os.path.isdir(path):
+            filenames.extend(sorted(iterate_files(path, matching=["*"])))
+        else:
+            filenames.append(path)
+
+    digests = file_digests(cont, filenames, jobs)
+    digest = hashlib.sha1()
+
+    for filename in filenames:
+        contents = digests[filename] or "missing"
+        digest.update(u"{0}\0{1}\0".format(filename,
+                                           contents).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def where_changed(cont, name, inputs, func, *args, **kwargs):
+    """Call func if the contents of inputs changed since it last succeeded.
+
+    The fingerprint of inputs is stored under name in the container once
+    func returns, so it isn't called again until something in inputs
+    changes. Unlike where_more_recent, this works across restoring the
+    container from a tarball.
+    """
+    current = fingerprint(cont, inputs)
+    successes = _stamp_store_in(cont, _fingerprints_dir(cont), "successes")
+
+    if successes.get(name) == current:
+        return None
+
+    result = func(*args, **kwargs)
+    successes.put(name, current)
+    return result
+
+
 def prepare_deployment(function, *args, **kwargs):
     """Call function if this build is a build that will be deployed later."""
     if (os.environ.get("TRAVIS_PULL_REQUEST", None) == "false" and
@@ -750,7 +2385,11 @@ def url_error():
 
 
 def url_opener():
-    """Return a function that opens urls as files, performing retries."""
+    """Return a function that opens urls as files, performing retries.
+
+    If bootstrap has set HTTP_CLIENT, then connections are shared
+    with it and kept alive between requests.
+    """
     from ssl import SSLError
     from socket import timeout
 
@@ -759,9 +2398,31 @@ def url_opener():
     except ImportError:
         from urllib2 import urlopen  # suppress(import-error)
 
+    try:
+        from urllib.request import Request
+    except ImportError:
+        from urllib2 import Request  # suppress(import-error)
+
+    def _client_urlopen(url, headers=None, **kwargs):
+        """Open url using HTTP_CLIENT, setting the timeout to 30."""
+        return HTTP_CLIENT.open(url,
+                                headers=headers,
+                                timeout=kwargs.get("timeout", None) or 30,
+                                retries=kwargs.get("retrycount", None) or 100,
+                                deadline=kwargs.get("deadline", None))
+
     def _urlopen(*args, **kwargs):
         """Open url, but set the timeout to 30 and retry a few times."""
+        if HTTP_CLIENT is not None:
+            return _client_urlopen(*args, **kwargs)
+
         kwargs["timeout"] = kwargs.get("timeout", None) or 30
+        kwargs.pop("deadline", None)
+
+        url = args[0]
+        headers = kwargs.pop("headers", None)
+        if headers:
+            args = (Request(url, headers=headers),) + args[1:]
 
         if kwargs.get("retrycount"):
             retrycount = (kwargs["retrycount"] + 1)
@@ -781,13 +2442,292 @@ def url_opener():
         errors_string = "    \n".join([repr(e) for e in errors])
         raise url_error()(u"""Failed to open URL {0}, """
                           u"""exceeded max retries {1}. """
-                          u""" Errors [{2}]\n""".format(args[0],
+                          u""" Errors [{2}]\n""".format(url,
                                                         retrycount,
                                                         errors_string))
 
     return _urlopen
 
 
+# Number of times a download is started again after its connection
+# is dropped part of the way through.
+_DOWNLOAD_ATTEMPTS = 5
+
+
+def _download_errors():
+    """Return errors raised when a connection drops during a download."""
+    import socket
+    from ssl import SSLError
+
+    try:
+        import http.client as http_client
+    except ImportError:
+        import httplib as http_client  # suppress(import-error)
+
+    return (url_error(),
+            socket.error,
+            SSLError,
+            http_client.HTTPException,
+            EOFError)
+
+
+def _check_digest(url, algorithm, expected, actual):
+    """Raise RuntimeError if the download of url has the wrong digest."""
+    if expected is not None and expected.lower() != actual:
+        raise RuntimeError("""Download of {0} has {1} digest {2}, """
+                           """expected {3}""".format(url,
+                                                     algorithm,
+                                                     actual,
+                                                     expected))
+
+
+def _resume_validator(info):
+    """Return the validator to send in If-Range to resume a download.
+
+    Weak entity tags can't be used in If-Range, so Last-Modified is
+    used instead of them. Return None if the response had neither.
+    """
+    etag = info.get("ETag", None)
+    if etag and not etag.startswith("W/"):
+        return etag
+
+    return info.get("Last-Modified", None)
+
+
+def _saved_validator(partial, url):
+    """Return the validator saved for the partial download of url.
+
+    Return None if there is no partial download from url with a
+    validator, in which case it can't be told whether what was
+    downloaded so far is still a prefix of what is at url.
+    """
+    import json
+
+    try:
+        with open(partial + ".validator") as validator_file:
+            saved = json.load(validator_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    return saved["validator"] if saved.get("url") == url else None
+
+
+def _save_validator(partial, url, validator):
+    """Save validator for the partial download of url, if there is one."""
+    import json
+
+    if validator is None:
+        _remove_if_exists(partial + ".validator")
+        return
+
+    with open(partial + ".validator", "w") as validator_file:
+        json.dump({"url": url, "validator": validator}, validator_file)
+
+
+def _remove_if_exists(path):
+    """Remove the file at path if it exists."""
+    try:
+        os.remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+def download(url, destination, digest=None, algorithm="sha256"):
+    """Download url to destination, writing it in chunks as it arrives.
+
+    The download is written next to destination and only moved into
+    place once it is complete. If the connection drops, the download is
+    resumed from where it stopped with an HTTP Range request. A download
+    left incomplete by an earlier invocation is only resumed if the
+    server sent an ETag or Last-Modified validator for it, which is
+    passed in If-Range so that the server sends the whole file again if
+    it changed. If digest is passed, the download must have that hex
+    digest using the hashlib algorithm, otherwise RuntimeError is raised.
+    """
+    try:
+        from urllib.error import HTTPError
+    except ImportError:
+        from urllib2 import HTTPError  # suppress(import-error)
+
+    partial = destination + ".part"
+    opener = url_opener()
+    errors = _download_errors()
+    last_error = None
+
+    validator = _saved_validator(partial, url)
+    if validator is None:
+        _remove_if_exists(partial)
+
+    for _ in range(_DOWNLOAD_ATTEMPTS):
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = dict()
+        if offset:
+            headers["Range"] = "bytes={0}-".format(offset)
+            if validator is not None:
+                headers["If-Range"] = validator
+
+        try:
+            with closing(opener(url, headers=headers or None)) as remote:
+                # The server sends everything if it ignored the range
+                # or if the file changed since it was partly downloaded.
+                if remote.getcode() == 206:
+                    mode = "ab"
+                else:
+                    mode = "wb"
+                    validator = _resume_validator(remote.info())
+                    _save_validator(partial, url, validator)
+
+                with open(partial, mode) as local_file:
+                    for chunk in iter(lambda: remote.read(_READ_SIZE), b""):
+                        local_file.write(chunk)
+            break
+        except HTTPError as error:
+            # The partial download is no longer a prefix of what
+            # is at url, so start again.
+            if error.code != 416:
+                raise
+
+            os.remove(partial)
+            last_error = error
+        except errors as error:
+            last_error = error
+    else:
+        raise last_error
+
+    _remove_if_exists(partial + ".validator")
+
+    if digest is not None:
+        try:
+            _check_digest(url,
+                          algorithm,
+                          digest,
+                          _file_digest(partial, algorithm))
+        except RuntimeError:
+            os.remove(partial)
+            raise
+
+    getattr(os, "replace", os.rename)(partial, destination)
+    return destination
+
+
+class _DigestingReader(object):  # suppress(too-few-public-methods)
+    """Wrap a file, updating a digest with everything read from it."""
+
+    def __init__(self, fileobj, digest):
+        """Initialize this reader with fileobj and digest to update."""
+        super(_DigestingReader, self).__init__()
+        self._fileobj = fileobj
+        self.digest = digest
+
+    def read(self, size=-1):
+        """Read up to size bytes from the file."""
+        data = self._fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _strip_components(member, components):
+    """Strip leading components from the paths in the archive member.
+
+    Return False if nothing is left of its path, or if it is absolute
+    or refers to a parent directory, in which case it is not extracted.
+    """
+    parts = member.name.split("/")[components:]
+    if not parts or not parts[0] or ".." in parts:
+        return False
+
+    member.name = "/".join(parts)
+    if member.islnk():
+        member.linkname = "/".join(member.linkname.split("/")[components:])
+
+    return True
+
+
+def _extracts_within(member, directory):
+    """Return True if extracting member can only write inside directory.
+
+    The directory that member is extracted to and, for links, what it
+    links to must both be inside directory, once any symbolic links
+    already extracted there are resolved. Otherwise a symbolic link
+    could be used to write files elsewhere.
+    """
+    root = os.path.join(os.path.realpath(directory), "")
+
+    def _inside(path):
+        """Return True if path resolves to a path inside root."""
+        return os.path.join(os.path.realpath(path), "").startswith(root)
+
+    parent = os.path.join(directory, os.path.dirname(member.name))
+    if not _inside(parent):
+        return False
+
+    if member.issym():
+        return _inside(os.path.join(parent, member.linkname))
+    elif member.islnk():
+        return _inside(os.path.join(directory, member.linkname))
+
+    return True
+
+
+def download_and_extract(url,  # suppress(too-many-arguments)
+                         destination,
+                         digest=None,
+                         algorithm="sha256",
+                         strip_components=0):
+    """Download the tarball at url, extracting it as it arrives.
+
+    The tarball is not written to disk. Instead, it is extracted to a
+    directory next to destination, which replaces destination once the
+    whole tarball was extracted. Like tar, strip_components leading
+    components are removed from the path of each file. Members that
+    would be written outside of destination, including links to files
+    outside of it, are not extracted. If digest is passed, the tarball
+    must have that hex digest using the hashlib algorithm, otherwise
+    RuntimeError is raised. If the connection drops, then the download
+    starts again, since extraction can't be resumed.
+    """
+    import tarfile
+
+    parent = os.path.dirname(os.path.abspath(destination))
+    errors = _download_errors() + (tarfile.ReadError,)
+    last_error = None
+
+    for _ in range(_DOWNLOAD_ATTEMPTS):
+        extracted = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+
+        try:
+            with closing(url_opener()(url)) as remote:
+                reader = _DigestingReader(remote, hashlib.new(algorithm))
+                with tarfile.open(fileobj=reader, mode="r|*") as archive:
+                    for member in archive:
+                        if (_strip_components(member, strip_components) and
+                                _extracts_within(member, extracted)):
+                            archive.extract(member, extracted)
+
+                # Read any padding after the end of the archive, so that
+                # the digest is of the whole download.
+                while reader.read(_READ_SIZE):
+                    pass
+
+            _check_digest(url, algorithm, digest, reader.digest.hexdigest())
+            break
+        except errors as error:
+            force_remove_tree(extracted)
+            last_error = error
+        except Exception:
+            force_remove_tree(extracted)
+            raise
+    else:
+        raise last_error
+
+    if os.path.exists(destination):
+        force_remove_tree(destination)
+
+    os.rename(extracted, destination)
+    return destination
+
+
 def make_executable(path):
     """Make file at path executable."""
     os.chmod(path,
@@ -812,13 +2752,15 @@ def make_meta_container(containers, **kwargs):
 
         def activate(self, util):
             """Activate all containers."""
-            for container in self._sub_containers:
-                container.activate(util)
+            with util.environment_transaction(None):
+                for container in self._sub_containers:
+                    container.activate(util)
 
         def deactivate(self, util):
             """Deactivate all containers."""
-            for container in self._sub_containers:
-                container.deactivate(util)
+            with util.environment_transaction(None):
+                for container in self._sub_containers:
+                    container.deactivate(util)
 
         @contextmanager
         def activated(self, util):
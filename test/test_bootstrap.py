@@ -7,6 +7,10 @@
 
 import errno
 
+import importlib
+
+import json
+
 import os
 
 import shutil
@@ -15,8 +19,12 @@ import subprocess
 
 import sys
 
+import tarfile
+
 import tempfile
 
+import threading
+
 from contextlib import contextmanager
 
 # We depend on the implicit setting of
@@ -27,9 +35,16 @@ from test import testutil
 import ciscripts.bootstrap as bootstrap
 import ciscripts.util as util
 
+from mock import Mock
+
 from nose_parameterized import param, parameterized
 
-from testtools import TestCase
+from six.moves import BaseHTTPServer  # suppress(import-error)
+from six.moves import socketserver  # suppress(import-error)
+from six.moves.urllib.error import (HTTPError,  # suppress(import-error)
+                                    URLError)
+
+from testtools import ExpectedException, TestCase
 from testtools.matchers import (Contains,
                                 DirExists,
                                 FileContains,
@@ -101,6 +116,41 @@ def removable_container_dir(directory_name):
         util.force_remove_tree(os.path.join(current_cwd, directory_name))
 
 
+def _container_for_scripts_version(server, sha1, keep=3, **kwargs):
+    """Create a container in the current directory for scripts at sha1.
+
+    The server at :server: will respond to the stale check with sha1.
+    """
+    with open(os.path.join(server[0], "HEAD"), "w") as head_file:
+        head_file.write(json.dumps({"sha": sha1}))
+
+    return _container_with_scripts(sha1,
+                                   stale_check=server[1] + "/HEAD",
+                                   keep_script_versions=keep,
+                                   **kwargs)
+
+
+def _container_with_scripts(sha1, **kwargs):
+    """Create a container in the current directory with scripts at sha1."""
+    scripts_dir = os.path.join("container", "_scripts", sha1, "ciscripts")
+    bootstrap.force_mkdir(scripts_dir)
+    shutil.copyfile(os.path.join(os.path.dirname(bootstrap.__file__),
+                                 "bootstrap.py"),
+                    os.path.join(scripts_dir, "bootstrap.py"))
+
+    printer = bootstrap.escaped_printer_with_character("\\")
+    shell = bootstrap.BashParentEnvironment(printer)
+    return bootstrap.ContainerDir(shell, directory="container", **kwargs)
+
+
+def _load_in_other_container(script):
+    """Load script in another ContainerDir for the same container."""
+    shell = bootstrap.BashParentEnvironment(lambda _: None)
+    bootstrap.ContainerDir(shell,
+                           directory="container",
+                           stale_check=None).fetch_and_import(script)
+
+
 class TrackedLoadedModulesTestCase(TestCase):
     """Test case that tracks loaded modules and unloads them as appropriate."""
 
@@ -218,6 +268,428 @@ class TestContainerDir(TrackedLoadedModulesTestCase):
                     self.note_loaded_module_path(container, module, domain)
                     self.assertEqual(1, imported_module.CONSTANT)
 
+    def test_loaded_script_bytecode_cached(self):
+        """Bytecode for a loaded script is kept in the container."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with removable_container_dir("container") as container:
+                module_path = container.script_path("cached.py").fs_path
+                with bootstrap.open_and_force_mkdir(module_path, "w") as f:
+                    f.write("CONSTANT = 1")
+
+                container.fetch_and_import("cached.py")
+                self.note_loaded_module_path(container,
+                                             "cached.py",
+                                             "raw.githubusercontent.com")
+
+                self.assertEqual(len(os.listdir(os.path.join(container.path(),
+                                                             "_cache",
+                                                             "bytecode"))),
+                                 1)
+
+    def test_cached_bytecode_used_for_unchanged_script(self):
+        """Script is not compiled again if its bytecode is cached."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with removable_container_dir("container") as container:
+                module_path = container.script_path("cached.py").fs_path
+                with bootstrap.open_and_force_mkdir(module_path, "w") as f:
+                    f.write("CONSTANT = 1")
+
+                _load_in_other_container("cached.py")
+
+                self.patch(bootstrap,
+                           "compile",
+                           Mock(side_effect=AssertionError("Compiled")))
+                module = container.fetch_and_import("cached.py")
+                self.note_loaded_module_path(container,
+                                             "cached.py",
+                                             "raw.githubusercontent.com")
+                self.assertEqual(module.CONSTANT, 1)
+
+    def test_same_script_in_other_path_shares_bytecode(self):
+        """Bytecode is shared by scripts with the same contents."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            bytecode_dir = tempfile.mkdtemp(dir=os.getcwd())
+            paths = [os.path.join(os.getcwd(), v, "cached.py")
+                     for v in ("sha1", "sha2")]
+            codes = [bootstrap._compile_cached(path,
+                                               bytecode_dir,
+                                               b"CONSTANT = 1")
+                     for path in paths]
+
+            self.assertEqual((len(os.listdir(bytecode_dir)),
+                              [code.co_filename for code in codes]),
+                             (1, paths))
+
+    def test_changed_script_compiled_again(self):
+        """Script is compiled again if its contents change."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with removable_container_dir("container") as container:
+                module_path = container.script_path("cached.py").fs_path
+                with bootstrap.open_and_force_mkdir(module_path, "w") as f:
+                    f.write("CONSTANT = 1")
+
+                _load_in_other_container("cached.py")
+
+                with open(module_path, "w") as f:
+                    f.write("CONSTANT = 2")
+
+                module = container.fetch_and_import("cached.py")
+                self.note_loaded_module_path(container,
+                                             "cached.py",
+                                             "raw.githubusercontent.com")
+                self.assertEqual(module.CONSTANT, 2)
+
+    def test_prefetch_scripts_concurrently(self):
+        """Prefetch many scripts without importing them."""
+        modules = ["toplevel.py", "nested/nested.py"]
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                for module in modules:
+                    module_path = os.path.join(server[0], module)
+                    with bootstrap.open_and_force_mkdir(module_path,
+                                                        "w") as mfile:
+                        mfile.write("CONSTANT = 1")
+
+                with removable_container_dir("container") as container:
+                    container.prefetch_scripts(modules, server[1], jobs=2)
+
+                    for module in modules:
+                        self.assertThat(container.script_path(module).fs_path,
+                                        FileContains("CONSTANT = 1"))
+
+    def test_prefetch_scripts_from_archive(self):
+        """Prefetch the entire ciscripts tree from an archive."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                module_path = os.path.join(server[0],
+                                           "repo-sha1",
+                                           "ciscripts",
+                                           "nested",
+                                           "nested.py")
+                with bootstrap.open_and_force_mkdir(module_path,
+                                                    "w") as mfile:
+                    mfile.write("CONSTANT = 1")
+
+                archive_path = os.path.join(server[0], "archive.tar.gz")
+                with tarfile.open(archive_path, "w:gz") as archive:
+                    archive.add(os.path.join(server[0], "repo-sha1"),
+                                arcname="repo-sha1")
+
+                with removable_container_dir("container") as container:
+                    url = "http://{0}/archive.tar.gz".format(server[1])
+                    container.prefetch_scripts(archive_url=url)
+                    path = container.script_path("nested/nested.py").fs_path
+                    self.assertThat(path, FileContains("CONSTANT = 1"))
+
+    def test_truncated_scripts_archive_not_used(self):
+        """A truncated archive is reported as not fetched."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                module_path = os.path.join(server[0],
+                                           "repo-sha1",
+                                           "ciscripts",
+                                           "nested.py")
+                with bootstrap.open_and_force_mkdir(module_path,
+                                                    "w") as mfile:
+                    mfile.write("CONSTANT = 1\n" * 4096)
+
+                archive_path = os.path.join(server[0], "archive.tar.gz")
+                with tarfile.open(archive_path, "w:gz") as archive:
+                    archive.add(os.path.join(server[0], "repo-sha1"),
+                                arcname="repo-sha1")
+
+                with open(archive_path, "rb") as archive_file:
+                    contents = archive_file.read()
+
+                with open(archive_path, "wb") as archive_file:
+                    archive_file.write(contents[:len(contents) // 2])
+
+                url = "http://{0}/archive.tar.gz".format(server[1])
+                self.assertFalse(bootstrap._fetch_scripts_archive("scripts",
+                                                                  url))
+
+    def test_error_fetching_scripts_concurrently_raised(self):
+        """An error fetching a script on another thread is raised."""
+        self.patch(bootstrap,
+                   "_fetch_script",
+                   Mock(side_effect=RuntimeError("fetch failed")))
+        self.assertRaises(RuntimeError,
+                          bootstrap._fetch_scripts_concurrently,
+                          [("info", "path")] * 2,
+                          "domain",
+                          "urlpath",
+                          2)
+
+    def test_import_prefetched_scripts_from_bundle(self):
+        """Scripts prefetched from an archive are imported from a bundle."""
+        self.patch(sys, "meta_path", list(sys.meta_path))
+
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                module_path = os.path.join(server[0],
+                                           "repo-sha1",
+                                           "ciscripts",
+                                           "nested",
+                                           "nested.py")
+                with bootstrap.open_and_force_mkdir(module_path,
+                                                    "w") as mfile:
+                    mfile.write("CONSTANT = 1")
+
+                archive_path = os.path.join(server[0], "archive.tar.gz")
+                with tarfile.open(archive_path, "w:gz") as archive:
+                    archive.add(os.path.join(server[0], "repo-sha1"),
+                                arcname="repo-sha1")
+
+                with removable_container_dir("container") as container:
+                    url = "http://{0}/archive.tar.gz".format(server[1])
+                    container.prefetch_scripts(archive_url=url)
+                    module = container.fetch_and_import("nested/nested.py")
+                    package = module.__name__.split(".")[0]
+                    for name in (package,
+                                 package + ".nested",
+                                 module.__name__):
+                        self.note_loaded_module(name)
+
+                    self.assertEqual(module.__name__,
+                                     package + ".nested.nested")
+                    self.assertEqual(module.CONSTANT, 1)
+
+    def test_scripts_stored_in_directory_for_version(self):
+        """Scripts for the most recent commit are stored in a version dir."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                container = _container_for_scripts_version(server, "sha1")
+                self.assertThat(os.path.join(container.path(),
+                                             "_scripts",
+                                             "sha1",
+                                             "ciscripts",
+                                             "bootstrap.py"),
+                                FileExists())
+
+    def test_previous_scripts_version_kept(self):
+        """Scripts for recently used versions are kept."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                _container_for_scripts_version(server, "sha1")
+                container = _container_for_scripts_version(server, "sha2")
+                self.assertThat(os.path.join(container.path(),
+                                             "_scripts",
+                                             "sha1"),
+                                DirExists())
+
+    def test_least_recently_used_scripts_version_evicted(self):
+        """Scripts for the least recently used version are removed."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                _container_for_scripts_version(server, "sha1")
+                _container_for_scripts_version(server, "sha2")
+                _container_for_scripts_version(server, "sha1")
+                container = _container_for_scripts_version(server,
+                                                           "sha3",
+                                                           keep=2)
+                self.assertThat(os.path.join(container.path(),
+                                             "_scripts",
+                                             "sha2"),
+                                Not(DirExists()))
+
+    def test_scripts_version_in_use_not_evicted(self):
+        """Scripts for a version still being used are not removed."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                in_use = _container_for_scripts_version(server, "sha1")
+                _container_for_scripts_version(server, "sha2", keep=1)
+                self.assertThat(os.path.join(in_use.path(),
+                                             "_scripts",
+                                             "sha1"),
+                                DirExists())
+
+    def test_legacy_scripts_removed_only_once(self):
+        """Scripts stored before versions were introduced are removed once."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                legacy = os.path.join("container", "_scripts", "ciscripts")
+                bootstrap.force_mkdir(legacy)
+                _container_for_scripts_version(server, "sha1")
+                bootstrap.force_mkdir(legacy)
+                _container_for_scripts_version(server, "sha2")
+                self.assertThat(legacy, DirExists())
+
+    def test_scripts_fetched_from_version_being_used(self):
+        """Scripts are fetched from the version of the scripts being used."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                container = _container_for_scripts_version(server, "sha1")
+                fetch_script = Mock()
+                self.patch(bootstrap, "_fetch_script", fetch_script)
+                container.fetch_script("util.py")
+                self.assertEqual(fetch_script.call_args[0][3],
+                                 "polysquare/polysquare-ci-scripts/"
+                                 "sha1/ciscripts/")
+
+    def test_stale_check_result_reused_within_ttl(self):
+        """Result of the stale check is reused until its TTL expires."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with testutil.server_in_tempdir(os.getcwd(), "server") as server:
+                _container_for_scripts_version(server,
+                                               "sha1",
+                                               stale_check_ttl=600)
+                container = _container_for_scripts_version(server,
+                                                           "sha2",
+                                                           stale_check_ttl=600)
+                self.assertEqual(container.script_path("bootstrap.py").fs_path,
+                                 os.path.join(container.path(),
+                                              "_scripts",
+                                              "sha1",
+                                              "ciscripts",
+                                              "bootstrap.py"))
+
+    def _check_head_in_background(self, fork_result, check_head=None):
+        """Check for the most recent commit in the background.
+
+        os.fork is patched to return fork_result. Returns the result
+        of the check and the Mock standing in for _check_head.
+        """
+        if not hasattr(os, "fork"):
+            self.skipTest("""os.fork is required to run this test.""")
+
+        check_head = check_head or Mock()
+        self.patch(bootstrap, "_check_head", check_head)
+        self.patch(os, "fork", Mock(return_value=fork_result))
+        return (bootstrap._check_head_in_background(os.getcwd(),
+                                                    "stale_check",
+                                                    dict()),
+                check_head)
+
+    def _check_head_as_forked_child(self, check_head=None):
+        """Check for the most recent commit as a forked child would.
+
+        Returns the Mock standing in for _check_head.
+        """
+        check_head = check_head or Mock()
+        self.patch(os, "setsid", Mock())
+        self.patch(os, "dup2", Mock())
+        self.patch(os, "closerange", Mock())
+        self.patch(os, "_exit", Mock(side_effect=SystemExit))
+
+        with ExpectedException(SystemExit):
+            self._check_head_in_background(0, check_head)
+
+        return check_head
+
+    def test_background_stale_check_made_once_at_a_time(self):
+        """No check is started while another is still running."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with open(os.path.join(os.getcwd(),
+                                   "head.json.lock"), "a") as lock_file:
+                self.assertTrue(bootstrap._try_lock_file(lock_file))
+                self.assertTrue(self._check_head_in_background(0)[0])
+
+            self.assertEqual(os.fork.call_count, 0)
+
+    def test_background_stale_check_made_in_own_session(self):
+        """Child checks for the most recent commit in its own session."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            check_head = self._check_head_as_forked_child()
+
+            self.assertEqual((os.setsid.call_count,
+                              check_head.call_count,
+                              os._exit.call_args[0]),
+                             (1, 1, (0,)))
+
+    def test_background_stale_check_error_not_hidden(self):
+        """Child exits with an error status if the check fails."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            captured_output = testutil.CapturedOutput()
+            with captured_output:
+                self._check_head_as_forked_child(
+                    Mock(side_effect=RuntimeError("""Check failed"""))
+                )
+
+            self.assertEqual((os._exit.call_args[0],
+                              "Check failed" in captured_output.stderr),
+                             ((1,), True))
+
+    def test_background_stale_check_output_printed_next_time(self):
+        """Output of the last background check is printed afterwards."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with open("head.json.log", "w") as log_file:
+                log_file.write("Check failed\n")
+
+            captured_output = testutil.CapturedOutput()
+            with captured_output:
+                self._check_head_in_background(1)
+
+            self.assertEqual((captured_output.stderr,
+                              os.path.exists("head.json.log")),
+                             ("Check failed\n", False))
+
+    def test_stale_check_revalidated_with_etag(self):
+        """Stale check is revalidated with the ETag of the last check."""
+        requests = list()
+
+        def fetch(client, url, headers=None, **kwargs):
+            """Respond with sha1 and an ETag, then 304 Not Modified."""
+            del client
+            del kwargs
+
+            requests.append(headers)
+            if len(requests) == 1:
+                return (b"{\"sha\": \"sha1\"}", {"ETag": "etag"})
+
+            raise HTTPError(url, 304, "Not Modified", dict(), None)
+
+        self.patch(bootstrap.HTTPClient, "fetch", fetch)
+
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            _container_with_scripts("sha1", stale_check="example.com/HEAD")
+            container = _container_with_scripts("sha1",
+                                                stale_check="example.com/HEAD")
+            self.assertEqual(requests[1], {"If-None-Match": "etag"})
+            self.assertThat(os.path.join(container.path(),
+                                         "_scripts",
+                                         "sha1"),
+                            DirExists())
+
+    def test_lock_excludes_other_holders(self):
+        """Lock is only acquired once the current holder releases it."""
+        acquired = threading.Event()
+
+        def take_lock(container):
+            """Take the lock and note that it was acquired."""
+            with container.lock("name"):
+                acquired.set()
+
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with removable_container_dir("container") as container:
+                with container.lock("name"):
+                    thread = threading.Thread(target=take_lock,
+                                              args=(container, ))
+                    thread.start()
+                    self.assertFalse(acquired.wait(0.2))
+
+                thread.join()
+                self.assertTrue(acquired.is_set())
+
+    def test_concurrent_language_records_kept(self):
+        """Languages recorded concurrently are all kept in the record."""
+        with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
+            with removable_container_dir("container") as container:
+                threads = [threading.Thread(target=container.new_container_for,
+                                            args=("language", str(v)))
+                           for v in range(16)]
+                for thread in threads:
+                    thread.start()
+
+                for thread in threads:
+                    thread.join()
+
+                with open(os.path.join(container.path(),
+                                       "_languages",
+                                       "record")) as record:
+                    self.assertEqual(sorted(record.read().splitlines()),
+                                     sorted(["language-" + str(v)
+                                             for v in range(16)]))
+
     def test_create_named_cache_dir(self):
         """Created named cache directory exists."""
         with testutil.in_tempdir(os.getcwd(), "container_dir_test"):
@@ -271,6 +743,166 @@ class TestContainerDir(TrackedLoadedModulesTestCase):
                                  language_dir)
 
 
+class TestBundleImporter(TestCase):
+    """Test cases for importing scripts from a bundle."""
+
+    def setUp(self):  # suppress(N802)
+        """Create an importer for some scripts and add it to meta_path."""
+        super(TestBundleImporter, self).setUp()
+        self.patch(sys, "meta_path", list(sys.meta_path))
+        self._bytecode_dir = tempfile.mkdtemp(dir=os.getcwd())
+        self.addCleanup(util.force_remove_tree, self._bytecode_dir)
+        self._importer = bootstrap.BundleImporter({
+            "toplevel.py": b"CONSTANT = 1",
+            "nested/nested.py": (b"from . import sibling\n"
+                                 b"CONSTANT = sibling.VALUE\n"),
+            "nested/sibling.py": b"VALUE = 2"
+        }, os.path.join(os.getcwd(), "bundle.zip"), self._bytecode_dir)
+        bootstrap._install_bundle_importer(  # suppress(PYC70)
+            self._importer
+        )
+        self.addCleanup(self._unload_bundle_modules)
+
+    def _unload_bundle_modules(self):
+        """Remove any modules imported from the bundle."""
+        for name in list(sys.modules.keys()):
+            if name.split(".")[0] == self._importer.package:
+                del sys.modules[name]
+
+    @parameterized.expand([
+        param("toplevel.py", 1),
+        param("nested/nested.py", 2)
+    ])
+    def test_import_module_in_bundle(self, script, value):
+        """Import a script in the bundle."""
+        module = importlib.import_module(self._importer.module_name(script))
+        self.assertEqual(module.CONSTANT, value)
+
+    def test_load_module_with_pep302_protocol(self):
+        """Load a script using find_module and load_module."""
+        name = self._importer.module_name("toplevel.py")
+        module = self._importer.find_module(name).load_module(name)
+        self.assertEqual(module.CONSTANT, 1)
+
+    def test_script_not_in_bundle(self):
+        """Scripts not in the bundle have no module name."""
+        self.assertEqual(self._importer.module_name("missing.py"), None)
+
+    def test_importer_installed_once(self):
+        """Importer for the same bundle is only added to meta_path once."""
+        other = bootstrap.BundleImporter(dict(),
+                                         os.path.join(os.getcwd(),
+                                                      "bundle.zip"),
+                                         self._bytecode_dir)
+        installed = bootstrap._install_bundle_importer(  # suppress(PYC70)
+            other
+        )
+        self.assertIs(installed, self._importer)
+
+
+@contextmanager
+def _responding_server(responses, received_headers=None):
+    """Serve each (status, body) in responses over keep-alive connections.
+
+    Yields the address of the server and a list of the client ports that
+    each request was made from. If :received_headers: is passed, the
+    headers of each request are appended to it.
+    """
+    ports = list()
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Respond with the next response in responses."""
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):  # suppress(N802)
+            """Respond with the next status and body."""
+            ports.append(self.client_address[1])
+            if received_headers is not None:
+                received_headers.append(dict(self.headers.items()))
+
+            status, body = responses.pop(0)
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # suppress(arguments-differ)
+            """Don't log anything."""
+            del args
+
+    class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        """A server that handles each connection in its own thread."""
+
+        daemon_threads = True
+
+    server = Server(("localhost", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    try:
+        yield ("http://{0}:{1}".format(*server.server_address), ports)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class TestHTTPClient(TestCase):
+    """Test cases for the shared HTTP client."""
+
+    def test_connection_kept_alive_between_requests(self):
+        """Second request to the same host re-uses the first connection."""
+        with _responding_server([(200, b"a"), (200, b"b")]) as (url, ports):
+            client = bootstrap.HTTPClient()
+            self.assertEqual(client.fetch(url + "/a")[0], b"a")
+            self.assertEqual(client.fetch(url + "/b")[0], b"b")
+            self.assertEqual(ports[0], ports[1])
+
+    def test_server_errors_retried(self):
+        """Responses with status 5xx are retried."""
+        responses = [(503, b""), (500, b""), (200, b"ok")]
+        with _responding_server(responses) as (url, _):
+            client = bootstrap.HTTPClient(backoff=0)
+            self.assertEqual(client.fetch(url)[0], b"ok")
+            self.assertEqual(client.statistics["retries"], 2)
+
+    def test_client_errors_not_retried(self):
+        """Responses with status 4xx raise HTTPError immediately."""
+        responses = [(404, b""), (200, b"ok")]
+        with _responding_server(responses) as (url, _):
+            client = bootstrap.HTTPClient(backoff=0)
+            self.assertRaises(HTTPError, client.fetch, url)
+
+            self.assertEqual(client.statistics["retries"], 0)
+
+    def test_gives_up_after_retries(self):
+        """URLError raised once there are no retries left."""
+        with _responding_server([(500, b"")] * 3) as (url, _):
+            client = bootstrap.HTTPClient(retries=2, backoff=0)
+            self.assertRaises(URLError, client.fetch, url)
+
+            self.assertEqual(client.statistics["failures"], 1)
+
+    def test_user_agent_sent(self):
+        """Requests are made with a User-Agent header."""
+        received_headers = list()
+        with _responding_server([(200, b"ok")],
+                                received_headers) as (url, _):
+            bootstrap.HTTPClient().fetch(url)
+
+        self.assertThat(received_headers[0], Contains("User-Agent"))
+
+    def test_failed_stale_check_reported(self):
+        """Failure to fetch the most recent sha1 is reported on stderr."""
+        captured_output = testutil.CapturedOutput()
+        with _responding_server([(403, b"")]) as (url, _):
+            with captured_output:
+                self.assertEqual(bootstrap._fetch_sha1(url), (None, None))
+
+        self.assertThat(captured_output.stderr, Contains("403"))
+
+
 class TestBashParentEnvironment(TestCase):
     """Test cases for specific functionality in bash parent environment."""
 
@@ -574,6 +1206,29 @@ def _write_setup_script(script_contents):
     return "setup/test/setup.py"
 
 
+def _run_bootstrap_with_daemon(container_dir, *argv):
+    """Run bootstrap in a subprocess with --daemon, returning its output.
+
+    Returns a tuple of the exit code and standard output.
+    """
+    scripts_dir = os.path.join(container_dir, "_scripts")
+    process = subprocess.Popen([sys.executable,
+                                os.path.join(scripts_dir,
+                                             "ciscripts",
+                                             "bootstrap.py"),
+                                "-d",
+                                container_dir,
+                                "-r",
+                                scripts_dir,
+                                "--keep-scripts",
+                                "--daemon",
+                                "-s",
+                                "setup/test/setup.py"] + list(argv),
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0].decode("utf-8")
+    return (process.returncode, output)
+
+
 class TestMain(TrackedLoadedModulesTestCase):
     """Test cases for creating containers on the command line."""
 
@@ -599,6 +1254,129 @@ class TestMain(TrackedLoadedModulesTestCase):
 
         write_bootstrap_script_into_container(self._container_dir)
 
+    def _stop_daemon(self, pid):
+        """Stop the daemon with pid once the test is complete."""
+        import signal
+
+        self.addCleanup(os.kill, pid, signal.SIGTERM)
+
+    def test_scripts_run_in_same_daemon(self):
+        """Scripts run with --daemon are run in the same process."""
+        if not bootstrap._daemon_supported():  # suppress(PYC70)
+            self.skipTest("""Daemon not supported on this platform""")
+
+        _write_setup_script("import os\n"
+                            "def run(cont, util, sh, argv):\n"
+                            "    print(os.getpid())\n")
+
+        first = _run_bootstrap_with_daemon(self._container_dir)
+        self._stop_daemon(int(first[1].split()[0]))
+        second = _run_bootstrap_with_daemon(self._container_dir)
+
+        self.assertEqual(first[1].split()[0], second[1].split()[0])
+
+    def test_daemon_forgets_completed_tasks_between_requests(self):
+        """Results of tasks completed by one request aren't seen by another."""
+        if not bootstrap._daemon_supported():  # suppress(PYC70)
+            self.skipTest("""Daemon not supported on this platform""")
+
+        _write_setup_script("import os\n"
+                            "def run(cont, util, sh, argv):\n"
+                            "    print(os.getpid())\n"
+                            "    print(util.already_completed('task'))\n"
+                            "    util.register_result('task', 'done')\n")
+
+        first = _run_bootstrap_with_daemon(self._container_dir)
+        self._stop_daemon(int(first[1].split()[0]))
+        second = _run_bootstrap_with_daemon(self._container_dir)
+
+        self.assertNotIn("done", second[1])
+
+    def test_daemon_serves_others_after_stalled_client(self):
+        """A client which never sends its request doesn't block others."""
+        if not bootstrap._daemon_supported():  # suppress(PYC70)
+            self.skipTest("""Daemon not supported on this platform""")
+
+        import socket
+
+        _write_setup_script("import os\n"
+                            "def run(cont, util, sh, argv):\n"
+                            "    print(os.getpid())\n")
+
+        first = _run_bootstrap_with_daemon(self._container_dir)
+        self._stop_daemon(int(first[1].split()[0]))
+
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(stalled.close)
+        stalled.connect(bootstrap._daemon_socket_path(self._container_dir))
+
+        second = _run_bootstrap_with_daemon(self._container_dir)
+        self.assertEqual(first[1].split()[0], second[1].split()[0])
+
+    def _handle_daemon_request(self, python, disconnect=False):
+        """Make a request for python to the daemon and handle it.
+
+        If :disconnect: is True, the client disconnects before the daemon
+        replies. Returns the result of handling the request and the reply.
+        """
+        if not bootstrap._daemon_supported():  # suppress(PYC70)
+            self.skipTest("""Daemon not supported on this platform""")
+
+        import array
+        import socket
+
+        client, server = socket.socketpair(socket.AF_UNIX,
+                                           socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+
+        with open(os.devnull, "r+") as devnull:
+            client.sendmsg([b"\0"],
+                           [(socket.SOL_SOCKET,
+                             socket.SCM_RIGHTS,
+                             array.array("i", [devnull.fileno()] * 3))])
+
+        bootstrap._send_message(client, {
+            "argv": list(),
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+            "bootstrap": bootstrap._bootstrap_script_path(),
+            "python": python
+        })
+
+        if disconnect:
+            client.close()
+            return (bootstrap._handle_daemon_request(server), None)
+
+        return (bootstrap._handle_daemon_request(server),
+                bootstrap._read_message(client))
+
+    def test_daemon_rejects_client_using_other_python(self):
+        """Daemon turns away clients running under a different python."""
+        self.assertEqual(self._handle_daemon_request(["python", "0.0"]),
+                         (True, {"rejected": True}))
+
+    def test_daemon_survives_client_disconnecting(self):
+        """Daemon carries on if a client disconnects before its reply."""
+        self.assertEqual(self._handle_daemon_request(["python", "0.0"],
+                                                     disconnect=True),
+                         (True, None))
+
+    def test_daemon_returns_exit_status(self):
+        """Exit status of scripts run in the daemon is returned."""
+        if not bootstrap._daemon_supported():  # suppress(PYC70)
+            self.skipTest("""Daemon not supported on this platform""")
+
+        _write_setup_script("import os\n"
+                            "def run(cont, util, sh, argv):\n"
+                            "    print(os.getpid())\n"
+                            "    cont.note_failure(True)\n")
+
+        status, output = _run_bootstrap_with_daemon(self._container_dir)
+        self._stop_daemon(int(output.split()[0]))
+
+        self.assertEqual(status, 1)
+
     def test_create_dir_and_pass_control_to_script(self):
         """Test creating a container and passing control to a script."""
         _write_setup_script("def run(cont, util, sh, argv):\n"
@@ -615,6 +1393,49 @@ class TestMain(TrackedLoadedModulesTestCase):
 
         self.assertEqual(captured_output.stdout, "Hello\n\n")
 
+    def test_timings_written_as_json(self):
+        """Time taken by each phase and import is written as JSON."""
+        _write_setup_script("def run(cont, util, sh, argv):\n"
+                            "    pass\n")
+
+        with testutil.CapturedOutput():
+            bootstrap.main(["-d",
+                            self._container_dir,
+                            "-s",
+                            "setup/test/setup.py",
+                            "--keep-scripts",
+                            "--timings",
+                            "timings.json"])
+
+        with open("timings.json") as timings_file:
+            timings = json.load(timings_file)
+
+        self.assertThat([p["name"] for p in timings["phases"]],
+                        Contains("run setup/test/setup.py"))
+        self.assertThat([i["name"] for i in timings["imports"]],
+                        Contains("setup/test/setup.py"))
+
+    def test_timings_include_http_requests(self):
+        """HTTP requests made while running the script are counted."""
+        bootstrap.http_client().statistics["requests"] += 1
+        _write_setup_script("def run(cont, util, sh, argv):\n"
+                            "    util.HTTP_CLIENT.statistics['requests'] "
+                            "+= 2\n")
+
+        with testutil.CapturedOutput():
+            bootstrap.main(["-d",
+                            self._container_dir,
+                            "-s",
+                            "setup/test/setup.py",
+                            "--keep-scripts",
+                            "--timings",
+                            "timings.json"])
+
+        with open("timings.json") as timings_file:
+            timings = json.load(timings_file)
+
+        self.assertEqual(timings["http"]["requests"], 2)
+
     def test_create_dir_and_pass_args_to_script(self):
         """Test creating a container and passing arguments to a script."""
         _write_setup_script("def run(cont, util, sh, argv):\n"
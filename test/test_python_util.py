@@ -5,6 +5,8 @@
 # See /LICENCE.md for Copyright information
 """Test cases for the functions in ciscripts/python_util.py."""
 
+import os
+
 import sys
 
 import ciscripts.python_util as python_util
@@ -62,3 +64,30 @@ class TestDetermineIfPythonModulesAvailable(TestCase):
         python_util.run_if_module_unavailable("sys", mock)
 
         mock.assert_not_called()  # suppress(PYC70)
+
+
+class TestPipInstallDepsTask(TestCase):
+    """Test cases for remembering that dependencies were installed."""
+
+    def test_fingerprint_covers_options(self):
+        """Installing with other options changes the fingerprint."""
+        fingerprints = [python_util._pip_install_deps_task(util,
+                                                           "python",
+                                                           "test",
+                                                           (),
+                                                           kwargs)[1]
+                        for kwargs in (dict(), {"upgrade": True})]
+        self.assertNotEqual(fingerprints[0], fingerprints[1])
+
+    def test_python_outside_container_detected(self):
+        """Only a python inside the container is in the container."""
+        cont = Mock(path=Mock(return_value=os.path.join(os.sep,
+                                                        "container")))
+        self.assertEqual([python_util._is_in_container(cont, p)
+                          for p in (os.path.join(os.sep,
+                                                 "container",
+                                                 "python"),
+                                    os.path.join(os.sep,
+                                                 "container-other",
+                                                 "python"))],
+                         [True, False])
@@ -9,22 +9,30 @@ import doctest
 
 import hashlib
 
+import io
+
 import os
 
 import platform
 
+import select
+
 import stat
 
 import subprocess
 
 import sys
 
+import tarfile
+
 import tempfile
 
 import time
 
 from collections import namedtuple
 
+from contextlib import contextmanager
+
 from test import testutil
 
 import ciscripts.util as util
@@ -42,6 +50,7 @@ from testtools.matchers import (Contains,
                                 DocTestMatches,
                                 Equals,
                                 GreaterThan,
+                                LessThan,
                                 MatchesAll,
                                 MatchesAny,
                                 Not)
@@ -242,6 +251,197 @@ class TestOverwriteEnvironmentVariables(OverwrittenEnvironmentVarsTestCase):
                         MatchesAll(Not(Contains("VALUE")),
                                    Contains("SECOND_VALUE")))
 
+    @parameterized.expand(PARENT_ENVIRONMENTS)
+    def test_remove_many_values_from_environment_variable(self, config):
+        """Remove many values from a value list in parent shell at once."""
+        self._require(config.shell)
+
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.overwrite_environment_variable(config.parent, "VAR", "VALUE")
+            util.prepend_environment_variable(config.parent,
+                                              "VAR",
+                                              "SECOND_VALUE")
+            util.prepend_environment_variable(config.parent,
+                                              "VAR",
+                                              "THIRD_VALUE")
+
+        removal_output = testutil.CapturedOutput()
+        with removal_output:
+            util.remove_from_environment_variable(config.parent,
+                                                  "VAR",
+                                                  "VALUE",
+                                                  "THIRD_VALUE")
+
+        self.assertEqual(len(removal_output.stdout.strip().splitlines()), 1)
+
+        parent_env_value = _get_parent_env_value(config,
+                                                 captured_output.stdout +
+                                                 removal_output.stdout,
+                                                 "VAR")
+        self.assertEqual(parent_env_value.strip().split(config.sep),
+                         ["SECOND_VALUE"])
+
+    @parameterized.expand(PARENT_ENVIRONMENTS)
+    def test_parent_removes_value_from_environment_variable(self, config):
+        """Parent shell removes a value from a list with one overwrite."""
+        self._require(config.shell)
+
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.overwrite_environment_variable(config.parent, "VAR", "VALUE")
+            util.prepend_environment_variable(config.parent,
+                                              "VAR",
+                                              "SECOND_VALUE")
+
+        removal_output = testutil.CapturedOutput()
+        with removal_output:
+            config.parent.remove_from_environment_variable("VAR", "VALUE")
+
+        self.assertEqual(len(removal_output.stdout.strip().splitlines()), 1)
+
+        parent_env_value = _get_parent_env_value(config,
+                                                 captured_output.stdout +
+                                                 removal_output.stdout,
+                                                 "VAR")
+        self.assertEqual(parent_env_value.strip().split(config.sep),
+                         ["SECOND_VALUE"])
+
+
+class TestEnvironmentTransaction(OverwrittenEnvironmentVarsTestCase):
+    """Test case for util.environment_transaction."""
+
+    def test_changes_applied_when_transaction_finishes(self):
+        """Changes are only made to os.environ when transaction finishes."""
+        with util.environment_transaction(Mock()) as environment:
+            environment.overwrite("VAR", "VALUE")
+            self.assertEqual(environment.get("VAR"), "VALUE")
+            self.assertNotIn("VAR", os.environ)
+
+        self.assertEqual(os.environ["VAR"], "VALUE")
+
+    def test_only_final_value_written_to_parent(self):
+        """Only the final value of each key is written to parent."""
+        parent = Mock()
+        with util.environment_transaction(parent) as environment:
+            environment.overwrite("VAR", "FIRST")
+            environment.overwrite("VAR", "SECOND")
+
+        parent.overwrite_environment_variable.assert_called_once_with(
+            "VAR",
+            "SECOND"
+        )
+
+    def test_undone_changes_not_written(self):
+        """Keys which end up with their original value are not written."""
+        os.environ["VAR"] = "VALUE"
+        parent = Mock()
+        with util.environment_transaction(parent) as environment:
+            environment.prepend("VAR", "PREPENDED")
+            environment.remove("VAR", "PREPENDED")
+
+        self.assertEqual(parent.mock_calls, [])
+        self.assertEqual(os.environ["VAR"], "VALUE")
+
+    def test_prepended_values_written_as_prepend(self):
+        """Values put in front of original value are prepended in parent."""
+        os.environ["VAR"] = "VALUE"
+        parent = Mock()
+        with util.environment_transaction(parent) as environment:
+            environment.prepend("VAR", "FIRST")
+            environment.prepend("VAR", "SECOND")
+
+        parent.prepend_environment_variable.assert_called_once_with(
+            "VAR",
+            os.pathsep.join(["SECOND", "FIRST"])
+        )
+
+    def test_nested_transaction_applied_by_outermost(self):
+        """Nested transactions are applied when the outermost finishes."""
+        parent = Mock()
+        with util.environment_transaction(None):
+            with util.environment_transaction(parent) as environment:
+                environment.overwrite("VAR", "VALUE")
+
+            self.assertNotIn("VAR", os.environ)
+
+        self.assertEqual(os.environ["VAR"], "VALUE")
+        parent.overwrite_environment_variable.assert_called_once_with(
+            "VAR",
+            "VALUE"
+        )
+
+    def test_nothing_applied_on_exception(self):
+        """No changes are applied if an exception is raised."""
+        parent = Mock()
+        with ExpectedException(RuntimeError):
+            with util.environment_transaction(parent) as environment:
+                environment.overwrite("VAR", "VALUE")
+                raise RuntimeError("""Failure""")
+
+        self.assertNotIn("VAR", os.environ)
+        self.assertEqual(parent.mock_calls, [])
+
+
+class PrependingContainer(object):  # suppress(too-few-public-methods)
+    """Stands in for a container which prepends value to VAR."""
+
+    def __init__(self, parent, value):
+        """Initialize this container, prepending value in parent."""
+        super(PrependingContainer, self).__init__()
+        self._parent = parent
+        self._value = value
+
+    @contextmanager
+    def activated(self, util_module):
+        """Proceed with value prepended to VAR."""
+        if self._value is None:
+            raise RuntimeError("""Activation failed""")
+
+        with util_module.environment_transaction(self._parent) as env:
+            env.prepend("VAR", self._value)
+
+        try:
+            yield
+        finally:
+            with util_module.environment_transaction(self._parent) as env:
+                env.remove("VAR", self._value)
+
+
+class TestActivated(OverwrittenEnvironmentVarsTestCase):
+    """Test case for util.activated."""
+
+    def test_activations_applied_together(self):
+        """Changes made to activate several containers are applied once."""
+        os.environ["VAR"] = "VALUE"
+        parent = Mock()
+        with util.activated(PrependingContainer(parent, "FIRST"),
+                            PrependingContainer(parent, "SECOND")):
+            self.assertEqual(os.environ["VAR"],
+                             os.pathsep.join(["SECOND", "FIRST", "VALUE"]))
+
+        self.assertEqual(os.environ["VAR"], "VALUE")
+        parent.prepend_environment_variable.assert_called_once_with(
+            "VAR",
+            os.pathsep.join(["SECOND", "FIRST"])
+        )
+        parent.overwrite_environment_variable.assert_called_once_with(
+            "VAR",
+            "VALUE"
+        )
+
+    def test_nothing_applied_if_activation_fails(self):
+        """No changes are applied if a container fails to activate."""
+        os.environ["VAR"] = "VALUE"
+        parent = Mock()
+        with ExpectedException(RuntimeError):
+            with util.activated(PrependingContainer(parent, "FIRST"),
+                                PrependingContainer(parent, None)):
+                pass
+
+        self.assertEqual(os.environ["VAR"], "VALUE")
+        self.assertEqual(parent.mock_calls, [])
+
 
 class TestTask(TestCase):
     """Test case for util.Task."""
@@ -362,6 +562,74 @@ class TestExecute(TestCase):
         self.assertThat(captured_output.stderr.strip(),
                         Contains("/does-not-exist"))
 
+    def test_output_captured_in_container_on_failure(self):
+        """Keep output of failed process in container, showing its path."""
+        self.patch(os, "environ", os.environ.copy())
+        os.environ.pop("POLYSQUARE_ALWAYS_PRINT_PROCESS_OUTPUT", None)
+
+        with testutil.in_tempdir(os.getcwd(), "capture") as temp_dir:
+            container = Mock()
+            container.named_cache_dir.return_value = temp_dir
+
+            captured_output = testutil.CapturedOutput()
+            with captured_output:
+                util.execute(container,
+                             util.output_on_fail,
+                             "python",
+                             "-c",
+                             "import sys; print('output'); sys.exit(1)")
+
+            logs = [os.path.join(temp_dir, p) for p in os.listdir(temp_dir)]
+            self.assertEqual(len(logs), 1)
+            with open(logs[0]) as log_file:
+                self.assertEqual(log_file.read().strip(), "output")
+
+        self.assertThat(captured_output.stderr,
+                        MatchesAll(Contains("output"), Contains(logs[0])))
+
+    def test_output_not_kept_on_success(self):
+        """Remove captured output of a successful process."""
+        self.patch(os, "environ", os.environ.copy())
+        os.environ.pop("POLYSQUARE_ALWAYS_PRINT_PROCESS_OUTPUT", None)
+
+        with testutil.in_tempdir(os.getcwd(), "capture") as temp_dir:
+            container = Mock()
+            container.named_cache_dir.return_value = temp_dir
+
+            util.execute(container,
+                         util.output_on_fail,
+                         "python",
+                         "-c",
+                         "print('output')")
+
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_only_end_of_failure_output_shown(self):
+        """Only show the last lines of output when a process fails."""
+        self.patch(os, "environ", os.environ.copy())
+        os.environ.pop("POLYSQUARE_ALWAYS_PRINT_PROCESS_OUTPUT", None)
+        os.environ["POLYSQUARE_FAILURE_OUTPUT_LINES"] = "2"
+
+        with testutil.in_tempdir(os.getcwd(), "capture") as temp_dir:
+            container = Mock()
+            container.named_cache_dir.return_value = temp_dir
+
+            captured_output = testutil.CapturedOutput()
+            with captured_output:
+                util.execute(container,
+                             util.output_on_fail,
+                             "python",
+                             "-c",
+                             "import sys\n"
+                             "for i in range(10):\n"
+                             "    print('line {0}'.format(i))\n"
+                             "sys.exit(1)")
+
+        self.assertThat(captured_output.stderr,
+                        MatchesAll(Contains("line 8"),
+                                   Contains("line 9"),
+                                   Not(Contains("line 7"))))
+
     def test_override_suppressed_output(self):
         """Override suppressed output with environment variable."""
         os.environ["POLYSQUARE_ALWAYS_PRINT_PROCESS_OUTPUT"] = "1"
@@ -439,21 +707,107 @@ class TestExecute(TestCase):
                                        doctest.ELLIPSIS |
                                        doctest.NORMALIZE_WHITESPACE))
 
-    def test_running_stderr_at_end(self):
-        """Execute a command with success, but display stderr at end."""
+    def test_running_output_prints_large_output_indented(self):
+        """Print all of a large output, indenting each line."""
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            with util.Task("Description"):
+                util.execute(Mock(),
+                             util.running_output,
+                             "python",
+                             "-c",
+                             "import sys\n"
+                             "for i in range(50000):\n"
+                             "    sys.stdout.write('%d\\n' % i)")
+
+        lines = captured_output.stderr.replace("\r\n", "\n").splitlines()
+        self.assertEqual([l for l in lines if l.strip()][1:],
+                         ["    {0}".format(i) for i in range(50000)])
+
+    def test_running_stderr_interleaved(self):
+        """Execute a command with success, showing stderr as it arrives."""
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.execute(Mock(),
+                         util.running_output,
+                         "python",
+                         "-c",
+                         "import sys, time; "
+                         "sys.stdout.write('a\\n'); "
+                         "sys.stdout.flush(); "
+                         "time.sleep(0.2); "
+                         "sys.stderr.write('b\\n'); "
+                         "sys.stderr.flush(); "
+                         "time.sleep(0.2); "
+                         "sys.stdout.write('c')")
+
+        self.assertEqual(captured_output.stderr.replace("\r\n", "\n"),
+                         "\na\nb\nc\n")
+
+    def test_running_output_partial_lines_not_mixed(self):
+        """Partial lines from different streams are shown on own lines."""
         captured_output = testutil.CapturedOutput()
         with captured_output:
             util.execute(Mock(),
                          util.running_output,
                          "python",
                          "-c",
-                         "import sys; "
-                         "sys.stdout.write('a\\nb'); "
-                         "sys.stderr.write('c'); "
-                         "sys.stdout.write('d')")
+                         "import sys, time; "
+                         "sys.stdout.write('a'); "
+                         "sys.stdout.flush(); "
+                         "time.sleep(0.2); "
+                         "sys.stderr.write('b\\n'); "
+                         "sys.stderr.flush(); "
+                         "time.sleep(0.2); "
+                         "sys.stdout.write('c\\n')")
 
         self.assertEqual(captured_output.stderr.replace("\r\n", "\n"),
-                         "\na\nbd\nc\n")
+                         "\nb\nac\n\n")
+
+    def test_running_output_long_partial_line_printed(self):
+        """A partial line is printed once it gets too long."""
+        printer = util._OutputPrinter(1)
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            printer.print_chunk(0,
+                                b"a" * util._PARTIAL_LINE_LIMIT,
+                                more_waiting=True)
+
+        self.assertThat(captured_output.stderr,
+                        Contains("a" * util._PARTIAL_LINE_LIMIT))
+
+    def test_running_output_old_partial_line_printed(self):
+        """A partial line is printed after a while, even if output arrives."""
+        now = [0.0]
+        self.patch(util.time, "time", lambda: now[0])
+
+        printer = util._OutputPrinter(1)
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            printer.print_chunk(0, b"a", more_waiting=True)
+            now[0] += util._PARTIAL_LINE_TIMEOUT
+            printer.print_chunk(0, b"b", more_waiting=True)
+            printer.tick()
+
+        self.assertThat(captured_output.stderr, Contains("ab"))
+
+    def test_running_output_with_timestamps(self):
+        """Prefix each line with time since process started if requested."""
+        self.patch(os,
+                   "environ",
+                   dict(os.environ, POLYSQUARE_TIMESTAMP_PROCESS_OUTPUT="1"))
+
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.execute(Mock(),
+                         util.running_output,
+                         "python",
+                         "-c",
+                         "print('a'); print('b')")
+
+        self.assertThat(captured_output.stderr.replace("\r\n", "\n"),
+                        DocTestMatches("\n[...] a\n[...] b\n\n",
+                                       doctest.ELLIPSIS))
 
     def test_running_output_no_double_leading_slash_n(self):
         """Using running_output does not allow double-leading slash-n."""
@@ -490,6 +844,242 @@ class TestExecute(TestCase):
                                    Equals("...")))  # suppress(PYC90)
 
 
+def _python_command(container, output_strategy, code, **kwargs):
+    """Make a command for util.execute_many running code in python."""
+    return util.command(container,
+                        output_strategy,
+                        "python",
+                        "-c",
+                        code,
+                        **kwargs)
+
+
+class TestExecuteMany(TestCase):
+    """Test case for util.execute_many."""
+
+    def test_return_status_of_each_command(self):
+        """Return exit status of each command, in order."""
+        commands = [_python_command(Mock(),
+                                    util.output_on_fail,
+                                    "import sys; sys.exit({0})".format(i))
+                    for i in range(3)]
+
+        with testutil.CapturedOutput():
+            self.assertEqual(util.execute_many(commands), [0, 1, 2])
+
+    def test_commands_run_at_the_same_time(self):
+        """Run commands at the same time, up to the number of jobs."""
+        commands = [_python_command(Mock(),
+                                    util.output_on_fail,
+                                    "import time; time.sleep(1)")
+                    for _ in range(3)]
+
+        started = time.time()
+        util.execute_many(commands, jobs=3)
+        self.assertThat(2.5, GreaterThan(time.time() - started))
+
+    def test_number_of_jobs_limited(self):
+        """Run no more than the number of jobs at once."""
+        commands = [_python_command(Mock(),
+                                    util.output_on_fail,
+                                    "import time; time.sleep(0.5)")
+                    for _ in range(2)]
+
+        started = time.time()
+        util.execute_many(commands, jobs=1)
+        self.assertThat(time.time() - started, GreaterThan(1))
+
+    def test_output_of_each_command_printed_together(self):
+        """Print output of each command together."""
+        code = ("import sys, time\n"
+                "for i in range(3):\n"
+                "    print('{0}')\n"
+                "    sys.stdout.flush()\n"
+                "    time.sleep(0.1)\n")
+        commands = [_python_command(Mock(),
+                                    util.running_output,
+                                    code.format(name))
+                    for name in ("first", "second")]
+
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.execute_many(commands, jobs=2)
+
+        lines = [l for l in captured_output.stderr.splitlines() if l.strip()]
+        self.assertThat(lines,
+                        MatchesAny(Equals(["first"] * 3 + ["second"] * 3),
+                                   Equals(["second"] * 3 + ["first"] * 3)))
+
+    def test_partial_line_printed_with_its_command(self):
+        """Partial lines printed on a tick are kept with their command."""
+        self.patch(util, "_PARTIAL_LINE_TIMEOUT", 0.1)
+        commands = [
+            _python_command(Mock(),
+                            util.running_output,
+                            "import sys, time\n"
+                            "sys.stdout.write('PARTIAL')\n"
+                            "sys.stdout.flush()\n"
+                            "time.sleep(0.5)\n"
+                            "print('END')\n"),
+            _python_command(Mock(),
+                            util.running_output,
+                            "import time\n"
+                            "time.sleep(0.25)\n"
+                            "print('second')\n")
+        ]
+
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.execute_many(commands, jobs=2)
+
+        self.assertThat(captured_output.stderr, Contains("PARTIALEND"))
+
+    def test_failure_noted_on_container(self):
+        """Note failure of a command on its container."""
+        container = Mock()
+        with testutil.CapturedOutput():
+            util.execute_many([_python_command(container,
+                                               util.output_on_fail,
+                                               "import sys; sys.exit(1)")])
+
+        container.note_failure.assert_called_once_with(False)
+
+    def test_instant_failure_stops_other_commands(self):
+        """Stop other commands when a command fails instantly."""
+        container = Mock()
+        commands = [
+            _python_command(Mock(),
+                            util.output_on_fail,
+                            "import time; time.sleep(10)"),
+            _python_command(container,
+                            util.output_on_fail,
+                            "import sys; sys.exit(1)",
+                            instant_fail=True),
+            _python_command(Mock(),
+                            util.output_on_fail,
+                            "print('not run')")
+        ]
+
+        started = time.time()
+        with testutil.CapturedOutput():
+            statuses = util.execute_many(commands, jobs=2)
+
+        self.assertThat(5, GreaterThan(time.time() - started))
+        self.assertEqual(statuses, [None, 1, None])
+        container.note_failure.assert_called_once_with(True)
+
+
+def _python_process(code, **kwargs):
+    """Start a python process running code."""
+    return subprocess.Popen(["python", "-c", code], **kwargs)
+
+
+class TestProcessSupervisor(TestCase):
+    """Test case for util.ProcessSupervisor."""
+
+    def test_watch_many_processes(self):
+        """Call on_exit with exit status of each watched process."""
+        statuses = []
+        supervisor = util.ProcessSupervisor()
+        for status in range(3):
+            supervisor.watch(_python_process("import sys; "
+                                             "sys.exit({0})".format(status)),
+                             on_exit=statuses.append)
+
+        supervisor.run()
+        self.assertEqual(sorted(statuses), [0, 1, 2])
+
+    def test_read_output_of_processes(self):
+        """Call on_output with output of each stream of process."""
+        output = [b"", b""]
+
+        def on_output(stream, chunk, more_waiting):
+            """Keep chunk from stream."""
+            del more_waiting
+            output[stream] += chunk
+
+        process = _python_process("import sys; "
+                                  "sys.stdout.write('out'); "
+                                  "sys.stderr.write('err')",
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.stderr.close)
+
+        supervisor = util.ProcessSupervisor()
+        supervisor.watch(process,
+                         (process.stdout, process.stderr),
+                         on_output=on_output)
+        supervisor.run()
+
+        self.assertEqual(output, [b"out", b"err"])
+
+    def test_tick_while_process_runs(self):
+        """Call on_tick periodically while process runs."""
+        ticks = []
+        supervisor = util.ProcessSupervisor()
+        supervisor.watch(_python_process("import time; time.sleep(1)"),
+                         tick=0.1,
+                         on_tick=lambda: ticks.append(None))
+        supervisor.run()
+
+        self.assertThat(len(ticks), GreaterThan(5))
+
+    def test_no_threads_started_for_output(self):
+        """No threads are started to read output where pipes are selectable."""
+        if util.selectors is None or platform.system() == "Windows":
+            self.skipTest("""Pipes are read with threads here""")
+
+        self.patch(util.threading, "Thread", Mock(side_effect=AssertionError))
+
+        with testutil.CapturedOutput():
+            util.execute(Mock(),
+                         util.running_output,
+                         "python",
+                         "-c",
+                         "print('output')")
+
+    def test_no_threads_started_without_selectors(self):
+        """No threads are started to read output without selectors."""
+        if platform.system() == "Windows":
+            self.skipTest("""Pipes are read with threads here""")
+
+        self.patch(util, "selectors", None)
+        self.patch(util.threading, "Thread", Mock(side_effect=AssertionError))
+
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.execute(Mock(),
+                         util.running_output,
+                         "python",
+                         "-c",
+                         "print('output')")
+
+        self.assertThat(captured_output.stderr, Contains("output"))
+
+    def test_output_read_with_select_without_poll(self):
+        """Output is read with select where poll isn't available."""
+        if platform.system() == "Windows":
+            self.skipTest("""Pipes are read with threads here""")
+
+        self.patch(util, "selectors", None)
+        self.patch(util,
+                   "select",
+                   Mock(spec=["select", "error"],
+                        select=select.select,
+                        error=select.error))
+
+        captured_output = testutil.CapturedOutput()
+        with captured_output:
+            util.execute(Mock(),
+                         util.running_output,
+                         "python",
+                         "-c",
+                         "print('output')")
+
+        self.assertThat(captured_output.stderr, Contains("output"))
+
+
 def _full_path_if_exists(path):
     """Return absolute path if it exists, otherwise return basename."""
     if os.path.exists(path):
@@ -573,6 +1163,80 @@ class TestExecutablePaths(OverwrittenEnvironmentVarsTestCase):
                               "python",
                               temp_file.name])
 
+    def test_which_result_kept_for_same_path(self):
+        """PATH is only searched once for the same executable and PATH."""
+        search_path = Mock(wraps=util._search_path)
+        self.patch(util, "_search_path", search_path)
+
+        with testutil.in_tempdir(os.getcwd(), "executable_path") as temp_dir:
+            os.environ["PATH"] = temp_dir
+            os.utime(temp_dir, (0, 0))
+
+            util.which("executable")
+            util.which("executable")
+
+        self.assertEqual(search_path.call_count, 1)
+
+    def test_which_result_not_kept_for_recently_modified_path(self):
+        """PATH is searched again if a directory in it was just modified."""
+        search_path = Mock(wraps=util._search_path)
+        self.patch(util, "_search_path", search_path)
+
+        with testutil.in_tempdir(os.getcwd(), "executable_path") as temp_dir:
+            os.environ["PATH"] = temp_dir
+
+            util.which("executable")
+            util.which("executable")
+
+        self.assertEqual(search_path.call_count, 2)
+
+    def test_which_finds_executable_added_to_path(self):
+        """Find executables added to a directory in PATH after searching."""
+        with testutil.in_tempdir(os.getcwd(), "executable_path") as temp_dir:
+            os.environ["PATH"] = temp_dir
+            self.assertEqual(util.which("executable"), None)
+
+            path = os.path.join(temp_dir, "executable")
+            with open(path, "wt") as executable_file:
+                executable_file.write("#!/bin/sh\n")
+
+            os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+            os.utime(temp_dir, (0, 0))
+
+            self.assertEqual(util.which("executable"),
+                             os.path.normcase(os.path.realpath(path)))
+
+    def test_which_searches_again_when_path_changes(self):
+        """Search for executables again when PATH is changed."""
+        with testutil.in_tempdir(os.getcwd(), "executable_path") as temp_dir:
+            path = os.path.join(temp_dir, "executable")
+            with open(path, "wt") as executable_file:
+                executable_file.write("#!/bin/sh\n")
+
+            os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+
+            os.environ["PATH"] = os.defpath
+            self.assertEqual(util.which("executable"), None)
+
+            util.prepend_environment_variable(None, "PATH", temp_dir)
+            self.assertEqual(util.which("executable"),
+                             os.path.normcase(os.path.realpath(path)))
+
+    def test_shebang_read_again_when_file_changes(self):
+        """Read shebang again when the file it is in changes."""
+        with testutil.in_tempdir(os.getcwd(), "executable_path") as temp_dir:
+            path = os.path.join(temp_dir, "script")
+            with open(path, "wt") as temp_file:
+                temp_file.write("#!/usr/bin/env python\n")
+
+            os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+            util.process_shebang([path])
+
+            with open(path, "wt") as temp_file:
+                temp_file.write("#!/usr/bin/env python3\n")
+
+            self.assertEqual(util.process_shebang([path])[1], "python3")
+
     def test_ignore_shebang_when_in_pathext(self):
         """Ignore shebang when extension is in PATHEXT."""
         with testutil.in_tempdir(os.getcwd(), "executable_path") as temp_dir:
@@ -796,24 +1460,151 @@ class TestApplicationToFilePatterns(TestCase):
 
                 function_applied.assert_not_called()  # suppress(PYC70)
 
+    def test_iterate_files_in_subdirectories(self):
+        """Iterate over files in subdirectories, not matching exclusions."""
+        with testutil.in_tempdir(os.getcwd(), "file_patterns") as temp_dir:
+            os.makedirs(os.path.join(temp_dir, "a", "b"))
+            for name in ["a/one.tmp", "a/b/two.tmp", "a/b/three.other"]:
+                with open(os.path.join(temp_dir, name), "w") as tmp_file:
+                    tmp_file.write("")
+
+            self.assertEqual(sorted(util.iterate_files(temp_dir,
+                                                       matching=["*.tmp"],
+                                                       not_matching=[
+                                                           "*/one.tmp"
+                                                       ])),
+                             [os.path.join(temp_dir, "a", "b", "two.tmp")])
+
+    def test_apply_first_matching_rule(self):
+        """Apply only the first rule matching each file in one walk."""
+        with testutil.in_tempdir(os.getcwd(), "file_patterns") as temp_dir:
+            for name in ["one.tmp", "two.other"]:
+                with open(os.path.join(temp_dir, name), "w") as tmp_file:
+                    tmp_file.write("")
+
+            first = Mock()
+            second = Mock()
+            util.apply_rules(temp_dir,
+                             file_rules=[(["*.tmp"], first),
+                                         (["*"], second)])
+
+            first.assert_called_once_with(os.path.join(temp_dir, "one.tmp"))
+            second.assert_called_once_with(os.path.join(temp_dir,
+                                                        "two.other"))
+
+    def test_no_descend_into_removed_directories(self):
+        """Don't descend into directories removed by a rule."""
+        with testutil.in_tempdir(os.getcwd(), "file_patterns") as temp_dir:
+            os.makedirs(os.path.join(temp_dir, "removed", "inner"))
+
+            function_applied = Mock()
+            util.apply_rules(temp_dir,
+                             file_rules=[(["*"], function_applied)],
+                             directory_rules=[(["*/removed"],
+                                               util.force_remove_tree),
+                                              (["*"], function_applied)])
+
+            function_applied.assert_not_called()  # suppress(PYC70)
+
+    def test_excluded_subtrees_not_listed(self):
+        """Don't list directories where everything is excluded."""
+        with testutil.in_tempdir(os.getcwd(), "file_patterns") as temp_dir:
+            os.makedirs(os.path.join(temp_dir, "build", "inner"))
+            with open(os.path.join(temp_dir, "build", "inner", "f.tmp"),
+                      "w") as tmp_file:
+                tmp_file.write("")
+
+            list_directory = Mock(wraps=util._list_directory)
+            self.patch(util, "_list_directory", list_directory)
+            files = util.apply_to_files(lambda x: x,
+                                        temp_dir,
+                                        matching=["*.tmp"],
+                                        not_matching=["*/build/*"])
+
+            listed = [c[0][0] for c in list_directory.call_args_list]
+            self.assertEqual((files, listed), ([], [temp_dir]))
+
+    def test_list_files_from_git(self):
+        """List files known to git and untracked files not ignored."""
+        with testutil.in_tempdir(os.getcwd(), "file_patterns") as temp_dir:
+            subprocess.check_call(["git", "init", "-q", temp_dir])
+            for name in [".gitignore", "a.tmp", "b.tmp"]:
+                with open(os.path.join(temp_dir, name), "w") as tmp_file:
+                    tmp_file.write("b.tmp\n")
+
+            self.assertEqual(util.apply_to_files(lambda x: x,
+                                                 temp_dir,
+                                                 matching=["*.tmp"],
+                                                 from_git=True),
+                             [os.path.join(temp_dir, "a.tmp")])
+
+
+class TestDirectoryIndex(TestCase):
+    """Test reusing directory listings stored in the container."""
+
+    def _walk_with_index(self, temp_dir):
+        """Return files in tree inside temp_dir, using the index in cache."""
+        container = Mock()
+        container.named_cache_dir.return_value = os.path.join(temp_dir,
+                                                              "cache")
+
+        with util.directory_index(container):
+            return util.apply_to_files(lambda x: x,
+                                       os.path.join(temp_dir, "tree"),
+                                       matching=["*"])
+
+    def test_reuse_listing_of_unchanged_directory(self):
+        """Don't scan a directory again if its mtime is unchanged."""
+        with testutil.in_tempdir(os.getcwd(), "index") as temp_dir:
+            os.makedirs(os.path.join(temp_dir, "cache"))
+            os.makedirs(os.path.join(temp_dir, "tree"))
+            with open(os.path.join(temp_dir, "tree", "f"), "w") as tmp_file:
+                tmp_file.write("")
+
+            os.utime(os.path.join(temp_dir, "tree"), (1000, 1000))
+            self._walk_with_index(temp_dir)
+
+            scan_directory = Mock(wraps=util._scan_directory)
+            self.patch(util, "_scan_directory", scan_directory)
+
+            self.assertEqual((self._walk_with_index(temp_dir),
+                              scan_directory.call_args_list),
+                             ([os.path.join(temp_dir, "tree", "f")], []))
+
+    def test_rescan_directory_with_changed_mtime(self):
+        """Scan a directory again if its mtime changed."""
+        with testutil.in_tempdir(os.getcwd(), "index") as temp_dir:
+            os.makedirs(os.path.join(temp_dir, "cache"))
+            os.makedirs(os.path.join(temp_dir, "tree"))
+
+            os.utime(os.path.join(temp_dir, "tree"), (1000, 1000))
+            self._walk_with_index(temp_dir)
+
+            with open(os.path.join(temp_dir, "tree", "f"), "w") as tmp_file:
+                tmp_file.write("")
+
+            os.utime(os.path.join(temp_dir, "tree"), (2000, 2000))
+            self.assertEqual(self._walk_with_index(temp_dir),
+                             [os.path.join(temp_dir, "tree", "f")])
+
 
 class PrepopulatedMTimeContainer(object):  # suppress(too-few-public-methods)
-    """Stub for container class, exposes named_cache_dir.
+    """Stub for container class, exposes named_cache_dir and lock.
 
-    The current dir will be pre-populated with the md5 of a specified
-    filename, with its actual mtime written to it.
+    The stamp store in the current dir will be pre-populated with the
+    current time for a specified filename.
 
-    named_cache_dir always returns the current directory.
+    named_cache_dir always returns the current directory. The names of
+    locks are kept in held while they are held.
     """
 
     def __init__(self, filename):
-        """Create cache dir and pre-populate it with mtime file."""
+        """Create cache dir and pre-populate it with a stamp."""
         super(PrepopulatedMTimeContainer, self).__init__()
+        self.held = list()
 
         if filename:
-            filename_stamp = hashlib.md5(filename.encode("utf-8")).hexdigest()
-            util.store_current_mtime_in(os.path.join(os.getcwd(),
-                                                     filename_stamp))
+            util.stamp_store(self).put(filename, time.time())
 
     def named_cache_dir(self, *args, **kwargs):  # suppress(no-self-use)
         """Return current directory."""
@@ -822,6 +1613,15 @@ class PrepopulatedMTimeContainer(object):  # suppress(too-few-public-methods)
 
         return os.getcwd()
 
+    @contextmanager
+    def lock(self, name):
+        """Keep name in held while in this context."""
+        self.held.append(name)
+        try:
+            yield
+        finally:
+            self.held.remove(name)
+
 
 class TestStoredMTimes(TestCase):
     """Test storing and acting on modification times."""
@@ -907,3 +1707,360 @@ class TestStoredMTimes(TestCase):
                                    callee)
 
             self.assertThat(callee.call_args_list, Not(Equals(list())))
+
+    def test_stamps_read_from_log_by_new_store(self):
+        """Stamps stored in one store are found by a later one."""
+        with testutil.in_tempdir(os.getcwd(), "mtimes") as temp_dir:
+            path = os.path.join(temp_dir, "stamps.log")
+            util.StampStore(path).put_many({"a": 1.5, "b": 2.5})
+            util.StampStore(path).put("a", 3.5)
+
+            self.assertEqual(util.StampStore(path).get_many(["a", "b", "c"]),
+                             {"a": 3.5, "b": 2.5})
+
+    def test_stamp_log_compacted(self):
+        """Stamp log keeps only the latest stamps once it grows."""
+        with testutil.in_tempdir(os.getcwd(), "mtimes") as temp_dir:
+            path = os.path.join(temp_dir, "stamps.log")
+            store = util.StampStore(path)
+            for stamp in range(10):
+                store.put("a", float(stamp))
+
+            with open(path) as log:
+                self.assertThat(len(log.readlines()), LessThan(3))
+
+    def test_stamp_log_written_holding_lock(self):
+        """Stamp log is only written while holding a lock in container."""
+        with testutil.in_tempdir(os.getcwd(), "mtimes"):
+            container = PrepopulatedMTimeContainer(None)
+            self.patch(util, "_STAMP_STORES", dict())
+            store = util.stamp_store(container)
+
+            held_while_writing = list()
+            write = store._write
+
+            def _record_locks_held(stamps):
+                """Record which locks are held, then write stamps."""
+                held_while_writing.extend(container.held)
+                write(stamps)
+
+            self.patch(store, "_write", _record_locks_held)
+            store.put("a", 1.0)
+
+            self.assertEqual((held_while_writing, container.held),
+                             (["stamps-{0}-stamps".format(
+                                 os.path.basename(os.getcwd())
+                             )], []))
+
+    def test_stamps_stored_by_others_kept_on_compaction(self):
+        """Stamps stored through another store survive compaction."""
+        with testutil.in_tempdir(os.getcwd(), "mtimes") as temp_dir:
+            path = os.path.join(temp_dir, "stamps.log")
+            store = util.StampStore(path)
+            store.put("a", 0.0)
+            util.StampStore(path).put("b", 1.0)
+
+            for stamp in range(10):
+                store.put("a", float(stamp))
+
+            self.assertEqual(util.StampStore(path).get_many(["a", "b"]),
+                             {"a": 9.0, "b": 1.0})
+
+    def test_more_recent_files_in_batch(self):
+        """Only return files more recent than the stored time."""
+        with testutil.in_tempdir(os.getcwd(), "mtimes"):
+            for name in ["old", "new"]:
+                with open(name, "w") as temporary_file:
+                    temporary_file.write("contents")
+
+            container = PrepopulatedMTimeContainer(None)
+            util.stamp_store(container).put_many({
+                os.path.abspath("old"): 1.0,
+                os.path.abspath("new"): 3.0
+            })
+
+            self.assertEqual(util.more_recent_files(container,
+                                                    [os.path.abspath("old"),
+                                                     os.path.abspath("new"),
+                                                     os.path.abspath("none")],
+                                                    2.0),
+                             [os.path.abspath("new")])
+
+
+class TestFingerprints(TestCase):
+    """Test detecting changes to the contents of files."""
+
+    def test_unchanged_files_not_hashed_again(self):
+        """Don't hash files with the same inode, size and mtime again."""
+        with testutil.in_tempdir(os.getcwd(), "fingerprints"):
+            with open("input", "w") as input_file:
+                input_file.write("contents")
+
+            os.utime("input", (1000, 1000))
+            container = PrepopulatedMTimeContainer(None)
+            first = util.fingerprint(container, [os.path.abspath("input")])
+
+            file_digest = Mock(wraps=util._file_digest)
+            self.patch(util, "_file_digest", file_digest)
+
+            self.assertEqual((util.fingerprint(container,
+                                               [os.path.abspath("input")]),
+                              file_digest.call_args_list),
+                             (first, []))
+
+    def test_act_only_where_contents_changed(self):
+        """Call function again only once the contents of inputs change."""
+        with testutil.in_tempdir(os.getcwd(), "fingerprints"):
+            os.makedirs("tree")
+            with open(os.path.join("tree", "input"), "w") as input_file:
+                input_file.write("contents")
+
+            container = PrepopulatedMTimeContainer(None)
+            callee = Mock()
+            inputs = [os.path.abspath("tree")]
+
+            util.where_changed(container, "task", inputs, callee)
+
+            # Same contents, but a different inode and mtime, as if
+            # restored from a tarball.
+            os.remove(os.path.join("tree", "input"))
+            with open(os.path.join("tree", "input"), "w") as input_file:
+                input_file.write("contents")
+
+            util.where_changed(container, "task", inputs, callee)
+
+            with open(os.path.join("tree", "input"), "w") as input_file:
+                input_file.write("changed")
+
+            util.where_changed(container, "task", inputs, callee)
+
+            self.assertEqual(len(callee.call_args_list), 2)
+
+
+class TestDownload(TestCase):
+    """Test downloading files."""
+
+    def test_download_verified_file(self):
+        """Download file with the expected digest."""
+        with testutil.server_in_tempdir(os.getcwd(), "download") as server:
+            with open(os.path.join(server[0], "file"), "wb") as served:
+                served.write(b"contents")
+
+            url = "http://{0}/file".format(server[1])
+            expected = hashlib.sha256(b"contents").hexdigest()
+            destination = util.download(url,
+                                        os.path.join(server[0], "local"),
+                                        digest=expected)
+
+            with open(destination, "rb") as local_file:
+                self.assertEqual(local_file.read(), b"contents")
+
+    def test_download_with_wrong_digest_raises(self):
+        """Raise RuntimeError and keep nothing if the digest is wrong."""
+        with testutil.server_in_tempdir(os.getcwd(), "download") as server:
+            with open(os.path.join(server[0], "file"), "wb") as served:
+                served.write(b"contents")
+
+            destination = os.path.join(server[0], "local")
+            with ExpectedException(RuntimeError):
+                util.download("http://{0}/file".format(server[1]),
+                              destination,
+                              digest="0" * 64)
+
+            self.assertEqual(os.listdir(server[0]), ["file"])
+
+    def test_download_resumed_from_partial_file(self):
+        """Request only the rest of a partial file if it is unchanged."""
+        with testutil.in_tempdir(os.getcwd(), "download") as temp_dir:
+            destination = os.path.join(temp_dir, "local")
+            with open(destination + ".part", "wb") as partial_file:
+                partial_file.write(b"con")
+
+            url = "http://localhost/file"
+            util._save_validator(destination + ".part", url, "\"tag\"")
+
+            remote = Mock()
+            remote.getcode.return_value = 206
+            remote.read.side_effect = io.BytesIO(b"tents").read
+            opener = Mock(return_value=remote)
+            self.patch(util, "url_opener", lambda: opener)
+
+            util.download(url, destination)
+
+            with open(destination, "rb") as local_file:
+                self.assertEqual((opener.call_args[1]["headers"],
+                                  local_file.read(),
+                                  sorted(os.listdir(temp_dir))),
+                                 ({"Range": "bytes=3-",
+                                   "If-Range": "\"tag\""},
+                                  b"contents",
+                                  ["local"]))
+
+    def test_download_restarted_if_file_changed(self):
+        """Replace the partial file if the file at url changed."""
+        with testutil.in_tempdir(os.getcwd(), "download") as temp_dir:
+            destination = os.path.join(temp_dir, "local")
+            with open(destination + ".part", "wb") as partial_file:
+                partial_file.write(b"old")
+
+            url = "http://localhost/file"
+            util._save_validator(destination + ".part", url, "\"old\"")
+
+            remote = Mock()
+            remote.getcode.return_value = 200
+            remote.info.return_value = {"ETag": "\"new\""}
+            remote.read.side_effect = io.BytesIO(b"contents").read
+            self.patch(util, "url_opener", lambda: Mock(return_value=remote))
+
+            util.download(url, destination)
+
+            with open(destination, "rb") as local_file:
+                self.assertEqual(local_file.read(), b"contents")
+
+    def test_partial_file_without_validator_not_resumed(self):
+        """Download everything if a partial file can't be validated."""
+        with testutil.in_tempdir(os.getcwd(), "download") as temp_dir:
+            destination = os.path.join(temp_dir, "local")
+            with open(destination + ".part", "wb") as partial_file:
+                partial_file.write(b"old")
+
+            remote = Mock()
+            remote.getcode.return_value = 200
+            remote.info.return_value = {}
+            remote.read.side_effect = io.BytesIO(b"contents").read
+            opener = Mock(return_value=remote)
+            self.patch(util, "url_opener", lambda: opener)
+
+            util.download("http://localhost/file", destination)
+
+            with open(destination, "rb") as local_file:
+                self.assertEqual((opener.call_args[1]["headers"],
+                                  local_file.read()),
+                                 (None, b"contents"))
+
+    def test_download_resumed_after_connection_drops(self):
+        """Resume a download in the same call if the connection drops."""
+        with testutil.in_tempdir(os.getcwd(), "download") as temp_dir:
+            dropped = Mock()
+            dropped.getcode.return_value = 200
+            dropped.info.return_value = {}
+            dropped.read.side_effect = [b"con", EOFError()]
+
+            resumed = Mock()
+            resumed.getcode.return_value = 206
+            resumed.read.side_effect = io.BytesIO(b"tents").read
+
+            opener = Mock(side_effect=[dropped, resumed])
+            self.patch(util, "url_opener", lambda: opener)
+
+            destination = util.download("http://localhost/file",
+                                        os.path.join(temp_dir, "local"))
+
+            with open(destination, "rb") as local_file:
+                self.assertEqual((opener.call_args[1]["headers"],
+                                  local_file.read()),
+                                 ({"Range": "bytes=3-"}, b"contents"))
+
+    def test_download_and_extract_stripping_components(self):
+        """Extract tarball as it is downloaded, stripping its top level."""
+        with testutil.server_in_tempdir(os.getcwd(), "download") as server:
+            os.makedirs(os.path.join(server[0], "top", "inner"))
+            with open(os.path.join(server[0], "top", "inner", "file"),
+                      "w") as archived_file:
+                archived_file.write("contents")
+
+            with tarfile.open(os.path.join(server[0], "archive.tar.gz"),
+                              "w:gz") as archive:
+                archive.add(os.path.join(server[0], "top"), "top")
+
+            destination = os.path.join(server[0], "extracted")
+            os.makedirs(destination)
+            util.download_and_extract("http://{0}/archive.tar.gz".format(
+                server[1]
+            ), destination, strip_components=1)
+
+            with open(os.path.join(destination, "inner", "file")) as result:
+                self.assertEqual(result.read(), "contents")
+
+    def test_links_out_of_destination_not_extracted(self):
+        """Don't extract links to outside destination or files via them."""
+        with testutil.server_in_tempdir(os.getcwd(), "download") as server:
+            with tarfile.open(os.path.join(server[0], "archive.tar"),
+                              "w") as archive:
+                for name, link_type, linkname in [
+                        ("escape", tarfile.SYMTYPE, ".."),
+                        ("hard", tarfile.LNKTYPE, "../archive.tar"),
+                        ("inside", tarfile.SYMTYPE, "."),
+                        ("inside/escape", tarfile.SYMTYPE, "../..")
+                ]:
+                    link = tarfile.TarInfo(name)
+                    link.type = link_type
+                    link.linkname = linkname
+                    archive.addfile(link)
+
+                archived_file = tarfile.TarInfo("escape/file")
+                archived_file.size = len(b"contents")
+                archive.addfile(archived_file, io.BytesIO(b"contents"))
+
+            destination = os.path.join(server[0], "extracted")
+            util.download_and_extract("http://{0}/archive.tar".format(
+                server[1]
+            ), destination)
+
+            self.assertEqual((sorted(os.listdir(destination)),
+                              os.path.isdir(os.path.join(destination,
+                                                         "escape")),
+                              os.path.exists(os.path.join(server[0],
+                                                          "file"))),
+                             (["escape", "inside"], True, False))
+
+
+class TestTaskResults(TestCase):
+    """Test storing the results of tasks in the container."""
+
+    def setUp(self):  # suppress(N802)
+        """Enable task caching for this test."""
+        super(TestTaskResults, self).setUp()
+        self.patch(util, "_NO_TASK_CACHING", False)
+        self.patch(util, "_COMPLETED_TASKS", dict())
+
+    def test_result_stored_in_container(self):
+        """Result is found in container by a later invocation."""
+        with testutil.in_tempdir(os.getcwd(), "task_results"):
+            container = PrepopulatedMTimeContainer(None)
+            util.register_result("task", {"a": "b"}, container, "1")
+            self.patch(util, "_COMPLETED_TASKS", dict())
+
+            self.assertEqual(util.already_completed("task", container, "1"),
+                             {"a": "b"})
+
+    def test_result_with_other_fingerprint_not_used(self):
+        """Result is not used if its inputs changed."""
+        with testutil.in_tempdir(os.getcwd(), "task_results"):
+            container = PrepopulatedMTimeContainer(None)
+            util.register_result("task", {"a": "b"}, container, "1")
+            self.patch(util, "_COMPLETED_TASKS", dict())
+
+            self.assertIs(util.already_completed("task", container, "2"),
+                          util.NOT_YET_COMPLETED)
+
+    def test_fingerprint_changes_with_file_contents(self):
+        """Fingerprint of a task changes when an input file changes."""
+        with testutil.in_tempdir(os.getcwd(), "task_results"):
+            with open("input", "w") as input_file:
+                input_file.write("1")
+
+            before = util.task_fingerprint(files=["input"])
+
+            with open("input", "w") as input_file:
+                input_file.write("2")
+
+            self.assertNotEqual(before, util.task_fingerprint(files=["input"]))
+
+    def test_fingerprint_changes_with_environment(self):
+        """Fingerprint of a task changes when an input variable changes."""
+        self.patch(os, "environ", {"VARIABLE": "1"})
+        before = util.task_fingerprint(env=["VARIABLE"])
+        os.environ["VARIABLE"] = "2"
+
+        self.assertNotEqual(before, util.task_fingerprint(env=["VARIABLE"]))
@@ -222,9 +222,18 @@ def overridden_dns(dns_map):
     custom_opener = urllib.request.build_opener(http_hnd, https_hnd)
     urllib.request.install_opener(custom_opener)
 
+    # bootstrap.HTTPClient makes its own connections, so also replace
+    # the connection classes that it uses.
+    original_connections = (http_client.HTTPConnection,
+                            http_client.HTTPSConnection)
+    http_client.HTTPConnection = http_connection
+    http_client.HTTPSConnection = https_connection
+
     try:
         yield
     finally:
+        (http_client.HTTPConnection,
+         http_client.HTTPSConnection) = original_connections
         urllib.request.install_opener(urllib.request.build_opener())
 
 